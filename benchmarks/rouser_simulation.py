@@ -0,0 +1,161 @@
+"""Rouser simulation
+
+Drives the scheduler -> rouser path against simulated pins, replaying a scripted button trace every time the alarm
+goes off, and reports how long it took for the output to turn on after the alarm was due and to turn off after the
+input that stopped it.
+
+Usage:
+  rouser_simulation.py [--cycles=<count>] [--interval=<seconds>] [--speed=<factor>] [--trace=<file>] [--conditions=<json>] [--pattern=<json>]
+  rouser_simulation.py (-h | --help)
+
+Options:
+  -h --help              Show this help text
+  --cycles=<count>       Number of alarms to measure, after one warm-up alarm [default: 10]
+  --interval=<seconds>   Real seconds between alarms; should divide 60 [default: 2]
+  --speed=<factor>       How much faster than real time the rouser's clock and the trace run [default: 10]
+  --trace=<file>         JSON list of {"at": seconds after the alarm started, "press" or "release": pin}; by default
+                         three quick presses one second in
+  --conditions=<json>    Stop conditions for the alarm [default: [[{"type": "presses", "count": 3, "within": 2}]]]
+  --pattern=<json>       Output pattern for the alarm; the trace is replayed every time the output turns on, so
+                         patterns other than "on" are mostly useful for watching pattern_jitter_seconds [default: {"type": "on"}]
+"""
+
+from threading import Thread, Event
+from docopt import docopt
+
+import statistics
+import tempfile
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'raspy_alarm'))
+
+from backends import SimulatedBackend  # noqa
+from scheduler import Scheduler  # noqa
+from rouser import Rouser  # noqa
+
+
+OUTPUT_PIN = 17
+INPUT_PIN = 27
+DEFAULT_TRACE = [
+  {'at': 1.0, 'press': INPUT_PIN}, {'at': 1.1, 'release': INPUT_PIN},
+  {'at': 1.3, 'press': INPUT_PIN}, {'at': 1.4, 'release': INPUT_PIN},
+  {'at': 1.6, 'press': INPUT_PIN}, {'at': 1.7, 'release': INPUT_PIN},
+]
+
+
+class TracePlayer(object):
+  # Replays the trace every time the output turns on and records the latencies of both transitions
+  def __init__(self, backend, trace, interval, cycles):
+    self.backend = backend
+    self.trace = sorted(trace, key=lambda event: event['at'])
+    self.interval = interval
+    self.cycles = cycles
+
+    self.last_input = None
+    self.alarms_started = 0
+    self.due_to_on = []
+    self.input_to_off = []
+    self.finished = Event()
+
+  def on_transition(self, output, transition):
+    sim_time, real_time, active = transition
+
+    if active:
+      # The first alarm may be one the scheduler catches up on at startup, so it is not counted
+      self.alarms_started += 1
+      if self.alarms_started > 1:
+        self.due_to_on.append(real_time % self.interval)
+
+      Thread(target=self._replay, daemon=True).start()
+
+    elif self.last_input is not None:
+      self.input_to_off.append(real_time - self.last_input)
+      self.last_input = None
+
+      if len(self.input_to_off) > self.cycles:
+        self.finished.set()
+
+  def _replay(self):
+    elapsed = 0
+
+    for event in self.trace:
+      self.backend.sleep(event['at'] - elapsed)
+      elapsed = event['at']
+
+      if 'press' in event:
+        button = self.backend.inputs[event['press']]
+        self.last_input = time.time()
+        button.press()
+      else:
+        button = self.backend.inputs[event['release']]
+        self.last_input = time.time()
+        button.release()
+
+
+def summarize(name, latencies):
+  if not latencies:
+    print("{:>14}: no samples".format(name))
+    return
+
+  latencies = sorted(latency * 1000 for latency in latencies)
+  p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+  print("{:>14}: n={} min={:.1f}ms mean={:.1f}ms p95={:.1f}ms max={:.1f}ms".format(
+    name, len(latencies), latencies[0], statistics.mean(latencies), p95, latencies[-1]))
+
+
+def run():
+  args = docopt(__doc__)
+  cycles = int(args['--cycles'])
+  interval = int(args['--interval'])
+  trace = DEFAULT_TRACE
+
+  if args['--trace']:
+    with open(args['--trace']) as file:
+      trace = json.load(file)
+
+  backend = SimulatedBackend(speed=float(args['--speed']))
+  rouser = Rouser('simulated', [OUTPUT_PIN], [INPUT_PIN], backend=backend)
+
+  player = TracePlayer(backend, trace, interval, cycles)
+  backend.outputs[OUTPUT_PIN].listeners.append(player.on_transition)
+
+  schedule = {
+    'timezone': 'UTC',
+    'rrule_sets': [{
+      # _make_rrule defaults bysecond to 0, so the seconds have to be listed explicitly
+      'rrules': [{'freq': 'secondly', 'bysecond': list(range(0, 60, interval)), 'dtstart': {'minute': 0, 'second': 0}}],
+      'parameters': {'simulated': {'name': 'simulated', 'stop_conditions': json.loads(args['--conditions']), 'pattern': json.loads(args['--pattern'])}},
+    }],
+  }
+
+  with tempfile.TemporaryDirectory() as directory:
+    os.chdir(directory)
+
+    with open('schedule_rules.json', 'w') as file:
+      json.dump(schedule, file)
+
+    scheduler = Scheduler('schedule_rules.json', rousers=[rouser])
+    threads = [Thread(target=rouser.main_loop), Thread(target=scheduler.main_loop)]
+    for thread in threads:
+      thread.start()
+
+    print("Running {} alarms {} seconds apart at {}x speed...".format(cycles, interval, args['--speed']))
+    finished = player.finished.wait(cycles * interval * 2 + 10)
+
+    scheduler.shutdown()
+    rouser.shutdown()
+    for thread in threads:
+      thread.join()
+
+  if not finished:
+    print("Timed out before all alarms were stopped; check that the trace satisfies the stop conditions.")
+
+  summarize('due -> on', player.due_to_on)
+  summarize('input -> off', player.input_to_off)
+
+
+if __name__ == '__main__':
+  run()
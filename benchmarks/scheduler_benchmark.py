@@ -0,0 +1,189 @@
+"""Scheduler benchmark
+
+Generates synthetic schedules and measures how Scheduler scales when parsing them and calculating alarm times.
+
+Usage:
+  scheduler_benchmark.py [--sizes=<sizes>] [--exclusions=<count>] [--timezones=<names>] [--ticks=<count>] [--from-epoch] [--memory]
+  scheduler_benchmark.py (-h | --help)
+
+Options:
+  -h --help              Show this help text
+  --sizes=<sizes>        Comma-separated numbers of rule sets, e.g. 10,100,1000,10000 [default: 10,100,1000]
+  --exclusions=<count>   Number of excluded datetimes in each schedule [default: 1000]
+  --timezones=<names>    Comma-separated schedule timezones [default: UTC,US/Eastern,Asia/Kolkata]
+  --ticks=<count>        Number of calculate_datetimes calls to average over [default: 100]
+  --from-epoch           Start rules at the scheduler's 2018 epoch instead of today, as schedules without a dtstart do
+  --memory               Also measure peak memory of a cold parse (a second, much slower parse under tracemalloc)
+"""
+
+from docopt import docopt
+
+import tracemalloc
+import datetime
+import tempfile
+import random
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'raspy_alarm'))
+
+from scheduler import Scheduler  # noqa
+import expansion  # noqa
+
+
+SCHEDULE_FILENAME = 'schedule_rules.json'
+
+
+class NullRouser(object):
+  def __init__(self, name):
+    self.name = name
+    self.started = 0
+
+  def start_alarm(self, name, **params):
+    self.started += 1
+
+
+def make_rrule_set(index, rouser_name, from_epoch):
+  kind = index % 4
+
+  if kind == 0:
+    rule = {'freq': 'daily', 'byhour': index % 24, 'byminute': index % 60}
+  elif kind == 1:
+    rule = {'freq': 'weekly', 'byweekday': ['mon', 'wed', 'fri'][index % 3], 'byhour': 7, 'byminute': index % 60}
+  elif kind == 2:
+    rule = {'freq': 'hourly', 'byminute': [0, 30]}
+  else:
+    rule = {'freq': 'minutely', 'interval': 15}
+
+  if not from_epoch:
+    rule['dtstart'] = {'hour': 0, 'minute': 0, 'second': 0}
+
+  rrule_set = {'rrules': [rule], 'parameters': {rouser_name: {'name': 'alarm {}'.format(index)}}}
+
+  if index % 10 == 0:
+    rrule_set['exrules'] = [dict(rule, freq='weekly', byweekday='sat')]
+
+  return rrule_set
+
+
+def make_schedule(num_rrule_sets, num_exclusions, timezone, from_epoch, rouser_name='bench'):
+  random.seed(num_rrule_sets)
+  today = datetime.date.today()
+
+  exclusions = []
+  for _ in range(num_exclusions):
+    day = today + datetime.timedelta(days=random.randrange(7))
+    exclusions.append(dict(year=day.year, month=day.month, day=day.day, hour=random.randrange(24), minute=random.choice([0, 15, 30, 45]), second=0))
+
+  return {
+    'timezone': timezone,
+    'rrule_sets': [make_rrule_set(index, rouser_name, from_epoch) for index in range(num_rrule_sets)],
+    'exceptions': {'exclude': exclusions, 'include': []},
+  }
+
+
+def timed(function, *args):
+  start = time.perf_counter()
+  result = function(*args)
+  return time.perf_counter() - start, result
+
+
+def cold_scheduler(rouser):
+  scheduler = Scheduler(SCHEDULE_FILENAME, rousers=[rouser])
+  if os.path.exists(scheduler.compiled_filepath):
+    os.remove(scheduler.compiled_filepath)
+
+  return scheduler
+
+
+def run_case(num_rrule_sets, num_exclusions, timezone, num_ticks, from_epoch, measure_memory):
+  rouser = NullRouser('bench')
+
+  with open(SCHEDULE_FILENAME, 'w') as file:
+    json.dump(make_schedule(num_rrule_sets, num_exclusions, timezone, from_epoch), file)
+
+  peak_memory = None
+  if measure_memory:
+    tracemalloc.start()
+    cold_scheduler(rouser)._check_schedule()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+  scheduler = cold_scheduler(rouser)
+  cold_parse, _ = timed(scheduler._check_schedule)
+
+  warm_scheduler = Scheduler(SCHEDULE_FILENAME, rousers=[rouser])
+  warm_parse, _ = timed(warm_scheduler._check_schedule)
+
+  now = scheduler.now
+  build_queue, _ = timed(scheduler._build_alarm_queue, now - scheduler.FIRE_WINDOW)
+  build_timeline, _ = timed(scheduler._build_timeline, now)
+  upcoming, _ = timed(scheduler.upcoming)
+
+  # Bulk expansion of a whole year of alarms, which needs numpy
+  expand_year = None
+  if expansion.np is not None:
+    expand_year, _ = timed(scheduler.expand, now, now + datetime.timedelta(days=365))
+
+  tick_total = 0
+  for tick in range(num_ticks):
+    elapsed, _ = timed(scheduler.calculate_datetimes, now + datetime.timedelta(minutes=tick))
+    tick_total += elapsed
+
+  # Drain a day of alarms through the queue as the main loop would, waking at each alarm time
+  end = now + datetime.timedelta(days=1)
+  start = time.perf_counter()
+  while scheduler.alarm_queue and scheduler.alarm_queue[0][0] <= end.timestamp():
+    scheduler._fire_due_alarms(scheduler.alarm_queue[0][2])
+  fire_day = time.perf_counter() - start
+
+  return dict(
+    rule_sets=num_rrule_sets,
+    timezone=timezone,
+    cold_parse=cold_parse,
+    warm_parse=warm_parse,
+    build_queue=build_queue,
+    build_timeline=build_timeline,
+    upcoming=upcoming,
+    expand_year=expand_year,
+    tick=tick_total / max(num_ticks, 1),
+    fire_day=fire_day,
+    fired=rouser.started,
+    peak_memory=peak_memory,
+  )
+
+
+def run():
+  args = docopt(__doc__)
+  sizes = [int(size) for size in args['--sizes'].split(',')]
+  timezones = args['--timezones'].split(',')
+
+  columns = '{:>9} {:>14} {:>11} {:>11} {:>11} {:>10} {:>10} {:>10} {:>11} {:>10} {:>8} {:>10}'
+  print(columns.format('rule sets', 'timezone', 'cold parse', 'warm parse', 'build queue', 'tick', 'timeline', 'upcoming', 'expand year', 'fire day', 'fired', 'peak mem'))
+
+  with tempfile.TemporaryDirectory() as directory:
+    os.chdir(directory)
+
+    for size in sizes:
+      for timezone in timezones:
+        result = run_case(size, int(args['--exclusions']), timezone, int(args['--ticks']), args['--from-epoch'], args['--memory'])
+        print(columns.format(
+          result['rule_sets'],
+          result['timezone'],
+          '{:.3f}s'.format(result['cold_parse']),
+          '{:.3f}s'.format(result['warm_parse']),
+          '{:.3f}s'.format(result['build_queue']),
+          '{:.2f}ms'.format(result['tick'] * 1000),
+          '{:.3f}s'.format(result['build_timeline']),
+          '{:.2f}ms'.format(result['upcoming'] * 1000),
+          '{:.3f}s'.format(result['expand_year']) if result['expand_year'] is not None else '-',
+          '{:.3f}s'.format(result['fire_day']),
+          result['fired'],
+          '{:.1f}MB'.format(result['peak_memory'] / 2 ** 20) if result['peak_memory'] is not None else '-',
+        ))
+
+
+if __name__ == '__main__':
+  run()
@@ -16,4 +16,4 @@ app.config.update(dict(
 os.environ.setdefault('RASPY_ALARM_SETTINGS', 'settings.py')
 app.config.from_envvar('RASPY_ALARM_SETTINGS')
 
-import webviz.views  # noqa
+from . import views  # noqa
@@ -0,0 +1,114 @@
+import time
+
+
+class GpioBackend(object):
+  # Real hardware through gpiozero, which is only imported once a pin is actually needed
+  def make_output(self, pin):
+    import gpiozero
+    return gpiozero.Buzzer(pin)
+
+  def make_input(self, pin):
+    import gpiozero
+    return gpiozero.Button(pin)
+
+  def time(self):
+    return time.time()
+
+  def monotonic(self):
+    # For timing output patterns, which mustn't jump when the clock is set, e.g. by NTP after a power blip
+    return time.monotonic()
+
+  def sleep(self, seconds):
+    time.sleep(seconds)
+
+  def real_timeout(self, timeout):
+    return timeout
+
+  def wait(self, condition, timeout):
+    return condition.wait(timeout)
+
+
+class SimulatedPin(object):
+  def __init__(self, number):
+    self.number = number
+
+
+class SimulatedOutput(object):
+  # Stands in for gpiozero.Buzzer and records every change as (simulated time, real time, active)
+  def __init__(self, pin, backend):
+    self.pin = SimulatedPin(pin)
+    self.backend = backend
+    self.is_active = False
+    self.transitions = []
+    self.listeners = []
+
+  def _set(self, active):
+    if active == self.is_active:
+      return
+
+    self.is_active = active
+    transition = (self.backend.time(), time.time(), active)
+    self.transitions.append(transition)
+
+    for listener in self.listeners:
+      listener(self, transition)
+
+  def on(self):
+    self._set(True)
+
+  def off(self):
+    self._set(False)
+
+
+class SimulatedButton(object):
+  # Stands in for gpiozero.Button; press() and release() run the callbacks just like gpiozero's event thread would
+  def __init__(self, pin, backend):
+    self.pin = SimulatedPin(pin)
+    self.backend = backend
+    self.is_pressed = False
+    self.when_pressed = None
+    self.when_released = None
+
+  def press(self):
+    self.is_pressed = True
+    if self.when_pressed:
+      self.when_pressed(self)
+
+  def release(self):
+    self.is_pressed = False
+    if self.when_released:
+      self.when_released(self)
+
+
+class SimulatedBackend(object):
+  # In-memory pins with a clock that runs `speed` times faster than real time
+  def __init__(self, speed=1):
+    self.speed = speed
+    self.real_start = time.monotonic()
+    self.start = time.time()
+
+    self.outputs = {}
+    self.inputs = {}
+
+  def make_output(self, pin):
+    self.outputs[pin] = SimulatedOutput(pin, self)
+    return self.outputs[pin]
+
+  def make_input(self, pin):
+    self.inputs[pin] = SimulatedButton(pin, self)
+    return self.inputs[pin]
+
+  def time(self):
+    return self.start + (time.monotonic() - self.real_start) * self.speed
+
+  def monotonic(self):
+    return self.time()
+
+  def sleep(self, seconds):
+    time.sleep(seconds / self.speed)
+
+  def real_timeout(self, timeout):
+    return None if timeout is None else timeout / self.speed
+
+  def wait(self, condition, timeout):
+    return condition.wait(self.real_timeout(timeout))
@@ -0,0 +1,297 @@
+import datetime
+import re
+
+from metrics import METRICS
+
+
+# Commands that can be sent to the alarm, as an email subject or a trigger message. Every interface parses them with
+# COMMANDS and only decides who may run them and how to answer:
+#
+#   help                                  the commands the sender may use
+#   schedule                              the alarms in the next week
+#   wake up now                           start the emergency alarm          (wakeup_whitelist)
+#   cancel alarm                          stop it                            (wakeup_whitelist)
+#   skip next | skip [YYYY-MM-DD] HH:MM   don't ring at that time            (edit_whitelist)
+#   unskip [YYYY-MM-DD] HH:MM             undo a skip                        (edit_whitelist)
+#   add alarm [YYYY-MM-DD] HH:MM [rouser ...]
+#                                         a one-off alarm, by default on every rouser  (edit_whitelist)
+#   remove alarm [YYYY-MM-DD] HH:MM       remove a one-off alarm             (edit_whitelist)
+#
+# A time without a date means its next occurrence. Edits are written to the schedule file, which the scheduler reloads
+# at once.
+#
+# Commands are matched by their first word, so parsing costs the same however many there are, and a batch of them
+# (e.g. everything a mail fetch found) is deduplicated before running: repeats of a command, with the same arguments,
+# run once and answer everyone who sent them, as long as no other change came in between.
+
+WHEN = re.compile(r'^(?:(\d{4})-(\d{1,2})-(\d{1,2})\s+)?(\d{1,2}):(\d{2})$')
+ADDED_ALARM_NAME = 'added alarm'
+
+
+class CommandError(ValueError):
+  pass
+
+
+class Command(object):
+  def __init__(self, name, run, help, permission=None, parse=None, mutates=False, announce=False):
+    self.name = name
+    self.run = run  # callable taking (interface, invocation, *args) and returning the reply
+    self.help = help
+    self.permission = permission  # None for any allowed sender, or 'wakeup' or 'edit'
+    self.parse = parse  # callable turning the text after the name into a tuple of args; None for no arguments
+    self.mutates = mutates
+    self.announce = announce  # whether the reply also goes to the main contacts
+
+
+class Invocation(object):
+  def __init__(self, command, args, sender, subject):
+    self.command = command
+    self.args = args
+    self.senders = [sender]
+    self.subject = subject
+
+  @property
+  def key(self):
+    # Changes are the same whoever asks; everything else is answered per sender
+    if self.command.mutates:
+      return (self.command.name, self.args)
+
+    return (self.command.name, self.args, self.senders[0])
+
+  def run(self, interface):
+    METRICS.increment('commands_total', command=self.command.name)
+    return self.command.run(interface, self, *self.args)
+
+
+class CommandRegistry(object):
+  def __init__(self):
+    self.commands = []
+    self.by_word = {}  # first word -> [commands], longest name first
+
+  def register(self, command):
+    self.commands.append(command)
+
+    candidates = self.by_word.setdefault(command.name.split()[0], [])
+    candidates.append(command)
+    candidates.sort(key=lambda candidate: -len(candidate.name))
+
+  def parse(self, text, sender=None):
+    # Returns an Invocation, or None if the text isn't a command; raises CommandError for bad arguments
+    normalized = ' '.join((text or '').lower().split())
+    if not normalized:
+      return None
+
+    for command in self.by_word.get(normalized.split()[0], []):
+      if normalized == command.name:
+        rest = ''
+      elif normalized.startswith(command.name + ' '):
+        rest = normalized[len(command.name) + 1:]
+      else:
+        continue
+
+      if command.parse is None:
+        if rest:
+          continue
+
+        return Invocation(command, (), sender, text)
+
+      return Invocation(command, command.parse(rest), sender, text)
+
+    return None
+
+  def batch(self, invocations):
+    merged = []
+    open_keys = {}  # key -> invocation that later repeats can still be merged into
+
+    for invocation in invocations:
+      key = invocation.key
+      if key in open_keys:
+        METRICS.increment('commands_deduplicated_total', command=invocation.command.name)
+        senders = open_keys[key].senders
+        if invocation.senders[0] not in senders:
+          senders.append(invocation.senders[0])
+        continue
+
+      if invocation.command.mutates:
+        # After a different change, repeating an earlier command means something again
+        open_keys = {}
+
+      open_keys[key] = invocation
+      merged.append(invocation)
+
+    return merged
+
+  def help_text(self, allowed):
+    # `allowed` tells whether the asker has a permission
+    content = "These are the available commands (capitalization doesn't matter):\n\n"
+    for command in self.commands:
+      if command.permission is None or allowed(command.permission):
+        content += "{}: {}\n".format(command.help[0], command.help[1])
+
+    return content
+
+
+def _parse_when(text):
+  match = WHEN.match(text)
+  if match is None:
+    raise CommandError("Expected a time like 07:30 or 2024-05-01 07:30, not \"{}\".".format(text))
+
+  year, month, day, hour, minute = (int(part) if part is not None else None for part in match.groups())
+  if hour > 23 or minute > 59:
+    raise CommandError("{} is not a valid time.".format(text))
+
+  return (year, month, day, hour, minute)
+
+
+def _parse_skip(text):
+  return ('next',) if text == 'next' else (_parse_when(text),)
+
+
+def _parse_add(text):
+  # The time, with or without a date, then any rouser names
+  parts = text.split()
+  count = 2 if parts and '-' in parts[0] else 1
+  return (_parse_when(' '.join(parts[:count])), tuple(parts[count:]))
+
+
+def _resolve_when(scheduler, when):
+  # The datetime meant by parsed (year, month, day, hour, minute) in the schedule's timezone
+  year, month, day, hour, minute = when
+  now = scheduler.now
+
+  try:
+    if year is None:
+      dt = now.replace(hour=hour, minute=minute, second=0)
+      return dt if dt > now else dt + datetime.timedelta(days=1)
+
+    return now.replace(year=year, month=month, day=day, hour=hour, minute=minute, second=0)
+  except ValueError as e:
+    raise CommandError("That is not a valid date: {}".format(str(e)))
+
+
+def _datetime_fields(dt):
+  return dict(year=dt.year, month=dt.month, day=dt.day, hour=dt.hour, minute=dt.minute, second=dt.second)
+
+
+def _matches(scheduler, fields, dt):
+  try:
+    return scheduler.now.replace(**fields) == dt
+  except (TypeError, ValueError) as e:
+    return False
+
+
+def _help(interface, invocation):
+  return interface._help_text(invocation.senders[0])
+
+
+def _schedule(interface, invocation):
+  return interface._schedule_text()
+
+
+def _wake_up_now(interface, invocation):
+  interface._wake_up(interface.wakeup_escalation)
+  return 'Emergency alarm started.'
+
+
+def _cancel(interface, invocation):
+  interface._cancel_alarm()
+  return 'Emergency alarm canceled.'
+
+
+def _skip(interface, invocation, when):
+  scheduler = interface.scheduler
+
+  if when == 'next':
+    upcoming = scheduler.upcoming()
+    if not upcoming:
+      return "There are no alarms coming up to skip."
+
+    dt = upcoming[0][0]
+  else:
+    dt = _resolve_when(scheduler, when)
+
+  def edit(schedule):
+    exceptions = schedule.setdefault('exceptions', {})
+
+    # A one-off alarm is removed; anything else is excluded
+    inclusions = exceptions.get('include', [])
+    remaining = [inclusion for inclusion in inclusions if not _matches(scheduler, inclusion['datetime'], dt)]
+    if len(remaining) < len(inclusions):
+      exceptions['include'] = remaining
+      return
+
+    exclusions = exceptions.setdefault('exclude', [])
+    if not any(_matches(scheduler, exclusion, dt) for exclusion in exclusions):
+      exclusions.append(_datetime_fields(dt))
+
+  scheduler.edit_schedule(edit)
+  return "Skipping the alarm at {}.".format(dt.strftime('%a %Y-%m-%d %H:%M %Z'))
+
+
+def _unskip(interface, invocation, when):
+  scheduler = interface.scheduler
+  dt = _resolve_when(scheduler, when)
+
+  def edit(schedule):
+    exclusions = schedule.get('exceptions', {}).get('exclude', [])
+    remaining = [exclusion for exclusion in exclusions if not _matches(scheduler, exclusion, dt)]
+    if len(remaining) == len(exclusions):
+      return False
+
+    schedule['exceptions']['exclude'] = remaining
+    return True
+
+  if not scheduler.edit_schedule(edit):
+    return "No alarm was skipped at {}.".format(dt.strftime('%a %Y-%m-%d %H:%M %Z'))
+
+  return "The alarm at {} is back on.".format(dt.strftime('%a %Y-%m-%d %H:%M %Z'))
+
+
+def _add_alarm(interface, invocation, when, rouser_names):
+  scheduler = interface.scheduler
+  dt = _resolve_when(scheduler, when)
+
+  # Commands are lowercased, rouser names may not be
+  names = {name.lower(): name for name in scheduler.rousers}
+  unknown = [name for name in rouser_names if name not in names]
+  if unknown:
+    raise CommandError("Unknown rousers: {}. The rousers are: {}.".format(', '.join(unknown), ', '.join(scheduler.rousers)))
+
+  parameters = {names[name]: dict(name=ADDED_ALARM_NAME) for name in rouser_names} or {name: dict(name=ADDED_ALARM_NAME) for name in scheduler.rousers}
+
+  def edit(schedule):
+    exceptions = schedule.setdefault('exceptions', {})
+    exceptions.setdefault('include', []).append(dict(datetime=_datetime_fields(dt), parameters=parameters))
+
+  scheduler.edit_schedule(edit)
+  return "Added an alarm at {} for {}.".format(dt.strftime('%a %Y-%m-%d %H:%M %Z'), ', '.join(sorted(parameters)))
+
+
+def _remove_alarm(interface, invocation, when):
+  scheduler = interface.scheduler
+  dt = _resolve_when(scheduler, when)
+
+  def edit(schedule):
+    inclusions = schedule.get('exceptions', {}).get('include', [])
+    remaining = [inclusion for inclusion in inclusions if not _matches(scheduler, inclusion['datetime'], dt)]
+    if len(remaining) == len(inclusions):
+      return False
+
+    schedule['exceptions']['include'] = remaining
+    return True
+
+  if not scheduler.edit_schedule(edit):
+    return "There is no added alarm at {}; use \"skip\" for regular alarms.".format(dt.strftime('%a %Y-%m-%d %H:%M %Z'))
+
+  return "Removed the alarm at {}.".format(dt.strftime('%a %Y-%m-%d %H:%M %Z'))
+
+
+COMMANDS = CommandRegistry()
+COMMANDS.register(Command('help', _help, ('help', 'Respond with this very list of available commands.')))
+COMMANDS.register(Command('wake up now', _wake_up_now, ('wake up now', 'Wake up the sleeper immediately.'), permission='wakeup', mutates=True, announce=True))
+COMMANDS.register(Command('cancel alarm', _cancel, ('cancel alarm', 'Stop the alarm.'), permission='wakeup', mutates=True, announce=True))
+COMMANDS.register(Command('schedule', _schedule, ('schedule', 'A list of the alarms coming up in the next week.')))
+COMMANDS.register(Command('skip', _skip, ('skip next, or skip [YYYY-MM-DD] HH:MM', "Don't ring the next alarm, or the one at that time."), permission='edit', parse=_parse_skip, mutates=True))
+COMMANDS.register(Command('unskip', _unskip, ('unskip [YYYY-MM-DD] HH:MM', 'Ring a skipped alarm after all.'), permission='edit', parse=lambda text: (_parse_when(text),), mutates=True))
+COMMANDS.register(Command('add alarm', _add_alarm, ('add alarm [YYYY-MM-DD] HH:MM [rousers]', 'Add a one-off alarm, for every rouser unless some are named.'), permission='edit', parse=_parse_add, mutates=True))
+COMMANDS.register(Command('remove alarm', _remove_alarm, ('remove alarm [YYYY-MM-DD] HH:MM', 'Remove a one-off alarm.'), permission='edit', parse=lambda text: (_parse_when(text),), mutates=True))
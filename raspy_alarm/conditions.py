@@ -0,0 +1,210 @@
+from collections import deque
+
+import math
+
+
+# Condition specs are plain dicts so that they can be written in the schedule JSON or the alarm configuration:
+#
+#   {"type": "long_press", "seconds": 3}                        a single press held for at least 3 seconds
+#   {"type": "presses", "count": 3, "within": 5}                3 presses within 5 seconds
+#   {"type": "sequence", "pattern": ["short", "long"], "long": 1, "within": 10}
+#                                                               presses shorter/longer than `long` seconds, in order
+#   {"type": "email"}                                           an email was received (any signal name can be used
+#   {"type": "signal", "name": "email"}                         with "signal")
+#
+# Button conditions may be limited to some of the rouser's input pins with "pins": [...]. Only events after the alarm
+# started (or, for start conditions, since they last triggered) count.
+
+
+class Matcher(object):
+  def __init__(self, spec, input_pins):
+    self.pins = set(spec.get('pins', input_pins))
+    self.reset(None)
+
+  def reset(self, current_time):
+    self.matched = False
+
+  def on_press(self, pin, timestamp):
+    pass
+
+  def on_release(self, pin, timestamp):
+    pass
+
+  def on_signal(self, name, timestamp):
+    pass
+
+  def matches(self, current_time):
+    return self.matched
+
+  def next_deadline(self, current_time):
+    # The earliest time at which this could start matching without any new event, if any
+    return None
+
+
+class NeverMatcher(Matcher):
+  def __init__(self, spec, input_pins):
+    self.pins = set()
+    self.reset(None)
+
+
+class LongPressMatcher(Matcher):
+  def __init__(self, spec, input_pins):
+    self.seconds = float(spec['seconds'])
+    super().__init__(spec, input_pins)
+
+  def reset(self, current_time):
+    super().reset(current_time)
+    self.held_since = {}
+
+  def on_press(self, pin, timestamp):
+    if pin in self.pins:
+      self.held_since[pin] = timestamp
+
+  def on_release(self, pin, timestamp):
+    press_time = self.held_since.pop(pin, None)
+    if press_time is not None and timestamp - press_time >= self.seconds:
+      self.matched = True
+
+  def matches(self, current_time):
+    if not self.matched and any(current_time - press_time >= self.seconds for press_time in self.held_since.values()):
+      self.matched = True
+
+    return self.matched
+
+  def next_deadline(self, current_time):
+    if self.matched or not self.held_since:
+      return None
+
+    return min(self.held_since.values()) + self.seconds
+
+
+class PressCountMatcher(Matcher):
+  def __init__(self, spec, input_pins):
+    self.count = int(spec['count'])
+    self.within = float(spec.get('within', math.inf))
+    super().__init__(spec, input_pins)
+
+  def reset(self, current_time):
+    super().reset(current_time)
+    self.press_times = deque(maxlen=self.count)
+
+  def on_press(self, pin, timestamp):
+    if pin not in self.pins:
+      return
+
+    self.press_times.append(timestamp)
+    if len(self.press_times) == self.count and timestamp - self.press_times[0] <= self.within:
+      self.matched = True
+
+
+class SequenceMatcher(Matcher):
+  def __init__(self, spec, input_pins):
+    self.pattern = [item.lower() for item in spec['pattern']]
+    self.long = float(spec.get('long', 1))
+    self.within = float(spec.get('within', math.inf))
+    super().__init__(spec, input_pins)
+
+  def reset(self, current_time):
+    super().reset(current_time)
+    self.held_since = {}
+    self.presses = deque(maxlen=len(self.pattern))  # (press time, 'short' or 'long')
+
+  def on_press(self, pin, timestamp):
+    if pin in self.pins:
+      self.held_since[pin] = timestamp
+
+  def on_release(self, pin, timestamp):
+    press_time = self.held_since.pop(pin, None)
+    if press_time is None:
+      return
+
+    self.presses.append((press_time, 'long' if timestamp - press_time >= self.long else 'short'))
+
+    if [kind for _, kind in self.presses] == self.pattern and timestamp - self.presses[0][0] <= self.within:
+      self.matched = True
+
+
+class SignalMatcher(Matcher):
+  def __init__(self, spec, input_pins):
+    self.name = spec.get('name', spec['type'])
+    super().__init__(spec, input_pins)
+
+  def on_signal(self, name, timestamp):
+    if name == self.name:
+      self.matched = True
+
+
+MATCHERS = {
+  'long_press': LongPressMatcher,
+  'presses': PressCountMatcher,
+  'sequence': SequenceMatcher,
+  'signal': SignalMatcher,
+  'email': SignalMatcher,
+}
+
+
+def compile_condition(condition, input_pins):
+  if callable(condition):
+    return condition
+
+  try:
+    return MATCHERS[condition['type']](condition, input_pins)
+  except Exception as e:
+    # A bad condition must not keep the alarm from starting, so it just never matches
+    print("Error compiling condition {}: {}".format(condition, str(e)))
+    return NeverMatcher(condition, input_pins)
+
+
+class CompiledConditions(object):
+  # Alternatives (outer list) of conditions that must all hold (inner lists). Matchers are fed input events as they
+  # happen; plain callables taking (current_time, input_pins, INPUTS) are still supported and evaluated each time.
+  def __init__(self, conditions, input_pins):
+    self.spec = conditions
+    self.clauses = [[compile_condition(condition, input_pins) for condition in or_cond] for or_cond in conditions]
+    self.matchers = [condition for clause in self.clauses for condition in clause if isinstance(condition, Matcher)]
+    self.needs_polling = any(not isinstance(condition, Matcher) for clause in self.clauses for condition in clause)
+
+  def __bool__(self):
+    return bool(self.clauses)
+
+  def reset(self, current_time):
+    for matcher in self.matchers:
+      matcher.reset(current_time)
+
+  def on_press(self, pin, timestamp):
+    for matcher in self.matchers:
+      matcher.on_press(pin, timestamp)
+
+  def on_release(self, pin, timestamp):
+    for matcher in self.matchers:
+      matcher.on_release(pin, timestamp)
+
+  def on_signal(self, name, timestamp):
+    for matcher in self.matchers:
+      matcher.on_signal(name, timestamp)
+
+  def next_deadline(self, current_time):
+    deadlines = [matcher.next_deadline(current_time) for matcher in self.matchers]
+    deadlines = [deadline for deadline in deadlines if deadline is not None]
+    return min(deadlines) if deadlines else None
+
+  def evaluate(self, current_time, input_pins, INPUTS):
+    for or_cond in self.clauses:
+      for and_cond in or_cond:
+        if isinstance(and_cond, Matcher):
+          if not and_cond.matches(current_time):
+            break
+
+          continue
+
+        try:
+          if not and_cond(current_time, input_pins, INPUTS):
+            break
+        except Exception as e:
+          print("Error evaluating condition:", str(e))
+          break
+
+      else:
+        return True
+
+    return False
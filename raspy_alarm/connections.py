@@ -0,0 +1,291 @@
+from threading import Condition, Event, Lock, Thread
+
+import traceback
+import select
+import socket
+import time
+import ssl
+import os
+
+from metrics import METRICS
+from outbox import Outbox
+
+
+class Mailbox(object):
+  # What the mailbox thread knows about one registered interface
+  def __init__(self, interface):
+    self.interface = interface
+    self.due = 0  # when to next read it (or renew its IDLE), on time.monotonic()
+    self.idling = False
+    self.busy = False  # while a worker is reading or closing it; the mailbox thread leaves it alone until then
+
+
+class ConnectionManager(object):
+  # Shared by every EmailInterface in the process, so that a team of on-call addresses doesn't cost a set of threads,
+  # sockets and TLS setups per address:
+  #
+  # * one TLS context for every IMAP and SMTP connection, so the CA certificates are loaded once
+  # * one outbox thread, with an SMTP connection per (server, port, login), shared by mailboxes that log in alike
+  # * one mailbox thread that waits on every IDLE connection at once with select, and polls the mailboxes whose
+  #   servers lack IDLE in the same loop. The reads themselves, which may block until the network timeout, each run
+  #   on a short-lived worker of their own, so a server that stops responding only holds up its own mailbox
+  # * one IP-change monitor, which tells every interface about a new address
+  #
+  # IMAP logins are per account, so each mailbox still has a session of its own.
+  POLL_INTERVAL = 1  # seconds between reads of a mailbox without IDLE
+  IP_CHECK_INTERVAL = 60 * 60
+
+  def __init__(self):
+    self.lock = Lock()
+    self.ssl_context = None
+    self.outbox = Outbox(name='shared')
+
+    self.mailboxes = []
+    self.closing = []  # (mailbox, event) pairs for the mailbox thread to log out of
+    self.mailbox_condition = Condition()
+    self.mailbox_thread = None
+    self.wake_pipe = os.pipe()
+    os.set_blocking(self.wake_pipe[1], False)
+
+    self.ip_address = None
+    self.ip_thread = None
+    self.stopped = Event()
+
+  def context(self):
+    with self.lock:
+      if self.ssl_context is None:
+        self.ssl_context = ssl.create_default_context()
+
+      return self.ssl_context
+
+  def register(self, interface):
+    with self.lock:
+      if self.outbox.thread is None:
+        self.outbox.start()
+
+      if self.ip_thread is None:
+        self.ip_thread = Thread(target=self._ip_check_loop, daemon=True, name='ip-monitor')
+        self.ip_thread.start()
+
+      ip_address = self.ip_address
+
+    if ip_address is not None:
+      interface._ip_address_changed(ip_address, None)
+
+    with self.mailbox_condition:
+      self.mailboxes.append(Mailbox(interface))
+
+      if self.mailbox_thread is None:
+        self.mailbox_thread = Thread(target=self._mailbox_loop, daemon=True, name='mailboxes')
+        self.mailbox_thread.start()
+
+    self._wake()
+
+  def unregister(self, interface, timeout=10):
+    # Logs the interface's mailbox out on the mailbox thread; the last one to go stops the shared threads
+    closed = Event()
+
+    with self.mailbox_condition:
+      for mailbox in self.mailboxes:
+        if mailbox.interface is interface:
+          self.mailboxes.remove(mailbox)
+          self.closing.append((mailbox, closed))
+          break
+      else:
+        closed.set()
+
+      last = not self.mailboxes
+
+    self._wake()
+    closed.wait(timeout)
+
+    if last:
+      self.shutdown()
+
+  def _wake(self):
+    with self.lock:
+      if self.wake_pipe is None:
+        return  # stopped
+
+      try:
+        os.write(self.wake_pipe[1], b'\0')
+      except BlockingIOError as e:
+        pass  # the pipe is full of wakeups already
+
+  def _close_wake_pipe(self):
+    with self.lock:
+      if self.wake_pipe is not None:
+        for fd in self.wake_pipe:
+          os.close(fd)
+
+        self.wake_pipe = None
+
+  def _dispatch(self, mailbox, work, *args):
+    # Runs blocking work on a mailbox on a worker thread and wakes the mailbox thread once it's done
+    with self.mailbox_condition:
+      mailbox.busy = True
+
+    def run():
+      try:
+        work(mailbox, *args)
+      finally:
+        with self.mailbox_condition:
+          mailbox.busy = False
+
+        self._wake()
+
+    Thread(target=run, daemon=True, name='mailbox').start()
+
+  def _read_mailbox(self, mailbox):
+    # Reads new mail and goes back to waiting for more, by IDLE if the server has it
+    interface = mailbox.interface
+
+    try:
+      if mailbox.idling:
+        mailbox.idling = False
+        interface._stop_idle()
+
+      if interface.imap_server is None:
+        interface._setup_imap()
+
+      interface._read_email()
+
+      if interface._supports_idle():
+        interface._start_idle()
+        mailbox.idling = True
+        mailbox.due = time.monotonic() + interface.IDLE_TIMEOUT  # renewed before servers drop it
+      else:
+        mailbox.due = time.monotonic() + self.POLL_INTERVAL
+
+    except Exception as e:
+      print("Error reading mailbox {}: {}".format(interface.email_address, str(e)))
+      METRICS.increment('imap_errors_total')
+      traceback.print_exc()
+
+      mailbox.idling = False
+      interface._teardown_imap()
+      mailbox.due = time.monotonic() + interface.IDLE_RETRY_DELAY
+
+  def _read_idle(self, mailbox):
+    try:
+      if mailbox.interface._read_idle():
+        mailbox.due = 0  # new mail
+    except Exception as e:
+      print("Error in IMAP IDLE for {}: {}".format(mailbox.interface.email_address, str(e)))
+      METRICS.increment('imap_errors_total')
+
+      mailbox.idling = False
+      mailbox.interface._teardown_imap()
+      mailbox.due = time.monotonic() + mailbox.interface.IDLE_RETRY_DELAY
+
+  def _close_mailbox(self, mailbox, closed):
+    try:
+      if mailbox.idling:
+        mailbox.interface._stop_idle()
+    except Exception as e:
+      print("Error ending IDLE for {}: {}".format(mailbox.interface.email_address, str(e)))
+
+    mailbox.idling = False
+    mailbox.interface._teardown_imap()
+    closed.set()
+
+  def _mailbox_loop(self):
+    try:
+      while True:
+        with self.mailbox_condition:
+          mailboxes = [mailbox for mailbox in self.mailboxes if not mailbox.busy]
+          # A mailbox is closed once its worker is done with it
+          closing = [(mailbox, closed) for mailbox, closed in self.closing if not mailbox.busy]
+          self.closing = [(mailbox, closed) for mailbox, closed in self.closing if mailbox.busy]
+
+        for mailbox, closed in closing:
+          self._dispatch(mailbox, self._close_mailbox, closed)
+
+        if self.stopped.is_set():
+          return
+
+        now = time.monotonic()
+        for mailbox in mailboxes:
+          if mailbox.due <= now:
+            self._dispatch(mailbox, self._read_mailbox)
+
+        mailboxes = [mailbox for mailbox in mailboxes if not mailbox.busy]
+        idling = {mailbox.interface.imap_server.socket(): mailbox for mailbox in mailboxes if mailbox.idling}
+
+        # TLS may already hold decrypted data that select can't see
+        readable = [sock for sock in idling if getattr(sock, 'pending', lambda: 0)()]
+        if not readable:
+          due = min((mailbox.due for mailbox in mailboxes), default=None)
+          timeout = max(0, due - time.monotonic()) if due is not None else None
+          readable, _, _ = select.select(list(idling) + [self.wake_pipe[0]], [], [], timeout)
+
+        if self.wake_pipe[0] in readable:
+          os.read(self.wake_pipe[0], 4096)
+
+        for sock in readable:
+          if sock in idling:
+            self._dispatch(idling[sock], self._read_idle)
+    finally:
+      self._close_wake_pipe()
+
+  def _current_ip_address(self):
+    # Connecting a UDP socket sends nothing, but makes the OS pick the interface a packet to the internet would use
+    so = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+      so.connect(('8.8.8.8', 80))
+      return so.getsockname()[0]
+    finally:
+      so.close()
+
+  def _ip_check_loop(self):
+    while not self.stopped.is_set():
+      try:
+        ip_address = self._current_ip_address()
+      except OSError as e:
+        ip_address = None  # no network yet
+
+      with self.lock:
+        previous = self.ip_address
+        changed = ip_address is not None and ip_address != previous
+        if changed:
+          self.ip_address = ip_address
+
+      if changed:
+        with self.mailbox_condition:
+          interfaces = [mailbox.interface for mailbox in self.mailboxes]
+
+        for interface in interfaces:
+          interface._ip_address_changed(ip_address, previous)
+
+      # Until there is a network, try again every minute
+      self.stopped.wait(self.IP_CHECK_INTERVAL if ip_address is not None else 60)
+
+  def shutdown(self):
+    self.stopped.set()
+    self._wake()
+
+    with self.mailbox_condition:
+      mailbox_thread = self.mailbox_thread
+
+    # The mailbox thread closes the wake pipe when it stops, since workers may still be waking it until then
+    if mailbox_thread:
+      mailbox_thread.join(5)
+    else:
+      self._close_wake_pipe()
+
+    self.outbox.shutdown()
+
+
+MANAGER = None
+MANAGER_LOCK = Lock()
+
+
+def get_manager():
+  # One manager per process, like the state store, so that every interface shares it
+  global MANAGER
+
+  with MANAGER_LOCK:
+    if MANAGER is None or MANAGER.stopped.is_set():
+      MANAGER = ConnectionManager()
+
+    return MANAGER
@@ -0,0 +1,305 @@
+from threading import Condition, Thread
+
+import traceback
+import math
+
+from backends import GpioBackend
+from metrics import METRICS
+
+
+# Escalation policies start with one device and bring in more until someone responds:
+#
+#   escalations = {
+#     'on_call': [
+#       {'rousers': ['bedroom'], 'deadline': 120},
+#       {'rousers': ['bedroom', 'living_room'], 'pattern': {'type': 'beep', 'on': 0.2, 'off': 0.2}, 'deadline': 180},
+#       {'notify': ['backup@example.com'], 'message': 'Nobody has answered the on-call alarm.'},
+#     ],
+#   }
+#
+# Each stage starts its rousers (any other keys, e.g. "pattern" or "stop_conditions", are passed to start_alarm) and
+# emails its "notify" addresses, then waits up to its "deadline" seconds before moving on to the next stage. Rousers
+# from earlier stages keep going. The escalation ends when one of its rousers is stopped by its conditions or
+# canceled, which stops the rest, or unanswered once the last stage's deadline passes or its rousers have all run
+# for their max_active_duration. Rousers still ringing when it ends unanswered keep going until their own
+# max_active_duration.
+#
+# A rouser that reaches max_active_duration moves the escalation on right away instead of waiting out the deadline,
+# and a snoozed rouser holds the escalation back until the snooze is over. Rousers on other Pis can be started by a
+# stage, but since remote calls are one-way only local rousers can end an escalation by being stopped.
+
+STAGE_KEYS = ('rousers', 'deadline', 'notify', 'message', 'alarm')
+
+
+class WheelTimer(object):
+  __slots__ = ('tick', 'callback', 'args', 'cancelled')
+
+  def __init__(self, tick, callback, args):
+    self.tick = tick
+    self.callback = callback
+    self.args = args
+    self.cancelled = False
+
+
+class TimerWheel(object):
+  # Hashed timing wheel: timers are filed into SLOTS buckets by the tick they are due on, so scheduling and
+  # cancelling are constant time however many are pending, and one thread serves them all by advancing a tick at a
+  # time. Timers more than a turn away sit in their bucket until their tick comes around. The thread only ticks while
+  # timers are pending. Callbacks run on the wheel's thread, one at a time.
+  TICK = 0.25
+  SLOTS = 256
+
+  def __init__(self, backend, tick=None, slots=None):
+    self.backend = backend
+    self.tick = tick or self.TICK
+    self.slots = [[] for _ in range(slots or self.SLOTS)]
+
+    self.condition = Condition()
+    self.origin = None
+    self.ticks = 0  # ticks done since origin
+    self.pending = 0
+    self.running = True
+    self.thread = None
+
+  def schedule(self, delay, callback, *args):
+    with self.condition:
+      now = self.backend.monotonic()
+      if not self.pending:
+        # Nothing was ticking, so the wheel starts over from now
+        self.origin = now
+        self.ticks = 0
+
+      tick = max(self.ticks + 1, math.ceil((now + delay - self.origin) / self.tick))
+      timer = WheelTimer(tick, callback, args)
+      self.slots[tick % len(self.slots)].append(timer)
+      self.pending += 1
+
+      if self.thread is None:
+        self.thread = Thread(target=self._run, daemon=True, name='timer-wheel')
+        self.thread.start()
+
+      self.condition.notify()
+      return timer
+
+  def call_soon(self, callback, *args):
+    return self.schedule(0, callback, *args)
+
+  def cancel(self, timer):
+    # Cancelled timers stay in their bucket until their tick, but are skipped
+    if timer is not None:
+      timer.cancelled = True
+
+  def _run(self):
+    while True:
+      with self.condition:
+        while self.running and not self.pending:
+          self.condition.wait()
+
+        if not self.running:
+          return
+
+        remaining = self.origin + (self.ticks + 1) * self.tick - self.backend.monotonic()
+        if remaining > 0:
+          self.backend.wait(self.condition, remaining)
+          continue
+
+        self.ticks += 1
+        slot = self.slots[self.ticks % len(self.slots)]
+        due = [timer for timer in slot if timer.tick <= self.ticks]
+        slot[:] = [timer for timer in slot if timer.tick > self.ticks]
+        self.pending -= len(due)
+
+      for timer in due:
+        if timer.cancelled:
+          continue
+
+        try:
+          timer.callback(*timer.args)
+        except Exception as e:
+          print("Error in timer callback: {}".format(str(e)))
+          traceback.print_exc()
+
+  def shutdown(self):
+    with self.condition:
+      self.running = False
+      self.condition.notify()
+
+
+class Escalation(object):
+  # One running escalation of a policy
+  def __init__(self, policy, name, timezone, started):
+    self.policy = policy
+    self.name = name
+    self.timezone = timezone
+    self.started = started
+
+    self.stage = -1
+    self.ringing = {}  # rouser name -> alarm name it was started with
+    self.timer = None
+
+
+class Escalator(object):
+  # Runs escalation policies over the given rousers. All of its state is only touched on the timer wheel's thread:
+  # calls from the scheduler, interfaces and rouser callbacks are handed to the wheel, so nothing here ever waits on a
+  # rouser's lock while holding its own.
+  def __init__(self, rousers, policies, notifiers=None, backend=None):
+    self.rousers = {rouser.name: rouser for rouser in rousers}
+    self.policies = policies
+    self.notifiers = notifiers or []  # callables taking (subject, content, recipients)
+    self.backend = backend or next((rouser.backend for rouser in rousers if hasattr(rouser, 'backend')), None) or GpioBackend()
+    self.wheel = TimerWheel(self.backend)
+
+    self.escalations = {}  # policy name -> Escalation
+
+    for rouser in rousers:
+      if hasattr(rouser, 'listeners'):
+        rouser.listeners.append(self._rouser_stopped)
+
+  def policy_rousers(self):
+    # Stand-ins that let the scheduler and interfaces start a policy like any rouser
+    return [EscalationRouser(policy, self) for policy in self.policies]
+
+  def start(self, policy, name=None, timezone=None):
+    self.wheel.call_soon(self._start, policy, name, timezone)
+
+  def cancel(self, policy):
+    self.wheel.call_soon(self._cancel, policy)
+
+  def _start(self, policy, name, timezone):
+    current = self.escalations.get(policy, None)
+    if current is not None:
+      if current.name == (name or policy):
+        return  # like a rouser, a repeated start of the same alarm is ignored
+
+      self._finish(current, 'replaced')
+
+    print("Starting escalation {} for alarm {}...".format(policy, name))
+    METRICS.increment('escalations_started_total', policy=policy)
+
+    escalation = Escalation(policy, name or policy, timezone, self.backend.monotonic())
+    self.escalations[policy] = escalation
+    self._escalate(escalation)
+
+  def _cancel(self, policy):
+    escalation = self.escalations.get(policy, None)
+    if escalation is not None:
+      self._finish(escalation, 'canceled')
+
+  def _advance(self, escalation):
+    stages = self.policies[escalation.policy]
+    if escalation.stage + 1 >= len(stages):
+      return False
+
+    escalation.stage += 1
+    stage = stages[escalation.stage]
+
+    print("Escalation {} reached stage {}.".format(escalation.policy, escalation.stage + 1))
+    METRICS.increment('escalation_stages_total', policy=escalation.policy, stage=escalation.stage + 1)
+
+    params = {key: value for key, value in stage.items() if key not in STAGE_KEYS}
+    alarm_name = stage.get('alarm', escalation.name)
+
+    for rouser_name in stage.get('rousers', []):
+      rouser = self.rousers[rouser_name]
+      if rouser_name in escalation.ringing:
+        # Restarted, since a rouser ignores a repeated start of the alarm it is already running
+        rouser.stop_alarm(reason='escalated')
+
+      escalation.ringing[rouser_name] = alarm_name
+      rouser.start_alarm(alarm_name, timezone=escalation.timezone, **params)
+
+    if stage.get('notify'):
+      content = stage.get('message', "Alarm {} has not been answered.".format(escalation.name))
+      for notifier in self.notifiers:
+        notifier('Escalation: {}'.format(escalation.name), content, stage['notify'])
+
+    self.wheel.cancel(escalation.timer)
+    escalation.timer = None
+    if stage.get('deadline') is not None:
+      escalation.timer = self.wheel.schedule(stage['deadline'], self._deadline, escalation)
+
+    return True
+
+  def _escalate(self, escalation):
+    # Moves on to the next stage, and ends the escalation if that leaves nothing to wait for
+    if not self._advance(escalation) or (not escalation.ringing and escalation.timer is None):
+      self._finish(escalation, 'unanswered')
+
+  def _snoozed_until(self, escalation):
+    # When the latest snooze of the escalation's rousers ends, on the monotonic clock
+    ends = []
+    for rouser_name in escalation.ringing:
+      alarm = getattr(self.rousers[rouser_name], 'alarm', None)
+      if alarm and alarm['snooze_time']:
+        ends.append(alarm['snooze_time'] + alarm['snooze_duration'] - self.rousers[rouser_name].backend.time())
+
+    return self.backend.monotonic() + max(ends) if ends else None
+
+  def _deadline(self, escalation):
+    if self.escalations.get(escalation.policy, None) is not escalation:
+      return
+
+    snoozed_until = self._snoozed_until(escalation)
+    if snoozed_until is not None:
+      # Someone is up; give them the stage's full deadline again once the snooze is over
+      deadline = self.policies[escalation.policy][escalation.stage]['deadline']
+      escalation.timer = self.wheel.schedule(snoozed_until - self.backend.monotonic() + deadline, self._deadline, escalation)
+      return
+
+    self._escalate(escalation)
+
+  def _rouser_stopped(self, rouser, alarm_name, reason):
+    # Called by rousers, with their lock held, whenever an alarm stops
+    if reason != 'escalated':
+      self.wheel.call_soon(self._handle_stop, rouser.name, alarm_name, reason)
+
+  def _handle_stop(self, rouser_name, alarm_name, reason):
+    for escalation in list(self.escalations.values()):
+      if escalation.ringing.get(rouser_name, None) != alarm_name:
+        continue
+
+      del escalation.ringing[rouser_name]
+
+      if reason == 'expired':
+        # Nobody responded to this rouser; don't wait for the deadline to try the next stage
+        if not escalation.ringing:
+          self._escalate(escalation)
+
+      else:
+        METRICS.observe('escalation_response_seconds', self.backend.monotonic() - escalation.started, policy=escalation.policy)
+        self._finish(escalation, 'answered')
+
+  def _finish(self, escalation, outcome):
+    print("Escalation {} {} at stage {}.".format(escalation.policy, outcome, escalation.stage + 1))
+    METRICS.increment('escalations_finished_total', policy=escalation.policy, outcome=outcome)
+
+    self.wheel.cancel(escalation.timer)
+    del self.escalations[escalation.policy]
+
+    if outcome == 'unanswered':
+      return  # nobody has responded yet, so whatever is still ringing keeps going until its max_active_duration
+
+    for rouser_name in escalation.ringing:
+      self.rousers[rouser_name].stop_alarm(reason='escalated')
+
+  def shutdown(self):
+    self.wheel.shutdown()
+
+
+class EscalationRouser(object):
+  # Stands in for a Rouser in Scheduler.rousers, so that schedules and email commands can start a policy by name
+  def __init__(self, name, escalator):
+    self.name = name
+    self.escalator = escalator
+
+  def start_alarm(self, name=None, timezone=None, **params):
+    self.escalator.start(self.name, name, timezone)
+
+  def stop_alarm(self, reason='canceled'):
+    self.escalator.cancel(self.name)
+
+  def signal(self, name):
+    pass  # signals go to the rousers themselves
+
+  def shutdown(self):
+    pass
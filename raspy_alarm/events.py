@@ -0,0 +1,67 @@
+from array import array
+
+import math
+
+
+class EventBuffer(object):
+  # Fixed-capacity ring buffer of button presses. Each event is a press timestamp and a release timestamp, which is
+  # NaN while the button is still held. Once full, the oldest events are overwritten.
+  #
+  # Indexing and iteration give `[press]` or `[press, release]` lists like the plain lists previously stored in
+  # Rouser.INPUTS, so existing condition callables keep working. The declarative conditions don't read it at all;
+  # their matchers are fed each event as it happens (see conditions.py).
+  DEFAULT_CAPACITY = 256
+
+  def __init__(self, capacity=None):
+    self.capacity = capacity or self.DEFAULT_CAPACITY
+    self.press_times = array('d', [0.0]) * self.capacity
+    self.release_times = array('d', [math.nan]) * self.capacity
+    self.start = 0
+    self.count = 0
+
+  def _physical(self, index):
+    if index < 0:
+      index += self.count
+
+    if not 0 <= index < self.count:
+      raise IndexError("event index out of range")
+
+    return (self.start + index) % self.capacity
+
+  def press(self, timestamp):
+    if self.count < self.capacity:
+      position = (self.start + self.count) % self.capacity
+      self.count += 1
+    else:
+      position = self.start
+      self.start = (self.start + 1) % self.capacity
+
+    self.press_times[position] = timestamp
+    self.release_times[position] = math.nan
+
+  def release(self, timestamp):
+    if not self.count:
+      return
+
+    position = self._physical(-1)
+    if math.isnan(self.release_times[position]):
+      self.release_times[position] = timestamp
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in range(*index.indices(self.count))]
+
+    position = self._physical(index)
+    release_time = self.release_times[position]
+
+    if math.isnan(release_time):
+      return [self.press_times[position]]
+
+    return [self.press_times[position], release_time]
+
+  def __iter__(self):
+    for index in range(self.count):
+      yield self[index]
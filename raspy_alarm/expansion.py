@@ -0,0 +1,210 @@
+from dateutil import rrule
+
+import datetime
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+
+# Bulk expansion of rrule sets into NumPy arrays of epoch seconds, for questions about long stretches of the schedule
+# such as "how many alarms fire next year". Rules whose occurrences are a simple grid (anything but COUNT, UNTIL,
+# BYSETPOS, BYYEARDAY, BYWEEKNO, BYEASTER, and nth or negative weekdays/month days) are generated with array
+# arithmetic in local wall-clock time and then converted to UTC; any other rule falls back on rrule.between. This
+# reads the normalized rule from dateutil's rrule attributes, so defaults (e.g. the hour of a daily rule without
+# byhour) come out exactly as dateutil would fill them in.
+
+NAIVE_EPOCH = datetime.datetime(1970, 1, 1)
+DAY = 86400
+SUBDAILY_SECONDS = {rrule.HOURLY: 3600, rrule.MINUTELY: 60, rrule.SECONDLY: 1}
+
+
+def require_numpy():
+  if np is None:
+    raise ImportError("Bulk schedule expansion needs numpy; install it with `pip install numpy`.")
+
+
+def sorted_unique(values):
+  # np.unique, but sort-based, which beats its hashing for the mostly sorted arrays here
+  values = np.sort(values)
+  if len(values) < 2:
+    return values
+
+  keep = np.empty(len(values), dtype=bool)
+  keep[0] = True
+  np.not_equal(values[1:], values[:-1], out=keep[1:])
+  return values[keep]
+
+
+def contains(haystack, values):
+  # np.isin for a sorted haystack, by binary search instead of sorting both arrays again
+  if not len(haystack):
+    return np.zeros(len(values), dtype=bool)
+
+  positions = np.minimum(np.searchsorted(haystack, values), len(haystack) - 1)
+  return haystack[positions] == values
+
+
+def _local_seconds(dt):
+  # Wall-clock time as seconds since the epoch, ignoring the timezone
+  return int((dt.replace(tzinfo=None) - NAIVE_EPOCH).total_seconds())
+
+
+def is_vectorizable(rule):
+  return (
+    rule._count is None and rule._until is None and rule._bysetpos is None and rule._byyearday is None and
+    rule._byweekno is None and rule._byeaster is None and not rule._bynweekday and not rule._bynmonthday
+  )
+
+
+def _day_mask(rule, days):
+  # Which of the given days (days since the epoch) the BYxxx parts of the rule allow
+  mask = np.ones(len(days), dtype=bool)
+
+  if rule._byweekday is not None:
+    mask &= np.isin((days + 3) % 7, list(rule._byweekday))  # 1970-01-01 was a Thursday
+
+  if rule._bymonth or rule._bymonthday:
+    dates = days.astype('datetime64[D]')
+    months = dates.astype('datetime64[M]')
+
+    if rule._bymonth:
+      mask &= np.isin(months.astype(np.int64) % 12 + 1, list(rule._bymonth))
+
+    if rule._bymonthday:
+      mask &= np.isin((dates - months.astype('datetime64[D]')).astype(np.int64) + 1, list(rule._bymonthday))
+
+  return mask
+
+
+def _time_offsets(hours, minutes, seconds):
+  offsets = [hour * 3600 + minute * 60 + second for hour in hours for minute in minutes for second in seconds]
+  return np.array(sorted(offsets), dtype=np.int64)
+
+
+def _expand_daily_grid(rule, low, high):
+  # YEARLY, MONTHLY, WEEKLY and DAILY rules: every allowed day in the period, at every allowed time of day
+  start = _local_seconds(rule._dtstart)
+  start_day = start // DAY
+  days = np.arange(max(low // DAY, start_day), high // DAY + 1, dtype=np.int64)
+
+  if rule._interval > 1:
+    if rule._freq == rrule.DAILY:
+      periods = days - start_day
+    elif rule._freq == rrule.WEEKLY:
+      week_starts = days - ((days + 3 - rule._wkst) % 7)
+      periods = (week_starts - (start_day - ((start_day + 3 - rule._wkst) % 7))) // 7
+    else:
+      months = days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+      start_month = (rule._dtstart.year - 1970) * 12 + rule._dtstart.month - 1
+      periods = months - start_month if rule._freq == rrule.MONTHLY else months // 12 - start_month // 12
+
+    days = days[periods % rule._interval == 0]
+
+  days = days[_day_mask(rule, days)]
+  occurrences = (days[:, None] * DAY + _time_offsets(rule._byhour, rule._byminute, rule._bysecond)[None, :]).ravel()
+  return occurrences[(occurrences >= start) & (occurrences >= low) & (occurrences <= high)]
+
+
+def _expand_subdaily_grid(rule, low, high):
+  # HOURLY, MINUTELY and SECONDLY rules: every interval'th hour/minute/second since dtstart, filtered by the BYxxx parts
+  unit = SUBDAILY_SECONDS[rule._freq]
+  start = _local_seconds(rule._dtstart)
+  step = unit * rule._interval
+  first_period = start - start % unit
+
+  first = max(0, (low - first_period) // step)
+  last = (high - first_period) // step
+  periods = first_period + np.arange(first, last + 1, dtype=np.int64) * step
+
+  if rule._freq == rrule.HOURLY:
+    offsets = _time_offsets([0], rule._byminute, rule._bysecond)
+  elif rule._freq == rrule.MINUTELY:
+    offsets = _time_offsets([0], [0], rule._bysecond)
+  else:
+    offsets = np.zeros(1, dtype=np.int64)
+
+  occurrences = (periods[:, None] + offsets[None, :]).ravel()
+  occurrences = occurrences[(occurrences >= start) & (occurrences >= low) & (occurrences <= high)]
+
+  seconds_of_day = occurrences % DAY
+  mask = _day_mask(rule, occurrences // DAY)
+  if rule._byhour is not None:
+    mask &= np.isin(seconds_of_day // 3600, list(rule._byhour))
+  if rule._byminute is not None and rule._freq != rrule.HOURLY:
+    mask &= np.isin(seconds_of_day // 60 % 60, list(rule._byminute))
+  if rule._bysecond is not None and rule._freq == rrule.SECONDLY:
+    mask &= np.isin(seconds_of_day % 60, list(rule._bysecond))
+
+  return occurrences[mask]
+
+
+class OffsetCache(object):
+  # UTC offsets by local wall-clock hour, shared by every rule of a schedule since they all use its timezone
+  def __init__(self, timezone):
+    self.timezone = timezone
+    self.hours = np.empty(0, dtype=np.int64)  # sorted
+    self.offsets = np.empty(0, dtype=np.int64)
+
+  def _offset(self, hour):
+    wall_time = (NAIVE_EPOCH + datetime.timedelta(hours=hour)).replace(tzinfo=self.timezone)
+    offset = wall_time.utcoffset()
+    return int(offset.total_seconds()) if offset is not None else 0
+
+  def to_utc(self, local):
+    keys = local // 3600
+    hours = sorted_unique(keys)
+
+    missing = hours[~contains(self.hours, hours)]
+    if len(missing):
+      all_hours = np.concatenate([self.hours, missing])
+      all_offsets = np.concatenate([self.offsets, np.array([self._offset(hour) for hour in missing.tolist()], dtype=np.int64)])
+
+      order = np.argsort(all_hours)
+      self.hours = all_hours[order]
+      self.offsets = all_offsets[order]
+
+    return local - self.offsets[np.searchsorted(self.hours, keys)]
+
+
+def _timestamps(datetimes):
+  return np.array([int(dt.timestamp()) for dt in datetimes], dtype=np.int64)
+
+
+def expand_rule(rule, start, end, offset_cache):
+  # Occurrences of one rrule in [start, end] as sorted epoch seconds
+  if not is_vectorizable(rule):
+    return _timestamps(rule.between(start, end, inc=True))
+
+  # Generous bounds in local time, since the UTC offset isn't known until the occurrences are
+  low = _local_seconds(start.astimezone(rule._tzinfo) if rule._tzinfo else start) - DAY
+  high = _local_seconds(end.astimezone(rule._tzinfo) if rule._tzinfo else end) + DAY
+
+  if rule._freq in SUBDAILY_SECONDS:
+    local = _expand_subdaily_grid(rule, low, high)
+  else:
+    local = _expand_daily_grid(rule, low, high)
+
+  if rule._tzinfo is not None:
+    occurrences = offset_cache.to_utc(local)
+  else:
+    occurrences = _timestamps(NAIVE_EPOCH + datetime.timedelta(seconds=int(value)) for value in local)
+
+  return np.sort(occurrences[(occurrences >= int(start.timestamp())) & (occurrences <= int(end.timestamp()))])
+
+
+def expand_rule_set(rule_set, start, end, offset_cache):
+  # Occurrences of a whole rruleset in [start, end] as sorted, unique epoch seconds
+  parts = [expand_rule(rule, start, end, offset_cache) for rule in rule_set._rrule]
+  parts.append(_timestamps(dt for dt in rule_set._rdate if start <= dt <= end))
+  occurrences = sorted_unique(np.concatenate(parts))
+
+  excluded = [expand_rule(rule, start, end, offset_cache) for rule in rule_set._exrule]
+  excluded.append(_timestamps(rule_set._exdate))
+  excluded = sorted_unique(np.concatenate(excluded))
+
+  if len(excluded):
+    occurrences = occurrences[~contains(excluded, occurrences)]
+
+  return occurrences
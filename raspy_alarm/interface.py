@@ -1,141 +1,275 @@
-from email.message import Message
-from threading import Thread
+from email.utils import parseaddr
 
 import traceback
 import imaplib
 import smtplib
-import socket
 import email
 import json
-import time
 import os
 import re
 
+from commands import COMMANDS, CommandError
+from connections import get_manager
+from state import open_store
+from metrics import METRICS
+
 
 class Interface(object):
-  def startup(self):
-    raise NotImplemented()
+  SCHEDULE_DAYS = 7  # how far ahead the "schedule" command looks
+  SCHEDULE_LIMIT = 100  # most alarms listed in one reply
 
-  def check(self):
+  wakeup_escalation = None  # escalation policy that "wake up now" starts instead of every rouser
+
+  # Interfaces receive their events on threads of their own and act on them through methods on the scheduler
+  def startup(self):
     raise NotImplemented()
 
   def shutdown(self):
     raise NotImplemented()
 
+  # The commands themselves are shared by every interface (see commands.py); each one only decides who may run them
+  # and how to reply
+  def _allowed(self, sender, permission):
+    return permission is None
+
+  def _help_text(self, sender=None):
+    return COMMANDS.help_text(lambda permission: self._allowed(sender, permission))
+
+  def _rousers(self):
+    # The scheduler's rousers without the stand-ins for escalation policies (see escalation.py), which are only
+    # started by name
+    return [rouser for rouser in self.scheduler.rousers.values() if not hasattr(rouser, 'escalator')]
+
+  def _wake_up(self, escalation=None):
+    if escalation:
+      # Starts with one device and escalates from there rather than waking every rouser at once; see escalation.py
+      self.scheduler.rousers[escalation].start_alarm('wake up now')
+    else:
+      for rouser in self._rousers():
+        rouser.start_alarm('wake up now')
+
+  def _cancel_alarm(self):
+    for rouser in self._rousers():
+      rouser.stop_alarm()
+
+    # Escalations with rousers ringing end as answered above; this also ends any that are waiting between stages
+    for rouser in self.scheduler.rousers.values():
+      if hasattr(rouser, 'escalator'):
+        rouser.stop_alarm()
+
+  def _signal(self, name):
+    for rouser in self._rousers():
+      rouser.signal(name)
+
+  def _schedule_text(self):
+    upcoming = self.scheduler.upcoming(self.SCHEDULE_DAYS)
+
+    content = "Current time: {}\n".format(self.scheduler.now)
+    content += "Alarms in the next {} days:\n\n".format(self.SCHEDULE_DAYS)
+    for dt, params in upcoming[:self.SCHEDULE_LIMIT]:
+      alarms = ', '.join('{} ({})'.format(rouser_name, alarm_params.get('name')) for rouser_name, alarm_params in params.items())
+      content += "{}: {}\n".format(dt.strftime('%a %Y-%m-%d %H:%M:%S %Z'), alarms)
+
+    if len(upcoming) > self.SCHEDULE_LIMIT:
+      content += "...and {} more.\n".format(len(upcoming) - self.SCHEDULE_LIMIT)
+
+    return content
+
   def _clean_address(self, email_address):
     parts = email_address.split('@')
     return parts[0] + '_' + parts[1].split('.')[0]
 
 
 class EmailInterface(Interface):
-  NUM_SEND_ATTEMPTS = 2
-  NUM_READ_ATTEMPTS = 2
+  # Mail is read on the connection manager's mailbox thread, by IDLE or by polling, rather than by the scheduler
+  IDLE_TIMEOUT = 25 * 60  # servers may drop IDLE connections after 30 minutes, so it is renewed before then
+  IDLE_RETRY_DELAY = 30  # after a connection error
+  NETWORK_TIMEOUT = 30  # for every read and write, since one unresponsive server would stall every mailbox and all mail
+  HEADER_FIELDS = '(BODY.PEEK[HEADER.FIELDS (FROM TO SUBJECT)])'
+  UID_PATTERN = re.compile(rb'UID (\d+)')
 
   def __init__(self, **kwargs):
     self.scheduler = None
 
     self.info = kwargs
-    self.smtp_server = None
+    self.state = self.info.pop('state', None) or open_store()
+    self.connections = self.info.pop('connections', None) or get_manager()
     self.imap_server = None
+    self.idle_tag = None
+    self.idle_buffer = b''
 
-    self.ip_address = None
-    self.ip_check_thread = None
+    # Mailboxes that log in to the same SMTP server alike share a connection
+    self.smtp_account = (self.info.get('smtp_server'), self.info.get('smtp_port'), self.info['address'])
+    self.outbox = self.connections.outbox
+    self.outbox.add_account(self.smtp_account, self._connect_smtp)
 
     self.email_address = self.info['address']
     self.clean_address = self._clean_address(self.email_address)
     self.main_contacts = self.info['main_contacts']
 
+    # Built once rather than per message
+    self.wakeup_senders = frozenset(self.info['wakeup_whitelist'])
+    self.edit_senders = frozenset(self.info['edit_whitelist'])
+    self.whitelist = self.wakeup_senders | self.edit_senders
+    self.wakeup_escalation = self.info.get('wakeup_escalation', None)
+
     self.previous_sender = None
 
-  def _handle_email(self, email):
-    print('Email from: {}'.format(email['From']))
-    print('Email to: {}'.format(email['To']))
-    print('Email subject: {}'.format(email['Subject']))
+  def _allowed(self, sender, permission):
+    if permission == 'wakeup':
+      return sender in self.wakeup_senders
+    if permission == 'edit':
+      return sender in self.edit_senders
 
-    sender = re.search('<(.*)>', email['From']).groups()[0]
-    subject = email['Subject'].lower()
-    send_acknowledgement = False
+    return sender in self.whitelist
 
-    if sender not in self.info['wakeup_whitelist'] + self.info['edit_whitelist']:
-      return
+  def _handle_email(self, message):
+    self._handle_emails([message])
 
-    if subject == 'help':
-      content = "These are the available commands (commands must be exactly as shown, except capitalization doesn't matter):\n\n"
-      content += "help: Respond with this very list of available commands.\n"
-      content += "wake up now: Wake up the sleeper immediately.\n"
-      content += "cancel alarm: Stop the alarm.\n"
-      content += "schedule: A list of upcoming alarm times.\n"
+  def _handle_emails(self, emails):
+    # Handles a whole fetch at once, so that a flood of the same command runs, and is answered, only once
+    invocations = []
+    handled = False
+    for message in emails:
+      print('Email from: {}'.format(message['From']))
+      print('Email to: {}'.format(message['To']))
+      print('Email subject: {}'.format(message['Subject']))
 
-      if sender in self.info['edit_whitelist']:
-        pass
+      sender = self._get_sender(message)
+      if sender not in self.whitelist:
+        continue
 
-      content += "\nAs always, feel free to email any of these for more information: {}".format(', '.join(self.main_contacts))
-      self._send_email('Re: ' + email['Subject'], content, self.email_address, [sender])
+      METRICS.increment('emails_handled_total')
+      handled = True
 
-    elif subject == 'wake up now' and sender in self.info['wakeup_whitelist']:
-      for rouser in self.scheduler.rousers.values():
-        rouser.start_alarm('wake up now')
+      try:
+        invocation = COMMANDS.parse(message['Subject'], sender)
+      except CommandError as e:
+        self._send_email('Re: ' + (message['Subject'] or ''), str(e), self.email_address, [sender])
+        continue
 
-      self.previous_sender = sender
-      recipients = list(set(self.main_contacts + [sender]))
-      self._send_email('Re: ' + email['Subject'], 'Emergency alarm started.', self.email_address, recipients)
+      if invocation is not None and self._allowed(sender, invocation.command.permission):
+        invocations.append(invocation)
 
-    elif subject == 'cancel alarm' and sender in self.info['wakeup_whitelist']:
-      for rouser in self.scheduler.rousers.values():
-        rouser.stop_alarm()
+    if not handled:
+      return
+
+    self._signal('email')
+
+    # Any error is answered rather than raised, since raising would keep the fetch from being marked as read and so
+    # rerun every command in it on the next attempt
+    for invocation in COMMANDS.batch(invocations):
+      try:
+        self._run_command(invocation)
+      except CommandError as e:
+        self._send_email('Re: ' + invocation.subject, str(e), self.email_address, invocation.senders)
+      except Exception as e:
+        print("Error running command {}: {}".format(invocation.command.name, str(e)))
+        METRICS.increment('command_errors_total', command=invocation.command.name)
+        traceback.print_exc()
+        self._send_email('Re: ' + invocation.subject, 'Error: {}'.format(str(e)), self.email_address, invocation.senders)
+
+  def _run_command(self, invocation):
+    content = invocation.run(self)
+    recipients = list(invocation.senders)
 
-      recipients = list(set(self.main_contacts + [self.previous_sender, sender]))
+    if invocation.command.announce:
+      recipients += self.main_contacts
+
+    if invocation.command.name == 'wake up now':
+      self.previous_sender = invocation.senders[-1]
+
+    elif invocation.command.name == 'cancel alarm':
+      recipients.append(self.previous_sender)
       self.previous_sender = None
-      self._send_email('Re: ' + email['Subject'], 'Emergency alarm canceled.', self.email_address, recipients)
 
-    elif subject == 'schedule':
-      content = "Current time:{}\n".format(self.scheduler.now)
-      content += "Upcoming alarm times:\n\n"
-      content += json.dumps(self.scheduler.calculate_datetimes(), indent=2, default=str)
-      self._send_email('Re: ' + email['Subject'], content, self.email_address, [sender])
+    elif invocation.command.name == 'help':
+      content += "\nAs always, feel free to email any of these for more information: {}".format(', '.join(self.main_contacts))
+
+    self._send_email('Re: ' + invocation.subject, content, self.email_address, list(set(recipients)))
+
+  def notify(self, subject, content, recipients):
+    # For other components, e.g. escalations, to email people through this interface's account
+    self._send_email(subject, content, self.email_address, recipients)
 
-    if send_acknowledgement:
-      self._send_email('Re: ' + email['Subject'], 'acknowledged', self.email_address, [sender])
+  def _get_sender(self, message):
+    return parseaddr(message['From'] or '')[1]
 
   def _read_email(self):
-    contents = None
-    filepath = os.path.join(os.getcwd(), 'data', self.clean_address)
+    with METRICS.timer('imap_fetch_seconds'):
+      self._fetch_email()
 
+  def _load_progress(self):
+    key = 'email/{}'.format(self.clean_address)
+    data = self.state.get(key, None)
+    if data is not None:
+      return data
+
+    # Older versions kept this in a JSON file of its own
     try:
-      with open(filepath, 'r') as file:
+      with open(os.path.join(os.getcwd(), 'data', self.clean_address), 'r') as file:
         contents = file.read()
     except FileNotFoundError as e:
-      pass
+      contents = None
 
-    if contents:
-      data = json.loads(contents)
-    else:
-      data = {'latest_email': 0}
+    return json.loads(contents) if contents else {}
+
+  def _fetch_email(self):
+    data = self._load_progress()
 
     self.imap_server.select('INBOX')
-    response, email_ids = self.imap_server.search(None, 'ALL')
+    uid_validity = int(self.imap_server.untagged_responses.get('UIDVALIDITY', [0])[-1])
+
+    if data.get('uid_validity') != uid_validity:
+      if 'latest_email' in data or 'uid_validity' in data:
+        # Sequence numbers from older versions (or UIDs from a different UIDVALIDITY) can't be mapped onto
+        # current UIDs, so skip everything that is already in the mailbox
+        response, uids = self.imap_server.uid('SEARCH', None, 'ALL')
+        data['latest_uid'] = max(map(int, uids[0].split()), default=0) + 1
+        data.pop('latest_email', None)
+      else:
+        data['latest_uid'] = 1
+
+      data['uid_validity'] = uid_validity
+
+    # `UID n:*` always matches the newest message even if its UID is below n, hence the filter
+    response, uids = self.imap_server.uid('SEARCH', None, 'UID {}:*'.format(data['latest_uid']))
     if response != 'OK':
       print('COULD NOT READ {}'.format(self.email_address))
       return
 
-    email_ids = sorted(map(int, email_ids[0].decode('utf-8').split()))
+    uids = sorted(uid for uid in map(int, uids[0].split()) if uid >= data['latest_uid'])
 
-    for email_id in email_ids:
-      if email_id < data['latest_email']:
-        continue
+    if uids:
+      # Commands only need the headers, so nothing more is fetched, however many messages there are
+      response, fetched = self.imap_server.uid('FETCH', ','.join(map(str, uids)), self.HEADER_FIELDS)
+      if response != 'OK':
+        print('COULD NOT READ EMAILS {}'.format(uids))
+        return
 
-      res, dat = self.imap_server.fetch(str(email_id), '(RFC822)')
-      if res != 'OK':
-        print('COULD NOT READ EMAIL {}'.format(email_id))
-      else:
-        message = email.message_from_string(dat[0][1].decode('utf-8'))
-        self._handle_email(message)
+      # Each message comes as a (response up to the literal, literal) tuple followed by the rest of its response, and
+      # servers may put the UID on either side of the literal
+      responses = []
+      for item in fetched:
+        if isinstance(item, tuple):
+          responses.append([item[0], item[1]])
+        elif isinstance(item, bytes) and responses:
+          responses[-1][0] += item
 
-    if email_ids:
-      data['latest_email'] = email_ids[-1] + 1
+      messages = []
+      for response_text, headers in responses:
+        match = self.UID_PATTERN.search(response_text)
+        if match is None:
+          print("Skipping a fetched message without a UID: {}".format(response_text))
+          continue
 
-    with open(filepath, 'w') as file:
-      file.write(json.dumps(data))
+        messages.append((int(match.group(1)), email.message_from_bytes(headers)))
+
+      self._handle_emails([message for _, message in sorted(messages, key=lambda pair: pair[0])])
+      data['latest_uid'] = uids[-1] + 1
+
+    # Only written when it changes, and synced right away then so that a crash can't make messages be handled twice
+    self.state.set('email/{}'.format(self.clean_address), data, durable=bool(uids))
 
   def _send_email(self, subject, content, from_addr=None, to_addrs=None):
     if from_addr is None:
@@ -148,62 +282,79 @@ class EmailInterface(Interface):
 
     print("Content: ", content)
 
-    msg = Message()
-    msg.set_payload(content)
-    msg['Subject'] = subject
-    msg['From'] = from_addr
-    msg['To'] = ', '.join(to_addrs)
+    # Queued rather than sent here so that handling a command never waits on the SMTP server
+    self.outbox.send(subject, content, from_addr, to_addrs, account=self.smtp_account)
 
-    num_attempts = self.NUM_SEND_ATTEMPTS
-    while num_attempts:
-      num_attempts -= 1
-
-      try:
-        self.smtp_server.send_message(msg, from_addr=from_addr, to_addrs=to_addrs)
-        break
-      except Exception as e:
-        print("Error in send_message: {}".format(str(e)))
-
-        if num_attempts:
-          self._teardown_smtp()
-          self._setup_smtp()
-
-  def _ip_check_loop(self):
-    so = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    so.connect(('8.8.8.8', 80))
-
-    while 1:
-      ip_address = so.getsockname()
-
-      if ip_address != self.ip_address:
-        if self.ip_address is None:
-          self._send_email('Alarm started and ready', 'ip address: {}'.format(ip_address))
-
-        elif self.ip_address[0] != ip_address[0]:
-          self._send_email('Alarm IP changed', 'ip address: {}'.format(ip_address))
-
-        self.ip_address = ip_address
-
-      time.sleep(60 * 60)
-
-  def _setup_smtp(self):
-    self.smtp_server = smtplib.SMTP_SSL(self.info['smtp_server'], int(self.info['smtp_port']))
-    self.smtp_server.ehlo_or_helo_if_needed()
-    self.smtp_server.login(self.info['address'], self.info['password'])
+  def _ip_address_changed(self, ip_address, previous):
+    # Called by the connection manager's IP monitor
+    if previous is None:
+      self._send_email('Alarm started and ready', 'ip address: {}'.format(ip_address))
+    else:
+      self._send_email('Alarm IP changed', 'ip address: {}'.format(ip_address))
+
+  def _connect_smtp(self):
+    smtp_server = smtplib.SMTP_SSL(self.info['smtp_server'], int(self.info['smtp_port']), context=self.connections.context(), timeout=self.NETWORK_TIMEOUT)
+    smtp_server.ehlo_or_helo_if_needed()
+    smtp_server.login(self.info['address'], self.info['password'])
+    return smtp_server
+
+  def _supports_idle(self):
+    return self.info.get('imap_idle', True) and 'IDLE' in self.imap_server.capabilities
+
+  def _start_idle(self):
+    # imaplib has no IDLE support, so the connection's socket is read directly until the server reports new mail;
+    # the connection manager waits on the socket alongside every other mailbox's
+    tag = self.imap_server._new_tag()
+    del self.imap_server.tagged_commands[tag]  # the tagged response is consumed here rather than by imaplib
+    self.imap_server.send(tag + b' IDLE\r\n')
+
+    response = self.imap_server.readline()
+    if not response.startswith(b'+'):
+      raise imaplib.IMAP4.error('IDLE rejected: {}'.format(response))
+
+    # Select only says that something arrived, and with TLS that may be part of a record, so reads still time out
+    self.imap_server.socket().settimeout(self.NETWORK_TIMEOUT)
+    self.idle_tag = tag
+    self.idle_buffer = b''
+
+  def _read_idle_lines(self):
+    chunk = self.imap_server.socket().recv(4096)
+    if not chunk:
+      raise imaplib.IMAP4.abort('connection closed during IDLE')
+
+    self.idle_buffer += chunk
+    lines = self.idle_buffer.split(b'\r\n')
+    self.idle_buffer = lines.pop()
+    return lines
+
+  def _read_idle(self):
+    # Reads what the server sent while idling; returns whether new mail arrived
+    return any(line.startswith(b'* ') and line.endswith(b' EXISTS') for line in self._read_idle_lines())
+
+  def _stop_idle(self):
+    self.imap_server.send(b'DONE\r\n')
+
+    # Consume everything up to the tagged completion so that imaplib sees a clean stream again
+    completed = False
+    while not completed:
+      for line in self._read_idle_lines():
+        if line.startswith(self.idle_tag):
+          completed = True
+
+    self.idle_tag = None
+    self.idle_buffer = b''
 
   def _setup_imap(self):
-    self.imap_server = imaplib.IMAP4_SSL('imap.gmail.com')
-    self.imap_server.login(self.info['address'], self.info['password'])
-    self.imap_server.select('INBOX')
+    if self.info.get('imap_ssl', True):
+      imap_server = imaplib.IMAP4_SSL(self.info.get('imap_server', 'imap.gmail.com'), int(self.info.get('imap_port', imaplib.IMAP4_SSL_PORT)), ssl_context=self.connections.context(), timeout=self.NETWORK_TIMEOUT)
+    else:
+      imap_server = imaplib.IMAP4(self.info.get('imap_server', 'imap.gmail.com'), int(self.info.get('imap_port', imaplib.IMAP4_PORT)), timeout=self.NETWORK_TIMEOUT)
 
-  def _teardown_smtp(self):
-    try:
-      if self.smtp_server:
-        self.smtp_server.quit()
-    except Exception as e:
-      print("Error in smtp_server shutdown: {}".format(str(e)))
-    finally:
-      self.smtp_server = None
+    imap_server.login(self.info['address'], self.info['password'])
+    imap_server.select('INBOX')
+
+    # Only set once logged in, since checks may already be running while the interface starts up
+    self.imap_server = imap_server
 
   def _teardown_imap(self):
     try:
@@ -217,34 +368,9 @@ class EmailInterface(Interface):
   def startup(self):
     print("Email interface started.")
 
-    self._setup_smtp()
-    self._setup_imap()
-
-    self.ip_check_thread = Thread(target=self._ip_check_loop, daemon=True)
-    self.ip_check_thread.start()
-
-  def check(self):
-    # print("Email interface checked.")
-    if self.imap_server:
-      num_attempts = self.NUM_READ_ATTEMPTS
-      while num_attempts:
-        num_attempts -= 1
-
-        try:
-          self._read_email()
-          break
-        except Exception as e:
-          print("Error in interface check: {}".format(str(e)))
-          traceback.print_exc()
-
-          if num_attempts:
-            try:
-              self._teardown_imap()
-              self._setup_imap()
-            except Exception as e:
-              print("Error while trying to reboot imap server:", str(e))
+    # Connecting, and reconnecting after errors, happens on the connection manager's mailbox thread
+    self.connections.register(self)
 
   def shutdown(self):
     print("  Shutting down email interface.")
-    self._teardown_smtp()
-    self._teardown_imap()
+    self.connections.unregister(self)
@@ -1,34 +1,114 @@
 """Raspy Alarm
 
 Usage:
-  main.py [--shell]
+  main.py [--shell] [--web] [--host=<host>] [--port=<port>] [--asyncio]
+  main.py --agent [--shell] [--asyncio]
   main.py (-h | --help)
 
 Options:
-  -h --help  Show this help text
-  --shell    Start an IPython shell with access to scheduler, rouser, and interface instances
+  -h --help      Show this help text
+  --shell        Start an IPython shell with access to scheduler, rouser, and interface instances
+  --web          Serve the web app, including timing metrics at /metrics
+  --host=<host>  Address for the web app to listen on; 0.0.0.0 for every network [default: 127.0.0.1]
+  --port=<port>  Port for the web app [default: 5000]
+  --agent        Only run this Pi's rousers, driven by a scheduler on another Pi (see `agent` in the configuration)
+  --asyncio      Run the scheduler and rousers as tasks on one asyncio event loop instead of a thread each
 """
 
-from threading import Thread
-from docopt import docopt
-import IPython
-import signal
+import time
 
-from interface import EmailInterface
-from scheduler import Scheduler
-from rouser import Rouser
+STARTED = time.perf_counter()  # before the other imports, so that the startup report includes them
+
+from threading import Thread  # noqa
+from docopt import docopt  # noqa
+import traceback  # noqa
+import signal  # noqa
+import sys  # noqa
+import os  # noqa
+
+# Only what every mode needs is imported here; IPython, Flask, email handling, the remote protocol and asyncio are
+# imported when the option that uses them is given, since each costs a noticeable fraction of a second on a Pi Zero
+from state import open_store  # noqa
+from metrics import METRICS  # noqa
+from rouser import Rouser  # noqa
 
 try:
   from alarm_configuration import rouser_configs, emails, alarms
 except ImportError as e:
   raise ValueError("No configuration found in alarm_configuration.py; look at alarm_configuration.example for ideas.")
 
+try:
+  # {node name: {'host': ..., 'port': ..., 'token': ..., 'rousers': [rouser names]}} for rousers on other Pis
+  from alarm_configuration import remote_nodes
+except ImportError as e:
+  remote_nodes = {}
+
+try:
+  # {policy name: [stages]}, see escalation.py; policies are started like rousers, by name
+  from alarm_configuration import escalations
+except ImportError as e:
+  escalations = {}
+
+try:
+  # {'webhook': {'token': ...}, 'socket': {'path': ..., 'token': ...}} for commands without email, see triggers.py
+  from alarm_configuration import triggers as trigger_configs
+except ImportError as e:
+  trigger_configs = {}
+
+try:
+  # {'host': ..., 'port': ..., 'token': ...} for --agent
+  from alarm_configuration import agent as agent_config
+except ImportError as e:
+  agent_config = {}
+
 rousers = None
 scheduler = None
+nodes = None
+agent = None
+escalator = None
+state = None
+
+
+class StartupReport(object):
+  # Times each phase of startup, to show what stands between a power blip and the first alarm
+  def __init__(self, started):
+    self.started = started
+    self.last = started
+    self.phases = []
+
+  def mark(self, phase):
+    now = time.perf_counter()
+    self.phases.append((phase, now - self.last))
+    self.last = now
+
+  def report(self):
+    for phase, seconds in self.phases:
+      METRICS.observe('startup_seconds', seconds, phase=phase)
+
+    print("Started in {:.2f}s ({}).".format(self.last - self.started, ', '.join('{} {:.2f}s'.format(phase, seconds) for phase, seconds in self.phases)))
+
+
+def start_interfaces(interfaces):
+  # IMAP logins can take seconds, or fail outright while the network is still coming up after a power blip, so they
+  # happen after the scheduler is already running alarms
+  for interface in interfaces:
+    try:
+      interface.startup()
+    except Exception as e:
+      print("Error starting {}: {}".format(type(interface).__name__, str(e)))
+      traceback.print_exc()
 
 
 def shutdown(signum=None, frame=None):
-  global rousers, scheduler
+  global rousers, scheduler, nodes, agent, escalator, state
+
+  if escalator:
+    escalator.shutdown()
+    escalator = None
+
+  if agent:
+    agent.shutdown()
+    agent = None
 
   if rousers:
     for rouser in rousers:
@@ -43,36 +123,135 @@ def shutdown(signum=None, frame=None):
     scheduler.shutdown()
     scheduler = None
 
+  if nodes:
+    for node in nodes:
+      node.shutdown()
+
+    nodes = None
+
+  if state:
+    state.close()
+    state = None
+
 
 def run():
-  global rousers, scheduler
+  global rousers, scheduler, nodes, agent, escalator, state
   args = docopt(__doc__)
+  startup = StartupReport(STARTED)
+  startup.mark('imports')
+
+  # Mailbox progress, active alarms and recent firings, so that a restart picks up where it left off
+  state = open_store()
+  startup.mark('state')
 
   interfaces = []
-  for key, email_info in emails.items():
-    interface = EmailInterface(**email_info)
-    interface.startup()
-    interfaces.append(interface)
+  if emails and not args.get('--agent'):
+    from interface import EmailInterface
+
+    for key, email_info in emails.items():
+      interfaces.append(EmailInterface(state=state, **email_info))
+
+    startup.mark('interfaces')
+
+  webhook = None
+  if trigger_configs and not args.get('--agent'):
+    from triggers import WebhookInterface, SocketInterface
+
+    if 'webhook' in trigger_configs:
+      webhook = WebhookInterface(**trigger_configs['webhook'])
+      interfaces.append(webhook)
+
+      if not args.get('--web'):
+        print("The webhook interface is configured, but only served with --web.")
+
+    if 'socket' in trigger_configs:
+      interfaces.append(SocketInterface(**trigger_configs['socket']))
+
+    startup.mark('triggers')
 
   rousers = []
   for rouser_name, rouser_config in rouser_configs.items():
     rouser_config['name'] = rouser_name
     rouser_config['alarms'] = alarms.get(rouser_name, {})
 
-    rouser = Rouser(**rouser_config)
+    rouser = Rouser(state=state, **rouser_config)
     rousers.append(rouser)
 
-    rouser_thread = Thread(target=rouser.main_loop)
-    rouser_thread.start()
+    if not args.get('--asyncio'):
+      rouser_thread = Thread(target=rouser.main_loop)
+      rouser_thread.start()
+
+  startup.mark('rousers')
+
+  if args.get('--agent'):
+    from remote import RouserAgent
+
+    agent = RouserAgent(rousers, **agent_config)
+    agent.start()
+    startup.mark('agent')
+
+  else:
+    from scheduler import Scheduler
+
+    if remote_nodes:
+      from remote import RemoteNode, RemoteRouser
+
+    nodes = []
+    remote_rousers = []
+    for node_name, node_config in remote_nodes.items():
+      node = RemoteNode(node_name, node_config['host'], node_config['port'], node_config.get('token', None))
+      node.start()
+      nodes.append(node)
+
+      for rouser_name in node_config['rousers']:
+        remote_rousers.append(RemoteRouser(rouser_name, node))
+
+    policy_rousers = []
+    if escalations:
+      from escalation import Escalator
+
+      escalator = Escalator(rousers + remote_rousers, escalations, notifiers=[interface.notify for interface in interfaces if hasattr(interface, 'notify')])
+      policy_rousers = escalator.policy_rousers()
+
+    scheduler = Scheduler('schedule_rules.json', rousers=rousers + remote_rousers + policy_rousers, interfaces=interfaces, state=state)
+
+    if not args.get('--asyncio'):
+      scheduler_thread = Thread(target=scheduler.main_loop)
+      scheduler_thread.start()
+
+    startup.mark('scheduler')
+
+  if args.get('--asyncio'):
+    from runtime import AsyncRuntime
+
+    runtime_thread = Thread(target=AsyncRuntime(scheduler, rousers).run)
+    runtime_thread.start()
+    startup.mark('asyncio')
+
+  if interfaces:
+    Thread(target=start_interfaces, args=(interfaces,), daemon=True).start()
+
+  if args.get('--web'):
+    # The web app lives in the raspy_alarm package, which is importable from the parent directory
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from raspy_alarm import app
+
+    app.config['METRICS'] = METRICS
+    app.config['SCHEDULER'] = scheduler
+    app.config['WEBHOOK'] = webhook
+
+    # Never in debug mode, whatever settings.py says, since the Werkzeug debugger runs any code it is sent
+    web_thread = Thread(target=app.run, kwargs=dict(host=args['--host'], port=int(args['--port']), debug=False, use_reloader=False), daemon=True)
+    web_thread.start()
+    startup.mark('web')
 
-  scheduler = Scheduler('schedule_rules.json', rousers=rousers, interfaces=interfaces)
-  scheduler_thread = Thread(target=scheduler.main_loop)
-  scheduler_thread.start()
+  startup.report()
 
   signal.signal(signal.SIGINT, shutdown)
   signal.signal(signal.SIGTERM, shutdown)
 
   if args.get('--shell'):
+    import IPython
     IPython.embed()
     shutdown()
 
@@ -0,0 +1,131 @@
+from contextlib import contextmanager
+from threading import Lock
+
+import bisect
+import math
+import time
+
+
+class Histogram(object):
+  # Cumulative-bucket histogram in the style of Prometheus; bucket bounds are upper bounds in seconds
+  DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+  def __init__(self, buckets=None):
+    self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+    self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+    self.count = 0
+    self.sum = 0.0
+    self.max = -math.inf
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+    self.max = max(self.max, value)
+
+  def snapshot(self):
+    # The implicit +Inf bucket is left out since it always equals count
+    cumulative = []
+    total = 0
+    for bound, count in zip(self.buckets, self.counts):
+      total += count
+      cumulative.append((bound, total))
+
+    return dict(
+      count=self.count,
+      sum=self.sum,
+      mean=self.sum / self.count if self.count else None,
+      max=self.max if self.count else None,
+      buckets=cumulative,
+    )
+
+
+class Metrics(object):
+  # Thread-safe registry of counters and histograms, keyed by name and labels
+  def __init__(self):
+    self.lock = Lock()
+    self.counters = {}
+    self.histograms = {}
+    self.bucket_overrides = {}
+
+  def _key(self, name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+  def set_buckets(self, name, buckets):
+    self.bucket_overrides[name] = buckets
+
+  def increment(self, name, amount=1, **labels):
+    key = self._key(name, labels)
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + amount
+
+  def observe(self, name, value, **labels):
+    key = self._key(name, labels)
+    with self.lock:
+      if key not in self.histograms:
+        self.histograms[key] = Histogram(self.bucket_overrides.get(name, None))
+
+      self.histograms[key].observe(value)
+
+  @contextmanager
+  def timer(self, name, **labels):
+    # Observes the duration of the block in seconds, even if it raises
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, time.perf_counter() - start, **labels)
+
+  def reset(self):
+    with self.lock:
+      self.counters = {}
+      self.histograms = {}
+
+  def snapshot(self):
+    with self.lock:
+      return dict(
+        counters=[dict(name=name, labels=dict(labels), value=value) for (name, labels), value in sorted(self.counters.items())],
+        histograms=[dict(name=name, labels=dict(labels), **histogram.snapshot()) for (name, labels), histogram in sorted(self.histograms.items())],
+      )
+
+  def render_text(self):
+    # Prometheus text exposition format
+    def format_labels(labels, **extra):
+      items = list(labels) + list(extra.items())
+      if not items:
+        return ''
+
+      return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in items) + '}'
+
+    def format_value(value):
+      return '+Inf' if value == math.inf else repr(float(value))
+
+    lines = []
+    with self.lock:
+      typed = set()
+      for (name, labels), value in sorted(self.counters.items()):
+        if name not in typed:
+          lines.append('# TYPE {} counter'.format(name))
+          typed.add(name)
+
+        lines.append('{}{} {}'.format(name, format_labels(labels), value))
+
+      for (name, labels), histogram in sorted(self.histograms.items()):
+        if name not in typed:
+          lines.append('# TYPE {} histogram'.format(name))
+          typed.add(name)
+
+        for bound, count in histogram.snapshot()['buckets'] + [(math.inf, histogram.count)]:
+          lines.append('{}_bucket{} {}'.format(name, format_labels(labels, le=format_value(bound)), count))
+
+        lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(histogram.sum)))
+        lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram.count))
+
+    return '\n'.join(lines) + '\n'
+
+
+# Shared by the scheduler, rousers and interfaces, and served by the web app at /metrics
+METRICS = Metrics()
+
+# How late alarms fire is measured from the scheduled time, so it gets finer buckets around zero
+METRICS.set_buckets('alarm_lateness_seconds', (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 300))
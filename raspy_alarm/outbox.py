@@ -0,0 +1,156 @@
+from email.message import Message
+from threading import Condition, Thread
+
+import traceback
+import time
+
+from metrics import METRICS
+
+
+class Outbox(object):
+  # Sends mail from a background thread over reused SMTP connections so that callers never wait on the network.
+  # One outbox can serve several accounts, each with its own connection, so a process needs only one sending thread.
+  # Messages queued close together for the same account, sender, recipients and subject are merged into a single email.
+  MAX_ATTEMPTS = 5
+  RETRY_DELAY = 2  # doubled after every failed attempt
+  MAX_RETRY_DELAY = 5 * 60
+  COALESCE_DELAY = 0.5
+  HEALTH_CHECK_INTERVAL = 60  # an idle connection is checked with NOOP before being reused
+
+  def __init__(self, connect=None, name=None):
+    self.name = name
+    self.connectors = {}  # account -> callable returning a logged-in SMTP connection
+    self.connections = {}  # account -> [connection, last used]
+
+    self.pending = []  # dicts with key, account, contents, attempts and next_attempt
+    self.condition = Condition()
+    self.thread = None
+    self.running = False
+
+    if connect is not None:
+      self.add_account(None, connect)
+
+  def start(self):
+    self.running = True
+    self.thread = Thread(target=self._send_loop, daemon=True)
+    self.thread.start()
+
+  def add_account(self, account, connect):
+    # Accounts are identified by any hashable key; the first connector given for an account is kept
+    with self.condition:
+      self.connectors.setdefault(account, connect)
+
+  def send(self, subject, content, from_addr, to_addrs, account=None):
+    key = (from_addr, tuple(sorted(set(to_addrs))), subject)
+
+    with self.condition:
+      for item in self.pending:
+        if item['key'] == key and item['account'] == account and item['attempts'] == 0:
+          if content not in item['contents']:
+            item['contents'].append(content)
+          break
+      else:
+        self.pending.append(dict(
+          key=key,
+          account=account,
+          contents=[content],
+          attempts=0,
+          next_attempt=time.time() + self.COALESCE_DELAY,
+        ))
+
+      self.condition.notify()
+
+  def _get_connection(self, account):
+    entry = self.connections.get(account, None)
+    if entry is not None and time.time() - entry[1] > self.HEALTH_CHECK_INTERVAL:
+      try:
+        code, _ = entry[0].noop()
+        if code != 250:
+          raise ValueError("NOOP returned {}".format(code))
+      except Exception as e:
+        print("SMTP connection for {} failed health check: {}".format(account or self.name, str(e)))
+        self._close_connection(account)
+        entry = None
+
+    if entry is None:
+      entry = self.connections[account] = [self.connectors[account](), time.time()]
+
+    return entry
+
+  def _close_connection(self, account):
+    entry = self.connections.pop(account, None)
+
+    try:
+      if entry:
+        entry[0].quit()
+    except Exception as e:
+      print("Error in smtp_server shutdown: {}".format(str(e)))
+
+  def _deliver(self, item):
+    from_addr, to_addrs, subject = item['key']
+
+    msg = Message()
+    msg.set_payload('\n\n'.join(item['contents']))
+    msg['Subject'] = subject
+    msg['From'] = from_addr
+    msg['To'] = ', '.join(to_addrs)
+
+    entry = self._get_connection(item['account'])
+    entry[0].send_message(msg, from_addr=from_addr, to_addrs=list(to_addrs))
+    entry[1] = time.time()
+
+  def _send_loop(self):
+    while True:
+      with self.condition:
+        while True:
+          if not self.pending and not self.running:
+            return
+
+          now = time.time()
+          due = [item for item in self.pending if item['next_attempt'] <= now or not self.running]
+          if due:
+            break
+
+          timeout = min(item['next_attempt'] for item in self.pending) - now if self.pending else None
+          self.condition.wait(timeout)
+
+        for item in due:
+          self.pending.remove(item)
+
+      for item in due:
+        try:
+          with METRICS.timer('smtp_send_seconds'):
+            self._deliver(item)
+          METRICS.increment('emails_sent_total')
+        except Exception as e:
+          print("Error in send_message: {}".format(str(e)))
+          METRICS.increment('smtp_errors_total')
+          traceback.print_exc()
+          self._close_connection(item['account'])
+
+          item['attempts'] += 1
+          if item['attempts'] >= self.MAX_ATTEMPTS or not self.running:
+            print("Giving up on email {} to {}".format(item['key'][2], ', '.join(item['key'][1])))
+            METRICS.increment('emails_dropped_total')
+            continue
+
+          with self.condition:
+            item['next_attempt'] = time.time() + min(self.RETRY_DELAY * 2 ** (item['attempts'] - 1), self.MAX_RETRY_DELAY)
+            self.pending.append(item)
+
+  def shutdown(self, timeout=10):
+    # Gives queued mail one last chance to go out before closing the connection
+    with self.condition:
+      self.running = False
+      self.condition.notify()
+
+    if self.thread:
+      self.thread.join(timeout)
+      if self.thread.is_alive():
+        print("Outbox for {} did not finish sending before shutdown.".format(self.name))
+        return
+
+      self.thread = None
+
+    for account in list(self.connections):
+      self._close_connection(account)
@@ -0,0 +1,254 @@
+from threading import Condition, Thread, Lock
+
+import itertools
+import bisect
+import heapq
+import json
+
+from metrics import METRICS
+
+
+# Output patterns are plain dicts, like condition specs, so that they can be written in the schedule JSON or the
+# alarm configuration:
+#
+#   {"type": "on"}                                               on the whole time
+#   {"type": "beep", "on": 0.5, "off": 0.5}                      a square wave
+#   {"type": "burst", "count": 3, "on": 0.1, "off": 0.1, "pause": 1}
+#                                                                `count` short pulses, then a pause
+#   {"type": "ramp", "from": 0.1, "to": 1, "steps": 10, "period": 1}
+#                                                                `steps` periods whose duty cycle rises from `from` to
+#                                                                `to`; a short period makes it software PWM
+#   {"type": "morse", "text": "SOS", "unit": 0.15, "pause": 7}   Morse code, by default for the alarm's name, with a
+#                                                                pause of `pause` units before it repeats
+#
+# A list of patterns plays them in order; each may set "repeat" to play more than once, and the last one repeats for
+# as long as the alarm lasts, so e.g. [{"type": "ramp", ...}, {"type": "on"}] escalates and then stays on. A single
+# pattern just repeats.
+#
+# Patterns are compiled into timing tables once per spec, and a single PatternPlayer thread per backend drives every
+# output from them, instead of gpiozero's thread per beeping output.
+
+
+MORSE = {
+  'A': '.-', 'B': '-...', 'C': '-.-.', 'D': '-..', 'E': '.', 'F': '..-.', 'G': '--.', 'H': '....', 'I': '..',
+  'J': '.---', 'K': '-.-', 'L': '.-..', 'M': '--', 'N': '-.', 'O': '---', 'P': '.--.', 'Q': '--.-', 'R': '.-.',
+  'S': '...', 'T': '-', 'U': '..-', 'V': '...-', 'W': '.--', 'X': '-..-', 'Y': '-.--', 'Z': '--..',
+  '0': '-----', '1': '.----', '2': '..---', '3': '...--', '4': '....-', '5': '.....', '6': '-....', '7': '--...',
+  '8': '---..', '9': '----.',
+}
+
+
+def _beep_segments(spec, name):
+  return [(float(spec.get('on', 0.5)), True), (float(spec.get('off', 0.5)), False)]
+
+
+def _burst_segments(spec, name):
+  segments = []
+  for _ in range(int(spec.get('count', 3))):
+    segments += [(float(spec.get('on', 0.1)), True), (float(spec.get('off', 0.1)), False)]
+
+  return segments + [(float(spec.get('pause', 1)), False)]
+
+
+def _ramp_segments(spec, name):
+  start = float(spec.get('from', 0.1))
+  end = float(spec.get('to', 1))
+  steps = int(spec.get('steps', 10))
+  period = float(spec.get('period', 1))
+
+  segments = []
+  for step in range(steps):
+    duty = start + (end - start) * step / max(steps - 1, 1)
+    duty = min(max(duty, 0), 1)
+    segments += [(period * duty, True), (period * (1 - duty), False)]
+
+  return segments
+
+
+def _morse_segments(spec, name):
+  unit = float(spec.get('unit', 0.15))
+  text = str(spec.get('text', name or 'SOS')).upper()
+
+  segments = []
+  for word in text.split():
+    for letter in word:
+      for symbol in MORSE.get(letter, ''):
+        segments += [(unit * (1 if symbol == '.' else 3), True), (unit, False)]
+
+      segments.append((unit * 2, False))  # 3 units between letters
+
+    segments.append((unit * 4, False))  # 7 units between words
+
+  return segments + [(unit * float(spec.get('pause', 7)), False)]
+
+
+def _on_segments(spec, name):
+  return [(1, True)]
+
+
+SEGMENTS = {
+  'on': _on_segments,
+  'beep': _beep_segments,
+  'burst': _burst_segments,
+  'ramp': _ramp_segments,
+  'morse': _morse_segments,
+}
+
+
+class Waveform(object):
+  # A timing table: an intro played once, then a loop repeated forever. Both are kept as the end offsets of their
+  # segments, so the state at any time is a binary search away and a late wakeup skips straight to the right segment
+  # instead of drifting.
+  def __init__(self, intro, loop):
+    self.intro_ends, self.intro_states = self._table(intro)
+    self.loop_ends, self.loop_states = self._table(loop)
+
+    self.intro_length = self.intro_ends[-1] if self.intro_ends else 0
+    self.loop_length = self.loop_ends[-1] if self.loop_ends else 0
+    self.constant = len(self.loop_states) <= 1
+
+  def _table(self, segments):
+    ends = []
+    states = []
+    total = 0
+
+    for duration, active in segments:
+      if duration <= 0:
+        continue
+
+      total += duration
+      if states and states[-1] == active:
+        ends[-1] = total  # merge with the previous segment
+      else:
+        ends.append(total)
+        states.append(active)
+
+    return ends, states
+
+  def at(self, elapsed):
+    # The output state `elapsed` seconds into the pattern and the elapsed time of its next change, if any
+    if elapsed < self.intro_length:
+      index = bisect.bisect_right(self.intro_ends, elapsed)
+      return self.intro_states[index], self.intro_ends[index]
+
+    if not self.loop_states:
+      return False, None
+
+    if self.constant:
+      return self.loop_states[0], None
+
+    offset = (elapsed - self.intro_length) % self.loop_length
+    index = bisect.bisect_right(self.loop_ends, offset)
+    return self.loop_states[index], elapsed - offset + self.loop_ends[index]
+
+
+def _sequence_segments(specs, name):
+  # (intro, loop) segments for a list of patterns; the last one loops
+  intro = []
+  for spec in specs[:-1]:
+    intro += SEGMENTS[spec['type']](spec, name) * int(spec.get('repeat', 1))
+
+  last = specs[-1]
+  return intro, SEGMENTS[last['type']](last, name)
+
+
+COMPILED = {}
+COMPILED_LOCK = Lock()
+
+
+def compile_pattern(spec, name=None):
+  # Timing tables are cached by spec (and alarm name, which Morse patterns may spell out)
+  key = (json.dumps(spec, sort_keys=True), name)
+
+  with COMPILED_LOCK:
+    if key in COMPILED:
+      return COMPILED[key]
+
+  try:
+    intro, loop = _sequence_segments(spec if isinstance(spec, list) else [spec], name)
+    waveform = Waveform(intro, loop)
+  except Exception as e:
+    # A bad pattern must not keep the alarm from going off, so it falls back on being on the whole time
+    print("Error compiling pattern {}: {}".format(spec, str(e)))
+    waveform = Waveform([], [(1, True)])
+
+  with COMPILED_LOCK:
+    COMPILED[key] = waveform
+
+  return waveform
+
+
+class PatternPlayer(object):
+  # Drives every playing output from one thread, sleeping until the earliest pending change. Changes are timed from
+  # the pattern's start on the backend's monotonic clock, so wakeup latency doesn't accumulate, and how late each one
+  # happened is recorded in pattern_jitter_seconds.
+  def __init__(self, backend):
+    self.backend = backend
+    self.condition = Condition()
+    self.playing = {}  # id(output) -> (output, waveform, start time, generation)
+    self.queue = []  # (due time, generation, id(output))
+    self.generations = itertools.count()
+    self.thread = None
+
+  def play(self, output, waveform):
+    # Replaces whatever the output was playing
+    with self.condition:
+      start = self.backend.monotonic()
+      generation = next(self.generations)
+      self.playing[id(output)] = (output, waveform, start, generation)
+      self._apply(id(output), start, start)
+
+      if self.thread is None:
+        self.thread = Thread(target=self._run, daemon=True, name='patterns')
+        self.thread.start()
+
+      self.condition.notify()
+
+  def stop(self, output):
+    # Stops changing the output and leaves it as it is; callers turn it on or off themselves
+    with self.condition:
+      self.playing.pop(id(output), None)
+
+  def _apply(self, key, now, due):
+    # Sets the output to its current state and queues its next change; called with the condition held
+    output, waveform, start, generation = self.playing[key]
+    active, next_change = waveform.at(now - start)
+
+    if active:
+      output.on()
+    else:
+      output.off()
+
+    if now > due:
+      METRICS.observe('pattern_jitter_seconds', now - due)
+
+    if next_change is None:
+      del self.playing[key]
+    else:
+      heapq.heappush(self.queue, (start + next_change, generation, key))
+
+  def _run(self):
+    with self.condition:
+      while True:
+        now = self.backend.monotonic()
+
+        while self.queue and self.queue[0][0] <= now:
+          due, generation, key = heapq.heappop(self.queue)
+          if key in self.playing and self.playing[key][3] == generation:
+            self._apply(key, now, due)
+
+        timeout = self.queue[0][0] - now if self.queue else None
+        self.backend.wait(self.condition, timeout)
+
+
+PLAYERS = {}
+PLAYERS_LOCK = Lock()
+
+
+def get_player(backend):
+  # One player per backend, shared by every rouser using it
+  with PLAYERS_LOCK:
+    if id(backend) not in PLAYERS:
+      PLAYERS[id(backend)] = PatternPlayer(backend)
+
+    return PLAYERS[id(backend)]
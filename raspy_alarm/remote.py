@@ -0,0 +1,307 @@
+from threading import Condition, Thread
+from dateutil import tz
+
+import socketserver
+import traceback
+import ipaddress
+import hmac
+import socket
+import json
+import time
+
+from metrics import METRICS
+
+
+# Remote rousers: a scheduler on one Pi drives rousers attached to others.
+#
+# The protocol is newline-delimited JSON over TCP. The scheduler's RemoteNode sends a batch of calls
+#
+#   {"id": 7, "token": "...", "calls": [{"rouser": "bedroom", "method": "start_alarm", "params": {...}}, ...]}
+#
+# and the node's RouserAgent runs them in order on its local rousers and acknowledges the batch with
+#
+#   {"id": 7, "results": [{"ok": true}, {"ok": false, "error": "..."}, ...]}
+
+
+METHODS = ('start_alarm', 'stop_alarm', 'signal')
+
+
+def encode_timezone(timezone):
+  # Zones are sent by name. The scheduler passes the name from the schedule file; of zone objects, only UTC and
+  # zoneinfo zones say which zone they are
+  if timezone is None or isinstance(timezone, str):
+    return timezone
+
+  if isinstance(timezone, tz.tzutc):
+    return 'UTC'
+
+  return getattr(timezone, 'key', None)
+
+
+class RemoteNode(object):
+  # Connection to the RouserAgent on another Pi. Calls are queued and sent from a background thread, so the
+  # scheduler never waits on the network; calls made within BATCH_DELAY of each other go out as one message.
+  BATCH_DELAY = 0.005
+  CONNECT_TIMEOUT = 5
+  ACK_TIMEOUT = 5
+  RETRY_DELAY = 1  # doubled after every failed attempt
+  MAX_RETRY_DELAY = 30
+  MAX_CALL_AGE = 60 * 60  # like Scheduler.MAX_LATENESS; older calls are dropped instead of ringing an alarm long after
+
+  def __init__(self, name, host, port, token=None):
+    self.name = name
+    self.host = host
+    self.port = int(port)
+    self.token = token
+
+    self.connection = None
+    self.reader = None
+    self.batch_id = 0
+
+    self.pending = []  # (queued time, call) tuples
+    self.condition = Condition()
+    self.thread = None
+    self.running = False
+
+  def start(self):
+    self.running = True
+    self.thread = Thread(target=self._send_loop, daemon=True)
+    self.thread.start()
+
+  def call(self, rouser_name, method, **params):
+    try:
+      json.dumps(params)
+    except TypeError as e:
+      # e.g. callable conditions, which only work for local rousers
+      print("Cannot send {} to {}/{}: {}".format(method, self.name, rouser_name, str(e)))
+      return
+
+    with self.condition:
+      self.pending.append((time.time(), dict(rouser=rouser_name, method=method, params=params)))
+      self.condition.notify()
+
+  def _connect(self):
+    self.connection = socket.create_connection((self.host, self.port), timeout=self.CONNECT_TIMEOUT)
+    self.connection.settimeout(self.ACK_TIMEOUT)
+    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.reader = self.connection.makefile('rb')
+
+  def _disconnect(self):
+    try:
+      if self.connection:
+        self.reader.close()
+        self.connection.close()
+    except Exception as e:
+      print("Error closing connection to {}: {}".format(self.name, str(e)))
+    finally:
+      self.connection = None
+      self.reader = None
+
+  def _send_batch(self, batch):
+    if self.connection is None:
+      self._connect()
+
+    self.batch_id += 1
+    message = dict(id=self.batch_id, token=self.token, calls=[call for _, call in batch])
+
+    sent = time.time()
+    self.connection.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+    while True:
+      line = self.reader.readline()
+      if not line:
+        raise ConnectionError("connection closed by {}".format(self.name))
+
+      response = json.loads(line.decode('utf-8'))
+      if response.get('id') == self.batch_id:
+        break
+
+    acked = time.time()
+    METRICS.observe('remote_ack_seconds', acked - sent, node=self.name)
+    for queued, call in batch:
+      METRICS.observe('remote_dispatch_seconds', acked - queued, node=self.name)
+
+    if 'error' in response:
+      print("Node {} rejected calls: {}".format(self.name, response['error']))
+
+    for (_, call), result in zip(batch, response.get('results', [])):
+      if not result.get('ok'):
+        print("Error in {} on {}/{}: {}".format(call['method'], self.name, call['rouser'], result.get('error')))
+
+  def _drop_expired(self, calls):
+    oldest = time.time() - self.MAX_CALL_AGE
+    expired = [call for queued, call in calls if queued < oldest]
+
+    for call in expired:
+      print("Dropping {} for {}/{}; it could not be delivered in time.".format(call['method'], self.name, call['rouser']))
+      METRICS.increment('remote_calls_dropped_total', node=self.name)
+
+    return [(queued, call) for queued, call in calls if queued >= oldest]
+
+  def _wait_until(self, deadline):
+    # Waits out the full delay even if new calls arrive in the meantime; only shutdown cuts it short
+    while self.running:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+
+      self.condition.wait(remaining)
+
+  def _send_loop(self):
+    attempts = 0
+
+    while True:
+      with self.condition:
+        while not self.pending and self.running:
+          self.condition.wait()
+
+        if not self.pending:
+          break
+
+        # Give simultaneous calls, e.g. every rouser of an alarm starting at once, a moment to join the batch
+        if not attempts:
+          self._wait_until(time.time() + self.BATCH_DELAY)
+
+        batch = self._drop_expired(self.pending)
+        self.pending = []
+
+      if not batch:
+        attempts = 0
+        continue
+
+      try:
+        self._send_batch(batch)
+        attempts = 0
+      except Exception as e:
+        print("Error sending to node {}: {}".format(self.name, str(e)))
+        METRICS.increment('remote_errors_total', node=self.name)
+        self._disconnect()
+
+        attempts += 1
+        with self.condition:
+          self.pending = batch + self.pending  # rousers ignore a repeated start of the same alarm, so retrying is safe
+          if not self.running:
+            break
+
+          self._wait_until(time.time() + min(self.RETRY_DELAY * 2 ** (attempts - 1), self.MAX_RETRY_DELAY))
+
+    self._disconnect()
+
+  def shutdown(self, timeout=5):
+    with self.condition:
+      self.running = False
+      self.condition.notify()
+
+    if self.thread:
+      self.thread.join(timeout)
+      self.thread = None
+
+
+class RemoteRouser(object):
+  # Stands in for a Rouser in Scheduler.rousers and forwards calls to the node it runs on
+  def __init__(self, name, node):
+    self.name = name
+    self.node = node
+
+  def start_alarm(self, name, timezone=None, **params):
+    self.node.call(self.name, 'start_alarm', name=name, timezone=encode_timezone(timezone), **params)
+
+  def stop_alarm(self, reason='canceled'):
+    self.node.call(self.name, 'stop_alarm', reason=reason)
+
+  def signal(self, name):
+    self.node.call(self.name, 'signal', name=name)
+
+  def shutdown(self):
+    pass  # the rouser itself keeps running on its node
+
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+  def setup(self):
+    super().setup()
+    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+  def handle(self):
+    for line in self.rfile:
+      try:
+        message = json.loads(line.decode('utf-8'))
+      except Exception as e:
+        print("Error decoding remote call: {}".format(str(e)))
+        continue
+
+      response = self.server.agent.handle(message)
+      self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+      self.wfile.flush()
+
+
+class _AgentServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+
+
+def is_loopback(host):
+  if host == 'localhost':
+    return True
+
+  try:
+    return ipaddress.ip_address(host).is_loopback
+  except ValueError as e:
+    return False
+
+
+class RouserAgent(object):
+  # Serves this Pi's rousers to a scheduler running elsewhere. Anyone who can reach it could ring or stop the alarm,
+  # so it needs a token unless it only listens on the loopback interface.
+  def __init__(self, rousers, host='0.0.0.0', port=8765, token=None):
+    self.rousers = {rouser.name: rouser for rouser in rousers}
+    self.host = host
+    self.port = int(port)
+    self.token = token
+
+    if not token and not is_loopback(host):
+      raise ValueError("The rouser agent needs a token to listen on {}.".format(host))
+
+    self.server = None
+    self.thread = None
+
+  def handle(self, message):
+    if self.token is not None and not hmac.compare_digest(str(message.get('token')).encode('utf-8'), str(self.token).encode('utf-8')):
+      return dict(id=message.get('id'), error='bad token')
+
+    results = []
+    for call in message.get('calls', []):
+      results.append(self._run(call))
+
+    return dict(id=message.get('id'), results=results)
+
+  def _run(self, call):
+    if call.get('rouser') not in self.rousers:
+      return dict(ok=False, error="unknown rouser {}".format(call.get('rouser')))
+
+    if call.get('method') not in METHODS:
+      return dict(ok=False, error="unknown method {}".format(call.get('method')))
+
+    try:
+      rouser = self.rousers[call['rouser']]
+
+      params = dict(call.get('params', {}))
+      getattr(rouser, call['method'])(**params)
+      return dict(ok=True)
+
+    except Exception as e:
+      traceback.print_exc()
+      return dict(ok=False, error=str(e))
+
+  def start(self):
+    self.server = _AgentServer((self.host, self.port), _AgentHandler)
+    self.server.agent = self
+
+    self.thread = Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+    print("Rouser agent listening on {}:{}...".format(self.host, self.port))
+
+  def shutdown(self):
+    if self.server:
+      self.server.shutdown()
+      self.server.server_close()
+      self.server = None
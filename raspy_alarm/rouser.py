@@ -1,21 +1,37 @@
-import time
+from threading import Condition
+from dateutil import tz
+
 import datetime
-import gpiozero
+import json
+
+from backends import GpioBackend
+from conditions import CompiledConditions
+from patterns import compile_pattern, get_player
+from events import EventBuffer
+from metrics import METRICS
 
 
 class Rouser(object):
   OUTPUTS = {}
   INPUTS = {}
+  INSTANCES = []
+  CONDITION = Condition()  # shared because input pins, and so their callbacks, are shared between rousers
+  TIME_CONDITION_INTERVAL = 1  # plain callable conditions may depend on how long ago something happened
+  BACKEND = GpioBackend()
+  WAKERS = []  # called along with every notification of CONDITION, e.g. to wake asyncio tasks
 
-  def __init__(self, name, output_pins, input_pins, alarms=None, invert_on_off=False, **additional_params):
+  def __init__(self, name, output_pins, input_pins, alarms=None, invert_on_off=False, backend=None, state=None, **additional_params):
     self.name = name
+    self.backend = backend or self.BACKEND
+    self.state = state  # a StateStore to keep the active alarm in across restarts, if any
+    self.listeners = []  # called with (rouser, alarm name, reason) when an alarm stops, e.g. by escalations
 
     # Initialize the output interface if needed
     self.output_pins = output_pins
     self.invert_on_off = invert_on_off
 
     if output_pins[0] not in self.OUTPUTS:
-      output = gpiozero.Buzzer(output_pins[0])
+      output = self.backend.make_output(output_pins[0])
       if self.invert_on_off:
         output.on, output.off = output.off, output.on  # e.g. a particular shaker vibrates when it's "off"
       output.off()
@@ -23,6 +39,7 @@ class Rouser(object):
       self.OUTPUTS[output_pins[0]] = output
 
     self.output = self.OUTPUTS[output_pins[0]]
+    self.player = get_player(self.backend)  # drives output patterns for every rouser on this backend
 
     # Initialize the input interfaces if needed
     self.input_pins = input_pins
@@ -30,7 +47,7 @@ class Rouser(object):
 
     for pin in input_pins:
       if pin not in self.INPUTS:
-        button = gpiozero.Button(pin)
+        button = self.backend.make_input(pin)
 
         if pin in self.toggle_pins:
           button.when_pressed = lambda b: (self._record_button_press(b), self._toggle_when_alarm_off(b))
@@ -39,12 +56,17 @@ class Rouser(object):
 
         button.when_released = lambda b: self._record_button_release(b)
 
-        self.INPUTS[pin] = {'button': button, 'events': []}
+        self.INPUTS[pin] = {'button': button, 'events': EventBuffer(additional_params.get('event_capacity', None))}
 
     self.alarms = alarms or {}
     self.alarm = {}
     self._reset_alarm()
 
+    self.start_conditions = {}
+    for name, params in self.alarms.items():
+      if params.get('start_conditions', None):
+        self.start_conditions[name] = CompiledConditions(params['start_conditions'], self.input_pins)
+
     self.default_beep_on_length = additional_params.get('default_beep_on_length', 0.5)
     self.default_beep_off_length = additional_params.get('default_beep_off_length', 0.5)
     self.default_snooze_duration = additional_params.get('default_snooze_duration', 600)
@@ -52,6 +74,9 @@ class Rouser(object):
     self.default_snooze_state = additional_params.get('default_snooze_state', 'off')
 
     self.running = True
+    self.INSTANCES.append(self)
+
+    self._restore_alarm()
 
   def _toggle_when_alarm_off(self, b):
     if self.alarm['onset_time'] is None:
@@ -61,20 +86,62 @@ class Rouser(object):
         self.output.off()
 
   def _record_button_press(self, b):
-    self.INPUTS[b.pin.number]['events'].append([time.time()])
+    with self.CONDITION:
+      timestamp = self.backend.time()
+      self.INPUTS[b.pin.number]['events'].press(timestamp)
+
+      for rouser in self.INSTANCES:
+        for conditions in rouser._active_conditions():
+          conditions.on_press(b.pin.number, timestamp)
+
+      self._notify_all()
 
   def _record_button_release(self, b):
-    self.INPUTS[b.pin.number]['events'][-1].append(time.time())
+    with self.CONDITION:
+      timestamp = self.backend.time()
+      self.INPUTS[b.pin.number]['events'].release(timestamp)
+
+      for rouser in self.INSTANCES:
+        for conditions in rouser._active_conditions():
+          conditions.on_release(b.pin.number, timestamp)
+
+      self._notify_all()
+
+  def signal(self, name):
+    # Reports an external event, e.g. an email having arrived, to "signal" conditions
+    with self.CONDITION:
+      timestamp = self.backend.time()
+
+      for conditions in self._active_conditions():
+        conditions.on_signal(name, timestamp)
+
+      self._notify_all()
+
+  def _notify_all(self):
+    self.CONDITION.notify_all()
+
+    for waker in self.WAKERS:
+      waker()
+
+  def _active_conditions(self):
+    active = list(self.start_conditions.values())
+
+    for key in ('conditions_to_stop_alarm', 'conditions_to_snooze_alarm'):
+      if self.alarm[key]:
+        active.append(self.alarm[key])
+
+    return active
 
   def _reset_alarm(self):
     self.old_alarm = self.alarm.copy()
     self.alarm = {
       'name': None,  # string
-      'conditions_to_start_alarm': None,  # callables that take the current time and a list of button presses as arguments
+      'conditions_to_start_alarm': None,  # lists of lists of condition specs or callables; see conditions.py
       'conditions_to_stop_alarm': None,
       'conditions_to_snooze_alarm': None,
       'beep_off_length': None,
       'beep_on_length': None,
+      'pattern': None,  # pattern spec, see patterns.py; a plain beep of beep_on_length and beep_off_length if unset
       'onset_time': None,
       'snooze_time': None,
       'snooze_duration': None,
@@ -82,118 +149,248 @@ class Rouser(object):
       'timezone': None,
     }
 
-  def _evaluate_conditions(self, conditions):
-    current_time = time.time()
+  @property
+  def state_key(self):
+    return 'rouser/{}/alarm'.format(self.name)
 
-    for or_cond in conditions:
-      for and_cond in or_cond:
-        try:
-          if not and_cond(current_time, self.input_pins, self.INPUTS):
-            break
-        except Exception as e:
-          print("Error evaluating condition:", str(e))
-          break
+  def _condition_spec(self, conditions):
+    # Callable conditions can't be saved; a restored alarm falls back on its named alarm's conditions instead
+    spec = conditions.spec if isinstance(conditions, CompiledConditions) else conditions
 
-      else:
-        break
+    try:
+      json.dumps(spec)
+      return spec
+    except TypeError as e:
+      return None
 
-    else:
-      return False
+  def _save_alarm(self):
+    if self.state is None:
+      return
 
-    return True
+    if not (self.alarm['onset_time'] or self.alarm['snooze_time']):
+      self.state.delete(self.state_key, durable=True, background=True)
+      return
 
-  def main_loop(self):
-    print("Rouser \"{}\" main loop running...".format(self.name))
+    self.state.set(self.state_key, dict(
+      name=self.alarm['name'],
+      start_conditions=self._condition_spec(self.alarm['conditions_to_start_alarm']),
+      stop_conditions=self._condition_spec(self.alarm['conditions_to_stop_alarm']),
+      snooze_conditions=self._condition_spec(self.alarm['conditions_to_snooze_alarm']),
+      beep_off_length=self.alarm['beep_off_length'],
+      beep_on_length=self.alarm['beep_on_length'],
+      pattern=self.alarm['pattern'],
+      snooze_duration=self.alarm['snooze_duration'],
+      snooze_state=self.alarm['snooze_state'],
+      onset_time=self.alarm['onset_time'],
+      snooze_time=self.alarm['snooze_time'],
+    ), durable=True, background=True)  # called with CONDITION held
+
+  def _restore_alarm(self):
+    # Restarts an alarm that was still going when the program stopped, e.g. because the Pi crashed or rebooted
+    saved = self.state.get(self.state_key, None) if self.state is not None else None
+    if not saved:
+      return
 
-    while self.running:
-      # print("Ping - rouser")
-      time.sleep(1)
+    if saved['onset_time'] and saved['onset_time'] + self.max_active_duration <= self.backend.time():
+      self.state.delete(self.state_key)
+      return
 
-      for name, params in self.alarms.items():
-        if params.get('start_conditions', None):
-          if self._evaluate_conditions(params['start_conditions']):
-            self.start_alarm(name)
+    print("Restoring alarm {} on \"{}\" after a restart.".format(saved['name'], self.name))
+
+    with self.CONDITION:
+      self.start_alarm(
+        saved['name'],
+        start_conditions=saved['start_conditions'],
+        stop_conditions=saved['stop_conditions'],
+        snooze_conditions=saved['snooze_conditions'],
+        beep_off_length=saved['beep_off_length'],
+        beep_on_length=saved['beep_on_length'],
+        pattern=saved.get('pattern', None),
+        snooze_duration=saved['snooze_duration'],
+        snooze_state=saved['snooze_state'],
+      )
+
+      if saved['snooze_time']:
+        self.snooze_alarm()
+        self.alarm['snooze_time'] = saved['snooze_time']
+      else:
+        self.alarm['onset_time'] = saved['onset_time']
 
-      if self.alarm['snooze_time']:
-        if self.alarm['snooze_time'] + self.alarm['snooze_duration'] < time.time():
-          self.resume_alarm()
+      self._save_alarm()
 
-      if self.alarm['onset_time'] and self.alarm['conditions_to_snooze_alarm']:
-        if self._evaluate_conditions(self.alarm['conditions_to_snooze_alarm']):
-          self.snooze_alarm()
+  def _evaluate_conditions(self, conditions):
+    with METRICS.timer('condition_evaluation_seconds', rouser=self.name):
+      return conditions.evaluate(self.backend.time(), self.input_pins, self.INPUTS)
 
-      if self.alarm['conditions_to_stop_alarm']:
-        if self._evaluate_conditions(self.alarm['conditions_to_stop_alarm']):
-          self.stop_alarm()
+  def _next_wakeup(self, current_time):
+    deadlines = []
 
-      if self.alarm['onset_time'] and self.alarm['onset_time'] + self.max_active_duration < time.time():
-        self.stop_alarm()
+    if self.alarm['snooze_time']:
+      deadlines.append(self.alarm['snooze_time'] + self.alarm['snooze_duration'])
 
-  def start_alarm(self, name, start_conditions=None, stop_conditions=None, snooze_conditions=None, beep_off_length=None, beep_on_length=None, snooze_duration=None, snooze_state=None, timezone=None):
-    if name is not None and name == self.alarm['name']:
-      return
+    if self.alarm['onset_time']:
+      deadlines.append(self.alarm['onset_time'] + self.max_active_duration)
 
-    self.alarm = {
-      'name': name,
-      'conditions_to_start_alarm': start_conditions,
-      'conditions_to_stop_alarm': stop_conditions,
-      'conditions_to_snooze_alarm': snooze_conditions,
-      'beep_off_length': beep_off_length,
-      'beep_on_length': beep_on_length,
-      'snooze_duration': snooze_duration,
-      'snooze_state': snooze_state,
-      'onset_time': None,
-      'snooze_time': None,
-      'timezone': timezone,
-    }
+    for conditions in self._active_conditions():
+      if conditions.needs_polling:
+        deadlines.append(current_time + self.TIME_CONDITION_INTERVAL)
+
+      deadline = conditions.next_deadline(current_time)
+      if deadline is not None:
+        deadlines.append(deadline)
 
-    if name in self.alarms:
-      named_alarm = self.alarms[name]
-      # overrides = {key: }
-      self.alarm['conditions_to_start_alarm'] = self.alarm['conditions_to_start_alarm'] or named_alarm.get('start_conditions', None)
-      self.alarm['conditions_to_stop_alarm'] = self.alarm['conditions_to_stop_alarm'] or named_alarm.get('stop_conditions', None)
-      self.alarm['conditions_to_snooze_alarm'] = self.alarm['conditions_to_snooze_alarm'] or named_alarm.get('snooze_conditions', None)
-      self.alarm['beep_off_length'] = self.alarm['beep_off_length'] or named_alarm.get('off_time', None)
-      self.alarm['beep_on_length'] = self.alarm['beep_on_length'] or named_alarm.get('on_time', None)
-      self.alarm['snooze_duration'] = self.alarm['snooze_duration'] or named_alarm.get('snooze_time', None)
-      self.alarm['snooze_state'] = self.alarm['snooze_state'] or named_alarm.get('snooze_state', None)
+    if not deadlines:
+      return None
 
-    self.alarm['beep_off_length'] = self.alarm['beep_off_length'] or self.default_beep_off_length
-    self.alarm['beep_on_length'] = self.alarm['beep_on_length'] or self.default_beep_on_length
-    self.alarm['snooze_duration'] = self.alarm['snooze_duration'] or self.default_snooze_duration
-    self.alarm['snooze_state'] = self.alarm['snooze_state'] or self.default_snooze_state
+    return max(0, min(deadlines) - current_time)
 
-    print("Starting alarm {} at {}...".format(self.alarm['name'], datetime.datetime.now(tz=self.alarm['timezone'])))
-    if name is None:
-      print("Alarm settings:", self.alarm)
+  def main_loop(self):
+    print("Rouser \"{}\" main loop running...".format(self.name))
 
-    self.resume_alarm()
+    with self.CONDITION:
+      while self.running:
+        # print("Ping - rouser")
+        timeout = self._step()
+
+        # Input callbacks and start/stop calls from other threads notify the condition, so presses are handled
+        # immediately and the loop only wakes on its own for deadlines
+        if self.running:
+          self.backend.wait(self.CONDITION, timeout)
+
+  def _step(self):
+    # One pass of the main loop, with CONDITION held; returns how long to sleep for, or None to sleep until notified
+    self._check_alarm()
+    return self._next_wakeup(self.backend.time())
+
+  def _check_alarm(self):
+    for name, conditions in self.start_conditions.items():
+      if self._evaluate_conditions(conditions):
+        conditions.reset(self.backend.time())
+        self.start_alarm(name)
+
+    if self.alarm['snooze_time']:
+      if self.alarm['snooze_time'] + self.alarm['snooze_duration'] <= self.backend.time():
+        self.resume_alarm()
+
+    if self.alarm['onset_time'] and self.alarm['conditions_to_snooze_alarm']:
+      if self._evaluate_conditions(self.alarm['conditions_to_snooze_alarm']):
+        self.snooze_alarm()
+
+    if self.alarm['conditions_to_stop_alarm']:
+      if self._evaluate_conditions(self.alarm['conditions_to_stop_alarm']):
+        self.stop_alarm(reason='stopped')
+
+    if self.alarm['onset_time'] and self.alarm['onset_time'] + self.max_active_duration <= self.backend.time():
+      self.stop_alarm(reason='expired')
+
+  def start_alarm(self, name, start_conditions=None, stop_conditions=None, snooze_conditions=None, beep_off_length=None, beep_on_length=None, pattern=None, snooze_duration=None, snooze_state=None, timezone=None):
+    with self.CONDITION:
+      if name is not None and name == self.alarm['name']:
+        return
+
+      self.alarm = {
+        'name': name,
+        'conditions_to_start_alarm': start_conditions,
+        'conditions_to_stop_alarm': stop_conditions,
+        'conditions_to_snooze_alarm': snooze_conditions,
+        'beep_off_length': beep_off_length,
+        'beep_on_length': beep_on_length,
+        'pattern': pattern,
+        'snooze_duration': snooze_duration,
+        'snooze_state': snooze_state,
+        'onset_time': None,
+        'snooze_time': None,
+        'timezone': tz.gettz(timezone) if isinstance(timezone, str) else timezone,  # the scheduler gives a name
+      }
+
+      if name in self.alarms:
+        named_alarm = self.alarms[name]
+        # overrides = {key: }
+        self.alarm['conditions_to_start_alarm'] = self.alarm['conditions_to_start_alarm'] or named_alarm.get('start_conditions', None)
+        self.alarm['conditions_to_stop_alarm'] = self.alarm['conditions_to_stop_alarm'] or named_alarm.get('stop_conditions', None)
+        self.alarm['conditions_to_snooze_alarm'] = self.alarm['conditions_to_snooze_alarm'] or named_alarm.get('snooze_conditions', None)
+        self.alarm['beep_off_length'] = self.alarm['beep_off_length'] or named_alarm.get('off_time', None)
+        self.alarm['beep_on_length'] = self.alarm['beep_on_length'] or named_alarm.get('on_time', None)
+        self.alarm['pattern'] = self.alarm['pattern'] or named_alarm.get('pattern', None)
+        self.alarm['snooze_duration'] = self.alarm['snooze_duration'] or named_alarm.get('snooze_time', None)
+        self.alarm['snooze_state'] = self.alarm['snooze_state'] or named_alarm.get('snooze_state', None)
+
+      self.alarm['beep_off_length'] = self.alarm['beep_off_length'] or self.default_beep_off_length
+      self.alarm['beep_on_length'] = self.alarm['beep_on_length'] or self.default_beep_on_length
+      self.alarm['snooze_duration'] = self.alarm['snooze_duration'] or self.default_snooze_duration
+      self.alarm['snooze_state'] = self.alarm['snooze_state'] or self.default_snooze_state
+
+      # Compiled once here; from then on input events update them incrementally
+      for key in ('conditions_to_stop_alarm', 'conditions_to_snooze_alarm'):
+        if self.alarm[key] and not isinstance(self.alarm[key], CompiledConditions):
+          self.alarm[key] = CompiledConditions(self.alarm[key], self.input_pins)
+
+      print("Starting alarm {} at {}...".format(self.alarm['name'], datetime.datetime.now(tz=self.alarm['timezone'])))
+      METRICS.increment('alarms_started_total', rouser=self.name)
+      if name is None:
+        print("Alarm settings:", self.alarm)
+
+      self.resume_alarm()
+      self._notify_all()
+
+  def _reset_conditions(self):
+    # Matchers stay matched once they match, so each snooze and resume starts them over; otherwise the press that
+    # snoozed the alarm would snooze it again the moment it resumes
+    for key in ('conditions_to_stop_alarm', 'conditions_to_snooze_alarm'):
+      if isinstance(self.alarm[key], CompiledConditions):
+        self.alarm[key].reset(self.backend.time())
 
   def resume_alarm(self):
-    self.alarm['onset_time'] = time.time()
+    self.alarm['onset_time'] = self.backend.time()
     self.alarm['snooze_time'] = None
+    self._reset_conditions()
 
-    if self.alarm['beep_on_length']:
-      self.output.beep(self.alarm['beep_off_length'], self.alarm['beep_on_length'])
-    else:
-      self.output.on()
+    pattern = self.alarm['pattern']
+    if not pattern:
+      pattern = dict(type='beep', on=self.alarm['beep_on_length'], off=self.alarm['beep_off_length']) if self.alarm['beep_on_length'] else dict(type='on')
+
+    self.player.play(self.output, compile_pattern(pattern, self.alarm['name']))
+
+    self._save_alarm()
 
   def snooze_alarm(self):
+    self.player.stop(self.output)
     if self.alarm['snooze_state'] == 'off':
       self.output.off()
     else:
       self.output.on()
 
-    self.alarm['snooze_time'] = time.time()
+    self.alarm['snooze_time'] = self.backend.time()
     self.alarm['onset_time'] = None
+    self._reset_conditions()
+    self._save_alarm()
+
+  def stop_alarm(self, reason='canceled'):
+    # reason is 'stopped' when the stop conditions were met, 'expired' after max_active_duration, 'canceled' when
+    # called from outside (e.g. by email), or 'escalated' when an escalation stops or restarts it
+    with self.CONDITION:
+      self.player.stop(self.output)
+      self.output.off()
+      if any(self.alarm.values()):
+        name = self.alarm['name']
+        print("Stopping alarm {} at {}...".format(name, datetime.datetime.now(tz=self.alarm['timezone'])))
+        METRICS.increment('alarms_stopped_total', rouser=self.name, reason=reason)
+        self._reset_alarm()
+        self._save_alarm()
+
+        for listener in self.listeners:
+          listener(self, name, reason)
 
-  def stop_alarm(self):
-    self.output.off()
-    if any(self.alarm.values()):
-      print("Stopping alarm {} at {}...".format(self.alarm['name'], datetime.datetime.now(tz=self.alarm['timezone'])))
-      self._reset_alarm()
+      self._notify_all()
 
   def shutdown(self):
     print("Shutting down \"{}\" rouser.".format(self.name))
-    self.stop_alarm()
-    self.running = False
+
+    # Only silenced, not stopped: the saved alarm is restored on the next start (e.g. after a reboot), and listeners
+    # such as escalations must not take this for someone answering
+    with self.CONDITION:
+      self.player.stop(self.output)
+      self.output.off()
+
+      self.running = False
+      self._notify_all()
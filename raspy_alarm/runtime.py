@@ -0,0 +1,99 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
+
+
+class AsyncRuntime(object):
+  # Runs the scheduler and rousers as tasks on a single asyncio event loop instead of a thread each. Their main loops
+  # are split into _step methods. A step takes the usual locks and may wait on them, or on the state store, so steps
+  # run on a small thread pool while the loop only does the waiting in between; the pool only starts a thread when
+  # none is idle, so usually one or two exist. Input callbacks and calls from other threads, e.g. interfaces, wake the
+  # tasks through Scheduler.listeners and Rouser.WAKERS.
+  def __init__(self, scheduler=None, rousers=None):
+    self.scheduler = scheduler
+    self.rousers = rousers or []
+
+    self.loop = None
+    self.executor = None
+
+  def _make_waker(self):
+    # Returns an event and a thread-safe callable that sets it
+    event = asyncio.Event()
+
+    def wake():
+      try:
+        self.loop.call_soon_threadsafe(event.set)
+      except RuntimeError:
+        pass  # the loop has already finished
+
+    return event, wake
+
+  async def _wait(self, event, timeout):
+    try:
+      await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+      pass
+
+  def _rouser_step(self, rouser):
+    with rouser.CONDITION:
+      return rouser._step()
+
+  async def _rouser_task(self, rouser):
+    print("Rouser \"{}\" task running...".format(rouser.name))
+    event, wake = self._make_waker()
+    rouser.WAKERS.append(wake)
+
+    try:
+      while rouser.running:
+        event.clear()
+        timeout = await self.loop.run_in_executor(self.executor, self._rouser_step, rouser)
+
+        if rouser.running:
+          await self._wait(event, rouser.backend.real_timeout(timeout))
+    finally:
+      rouser.WAKERS.remove(wake)
+
+  def _scheduler_step(self):
+    scheduler = self.scheduler
+
+    with scheduler.condition:
+      timeout = scheduler._step()
+      scheduler.pending_events = 0
+
+    return timeout
+
+  async def _scheduler_task(self):
+    print("Scheduler task running...")
+    scheduler = self.scheduler
+    event, wake = self._make_waker()
+    scheduler.listeners.append(wake)
+
+    scheduler._start_schedule_watcher()
+
+    try:
+      while scheduler.running:
+        event.clear()
+        timeout = await self.loop.run_in_executor(self.executor, self._scheduler_step)
+
+        if scheduler.running:
+          await self._wait(event, timeout)
+    finally:
+      scheduler.listeners.remove(wake)
+      scheduler.schedule_watcher.stop()
+
+  async def main(self):
+    self.loop = asyncio.get_running_loop()
+    tasks = [self._rouser_task(rouser) for rouser in self.rousers]
+
+    if self.scheduler:
+      tasks.append(self._scheduler_task())
+
+    self.executor = ThreadPoolExecutor(max_workers=max(1, len(tasks)), thread_name_prefix='step')
+
+    try:
+      await asyncio.gather(*tasks)
+    finally:
+      self.executor.shutdown(wait=False)
+
+  def run(self):
+    asyncio.run(self.main())
@@ -0,0 +1,94 @@
+from array import array
+
+import bisect
+import struct
+import mmap
+import json
+import os
+
+
+MAGIC = b'RASPYSC1'
+HEADER = struct.Struct('<8sII')  # magic, metadata length, number of timestamps
+
+
+class CompiledSchedule(object):
+  # Occurrence timestamps (epoch seconds) for every rule set up to a horizon, stored grouped by rule set index.
+  # `offsets[i]:offsets[i + 1]` is the slice belonging to rule set i and `horizons[i]` is the last moment that
+  # slice is known to be complete for (infinity if the rule set is exhausted).
+  def __init__(self, schedule_hash, reference_time, threshold, horizons, offsets, timestamps):
+    self.schedule_hash = schedule_hash
+    self.reference_time = reference_time
+    self.threshold = threshold
+    self.horizons = horizons
+    self.offsets = offsets
+    self.timestamps = timestamps
+
+    self.mapping = None
+
+  @classmethod
+  def load(cls, filepath):
+    try:
+      with open(filepath, 'rb') as file:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError) as e:
+      return None
+
+    try:
+      magic, metadata_length, count = HEADER.unpack_from(mapping, 0)
+      if magic != MAGIC:
+        raise ValueError("bad magic number")
+
+      metadata = json.loads(bytes(mapping[HEADER.size:HEADER.size + metadata_length]).decode('utf-8'))
+      start = HEADER.size + metadata_length
+
+      # A file cut short, e.g. by a full SD card, would otherwise give fewer timestamps than the offsets index
+      if start + count * 8 != len(mapping):
+        raise ValueError("expected {} timestamps in {} bytes".format(count, len(mapping) - start))
+
+      offsets = metadata['offsets']
+      if offsets[-1] != count or len(metadata['horizons']) != len(offsets) - 1:
+        raise ValueError("offsets don't match the timestamps")
+
+      timestamps = memoryview(mapping)[start:].cast('d')
+    except Exception as e:
+      print("Error loading compiled schedule: {}".format(str(e)))
+      mapping.close()
+      return None
+
+    compiled = cls(metadata['schedule_hash'], metadata['reference_time'], metadata['threshold'], metadata['horizons'], metadata['offsets'], timestamps)
+    compiled.mapping = mapping
+    return compiled
+
+  def save(self, filepath):
+    metadata = json.dumps(dict(
+      schedule_hash=self.schedule_hash,
+      reference_time=self.reference_time,
+      threshold=self.threshold,
+      horizons=self.horizons,
+      offsets=self.offsets,
+    )).encode('utf-8')
+    metadata += b' ' * (-(HEADER.size + len(metadata)) % 8)  # keep the timestamps 8-byte aligned
+
+    temp_filepath = filepath + '.tmp'
+    with open(temp_filepath, 'wb') as file:
+      file.write(HEADER.pack(MAGIC, len(metadata), len(self.timestamps)))
+      file.write(metadata)
+      file.write(array('d', self.timestamps).tobytes())
+
+    os.replace(temp_filepath, filepath)
+
+  def close(self):
+    if self.mapping is not None:
+      self.timestamps.release()
+      self.mapping.close()
+      self.mapping = None
+
+  def next_timestamp(self, index, timestamp):
+    # Returns the first stored occurrence of rule set `index` strictly after `timestamp`, or None if there is none
+    start, end = self.offsets[index], self.offsets[index + 1]
+    position = bisect.bisect_right(self.timestamps, timestamp, start, end)
+
+    if position < end:
+      return self.timestamps[position]
+
+    return None
@@ -1,11 +1,21 @@
 from dateutil import rrule, tz
+from threading import Condition, Lock, Thread
+from collections import deque
 
 import datetime
 import hashlib
-import time
+import itertools
+import heapq
+import copy
 import json
+import time
 import os
 
+from schedule_cache import CompiledSchedule
+from commands import CommandError
+from metrics import METRICS
+from watcher import FileWatcher
+
 
 FREQUENCIES = {'yearly': rrule.YEARLY, 'monthly': rrule.MONTHLY, 'weekly': rrule.WEEKLY, 'daily': rrule.DAILY, 'hourly': rrule.HOURLY, 'minutely': rrule.MINUTELY, 'secondly': rrule.SECONDLY}
 MONTH_NAMES = ['jan', 'january', 'feb', 'february', 'mar', 'march', 'apr', 'april', 'jun', 'june', 'jul', 'july', 'sept', 'september', 'oct', 'october', 'nov', 'november', 'dec', 'december']
@@ -15,9 +25,80 @@ WEEKDAYS = {name: index // 4 for index, name in enumerate(WEEKDAY_NAMES)}
 WEEKDAYNO = (rrule.MO, rrule.TU, rrule.WE, rrule.TH, rrule.FR, rrule.SA, rrule.SU)  # This supports e.g. rrule.MO(2) for the second Monday of a month
 
 
+class OccurrenceCursor(object):
+  # Walks an rruleset forward from the last threshold instead of rescanning it from dtstart on every lookup
+  def __init__(self, rrule_set, exclusions):
+    self.rrule_set = rrule_set
+    self.exclusions = exclusions
+    self.iterator = None
+    self.threshold = None
+    self.current = None
+
+  def _advance(self):
+    for dt in self.iterator:
+      if dt not in self.exclusions:
+        return dt
+
+    return None
+
+  def after(self, threshold, until=None):
+    if self.iterator is None or threshold < self.threshold:
+      self.iterator = self.rrule_set.xafter(threshold)
+      self.current = self._advance()
+
+    self.threshold = threshold
+
+    while self.current is not None and self.current <= threshold:
+      self.current = self._advance()
+
+    return self.current
+
+
+class CompiledCursor(object):
+  # Serves occurrences from a CompiledSchedule and hands over to a real rrule cursor past the compiled horizon
+  def __init__(self, compiled, index, timezone, make_fallback):
+    self.compiled = compiled
+    self.index = index
+    self.timezone = timezone
+    self.make_fallback = make_fallback
+    self.fallback = None
+
+  def _fallback_after(self, threshold):
+    if self.fallback is None:
+      self.fallback = self.make_fallback()
+
+    return self.fallback.after(threshold)
+
+  def after(self, threshold, until=None):
+    # With `until`, occurrences known to be later than it may be reported as None without building the rrule
+    timestamp = threshold.timestamp()
+    if timestamp < self.compiled.threshold:
+      return self._fallback_after(threshold)
+
+    next_timestamp = self.compiled.next_timestamp(self.index, timestamp)
+    if next_timestamp is not None:
+      return datetime.datetime.fromtimestamp(next_timestamp, tz=self.timezone)
+
+    horizon = self.compiled.horizons[self.index]
+    if horizon == float('inf') or (until is not None and until.timestamp() <= horizon):
+      return None
+
+    return self._fallback_after(max(threshold, datetime.datetime.fromtimestamp(horizon, tz=self.timezone)))
+
+
 class Scheduler(object):
-  def __init__(self, schedule_filepath, alarms=None, rousers=None, interfaces=None):
+  FIRE_WINDOW = datetime.timedelta(seconds=5)
+  MAX_LATENESS = datetime.timedelta(hours=1)  # alarms missed by more than this are skipped instead of fired late
+  MAX_SLEEP = 60  # seconds; the wall clock may be stepped, e.g. by NTP after boot on a Pi without a clock
+  COMPILED_HORIZON = datetime.timedelta(days=7)
+  MAX_COMPILED_OCCURRENCES = 10000  # per rule set
+  TIMELINE_HORIZON = datetime.timedelta(days=7)
+  TIMELINE_REFRESH = datetime.timedelta(hours=1)  # how far the horizon may move before the timeline is extended
+  RECENT_FIRES = 50  # how many alarm firings are kept in the state store
+
+  def __init__(self, schedule_filepath, alarms=None, rousers=None, interfaces=None, state=None):
     self.schedule_filepath = schedule_filepath
+    self.state = state  # a StateStore to record alarm firings in, if any
 
     self.rousers = {}
     if rousers:
@@ -31,12 +112,39 @@ class Scheduler(object):
         self.interfaces.append(interface)
 
     self.timezone = None
+    self.timezone_name = None  # as given in the schedule file, e.g. 'Europe/Berlin'
     self.schedule_hash = None
+    self.schedule_generation = 0  # bumped on every reload
+    self.compiled_schedule = None
     self.cached_rrsets = []
-    self.cached_exclusions = []
+    self.cached_exclusions = set()
     self.cached_inclusions = []
 
+    # Heap of (timestamp, sequence number, datetime, source) where source is ('rrule_set', index) or
+    # ('inclusion', index). Ordered and compared by timestamp, since datetimes in the same timezone compare by wall
+    # clock time, which is off by an hour across a DST change.
+    self.alarm_queue = []
+    self.queue_counter = 0
+    self.last_fire_check = None
+
+    # Sorted (datetime, params) pairs for every alarm up to timeline_end, kept up to date as alarms fire. Guarded by
+    # timeline_lock instead of the condition, since filling it in may walk rrules for a long time
+    self.timeline = deque()
+    self.timeline_end = None
+    self.timeline_cursors = []
+    self.timeline_sources = ([], [])  # the rule sets and inclusions the timeline was built from
+    self.timeline_generation = None  # schedule_generation it was built for
+    self.timeline_lock = Lock()
+    self.timeline_thread = None
+
+    self.schedule_watcher = None
+    self.schedule_changed = True
+    self.edit_lock = Lock()  # serializes edits of the schedule file by interfaces
+
+    self.condition = Condition()
+    self.pending_events = 0
     self.running = True
+    self.listeners = []  # called on every notify, e.g. to wake an asyncio task
 
   @property
   def now(self):
@@ -46,7 +154,7 @@ class Scheduler(object):
   def EPOCH(self):
     return datetime.datetime(2018, 1, 1, 0, 0, 0, tzinfo=self.timezone)
 
-  def _make_rrule(self, data):
+  def _make_rrule(self, data, reference=None):
     if 'freq' in data:
       if isinstance(data['freq'], str):
         data['freq'] = FREQUENCIES[data['freq'].lower()]
@@ -78,7 +186,7 @@ class Scheduler(object):
     data.setdefault('bysecond', 0)
 
     if 'dtstart' in data:
-      data['dtstart'] = self.now.replace(**data['dtstart'])
+      data['dtstart'] = (reference or self.now).replace(**data['dtstart'])
     else:
       data['dtstart'] = self.EPOCH
 
@@ -95,53 +203,57 @@ class Scheduler(object):
       pass
 
     if not contents:
-      return
+      return False
 
     schedule_hash = hashlib.sha1(bytes(contents, encoding='utf-8')).hexdigest()
     if schedule_hash == self.schedule_hash:
-      return
-
-    self.schedule_hash = schedule_hash
-
-    self.timezone = None
-    self.cached_rrsets = []
-    self.cached_exclusions = []
-    self.cached_inclusions = []
+      return False
 
     try:
       parsed = json.loads(contents)
     except Exception as e:
+      # Keep the previous schedule; a complete write will trigger another reload
       print("Error loading schedule JSON: {}".format(str(e)))
-      return
+      return False
 
-    self.timezone = tz.gettz(parsed.get('timezone', None))
-
-    now = self.now
+    self.schedule_hash = schedule_hash
+    self.schedule_generation += 1
 
-    for rrset_config in parsed.get('rrule_sets', []):
-      rset = rrule.rruleset()
+    self.timezone = None
+    self.cached_rrsets = []
+    self.cached_exclusions = set()
+    self.cached_inclusions = []
 
-      for rrule_config in rrset_config.get('rrules', []):
-        rule = self._make_rrule(rrule_config)
-        rset.rrule(rule)
+    self.timezone_name = parsed.get('timezone', None)
+    self.timezone = tz.gettz(self.timezone_name)
 
-      for exrule_config in rrset_config.get('exrules', []):
-        rule = self._make_rrule(exrule_config)
-        rset.exrule(rule)
+    if self.last_fire_check is None:
+      self.last_fire_check = self._restore_fire_check()
 
-      for rdate_config in rrset_config.get('rdates', []):
-        date = now.replace(**rdate_config)
-        rset.rdate(date)
+    # Relative dates are resolved against the time the schedule was compiled, so that reusing the compiled
+    # schedule after a restart gives exactly the same occurrences
+    compiled = CompiledSchedule.load(self.compiled_filepath)
+    if compiled and (compiled.schedule_hash != schedule_hash or compiled.reference_time + self.COMPILED_HORIZON.total_seconds() < self.now.timestamp()):
+      compiled.close()
+      compiled = None
 
-      for exdate_config in rrset_config.get('exdates', []):
-        date = now.replace(**exdate_config)
-        rset.exdate(date)
+    if compiled:
+      now = datetime.datetime.fromtimestamp(compiled.reference_time, tz=self.timezone)
+    else:
+      now = self.now
 
+    for rrset_config in parsed.get('rrule_sets', []):
       alarm_config = dict(
-        rrule_set=rset,
+        rrule_set=None,  # built lazily when a compiled schedule is reused
+        cursor=None,
+        config=rrset_config,
+        reference=now,
         params=rrset_config['parameters'],
       )
 
+      if not compiled:
+        alarm_config['rrule_set'] = self._make_rrule_set(rrset_config, now)
+
       self.cached_rrsets.append(alarm_config)
 
     exceptions = parsed.get('exceptions', {})
@@ -154,7 +266,94 @@ class Scheduler(object):
 
     for exdate_config in exceptions.get('exclude', []):
       date = now.replace(**exdate_config)
-      self.cached_exclusions.append(date)
+      self.cached_exclusions.add(date)
+
+    if not compiled:
+      compiled = self._compile_schedule(now)
+
+      try:
+        compiled.save(self.compiled_filepath)
+      except Exception as e:
+        print("Error saving compiled schedule: {}".format(str(e)))
+
+    if self.compiled_schedule is not None:
+      self.compiled_schedule.close()
+
+    self.compiled_schedule = compiled
+
+    for index, alarm_config in enumerate(self.cached_rrsets):
+      alarm_config['cursor'] = CompiledCursor(compiled, index, self.timezone, lambda index=index: self._make_cursor(index))
+
+    return True
+
+  @property
+  def compiled_filepath(self):
+    return os.path.join(os.getcwd(), self.schedule_filepath) + '.compiled'
+
+  def _make_rrule_set(self, rrset_config, now):
+    rrset_config = copy.deepcopy(rrset_config)  # _make_rrule normalizes its argument in place
+    rset = rrule.rruleset()
+
+    for rrule_config in rrset_config.get('rrules', []):
+      rule = self._make_rrule(rrule_config, now)
+      rset.rrule(rule)
+
+    for exrule_config in rrset_config.get('exrules', []):
+      rule = self._make_rrule(exrule_config, now)
+      rset.exrule(rule)
+
+    for rdate_config in rrset_config.get('rdates', []):
+      date = now.replace(**rdate_config)
+      rset.rdate(date)
+
+    for exdate_config in rrset_config.get('exdates', []):
+      date = now.replace(**exdate_config)
+      rset.exdate(date)
+
+    return rset
+
+  def _rrule_set(self, index):
+    return self._config_rrule_set(self.cached_rrsets[index])
+
+  def _config_rrule_set(self, alarm_config):
+    if alarm_config['rrule_set'] is None:
+      alarm_config['rrule_set'] = self._make_rrule_set(alarm_config['config'], alarm_config['reference'])
+
+    return alarm_config['rrule_set']
+
+  def _make_cursor(self, index):
+    return OccurrenceCursor(self._rrule_set(index), self.cached_exclusions)
+
+  def _compile_schedule(self, now):
+    threshold = now - self.FIRE_WINDOW
+    if self.last_fire_check is not None:
+      threshold = min(threshold, self.last_fire_check)
+
+    horizon = now + self.COMPILED_HORIZON
+    horizons = []
+    offsets = [0]
+    timestamps = []
+
+    for index in range(len(self.cached_rrsets)):
+      cursor = self._make_cursor(index)
+      count = 0
+      dt = cursor.after(threshold)
+
+      while dt is not None and dt <= horizon and count < self.MAX_COMPILED_OCCURRENCES:
+        timestamps.append(dt.timestamp())
+        count += 1
+        dt = cursor.after(dt)
+
+      if dt is None:
+        horizons.append(float('inf'))
+      elif dt > horizon:
+        horizons.append(horizon.timestamp())
+      else:
+        horizons.append(timestamps[-1])
+
+      offsets.append(len(timestamps))
+
+    return CompiledSchedule(self.schedule_hash, now.timestamp(), threshold.timestamp(), horizons, offsets, timestamps)
 
   def calculate_datetimes(self, threshold=None):
     if threshold is None:
@@ -162,53 +361,322 @@ class Scheduler(object):
 
     datetimes = list(self.cached_inclusions)
 
-    for alarm_rule in self.cached_rrsets:
-      rrule_set = alarm_rule['rrule_set']
-      temp_dt = rrule_set.after(threshold)
+    # Interfaces may call this from their own threads while the main loop advances the same cursors
+    with self.condition:
+      for alarm_rule in self.cached_rrsets:
+        datetimes.append(dict(
+          datetime=alarm_rule['cursor'].after(threshold),
+          params=alarm_rule['params'],
+        ))
 
-      while temp_dt in self.cached_exclusions:
-        temp_dt = rrule_set.after(temp_dt)
+    return datetimes
 
-      datetimes.append(dict(
-        datetime=temp_dt,
-        params=alarm_rule['params'],
-      ))
+  def _next_occurrence(self, index, after):
+    return self.cached_rrsets[index]['cursor'].after(after)
 
-    return datetimes
+  def _push_alarm(self, dt, source):
+    if dt is None:
+      return
 
-  def main_loop(self):
-    print("Scheduler main loop running...")
+    self.queue_counter += 1
+    heapq.heappush(self.alarm_queue, (dt.timestamp(), self.queue_counter, dt, source))
+
+  def _build_alarm_queue(self, threshold):
+    self.alarm_queue = []
+
+    for index, inclusion in enumerate(self.cached_inclusions):
+      if inclusion['datetime'].timestamp() > threshold.timestamp():
+        self._push_alarm(inclusion['datetime'], ('inclusion', index))
+
+    for index in range(len(self.cached_rrsets)):
+      self._push_alarm(self._next_occurrence(index, threshold), ('rrule_set', index))
+
+  def _start_timeline_build(self):
+    # Built on its own thread, so that alarms keep firing while rrules past the compiled horizon are walked
+    self.timeline_thread = Thread(target=self._build_timeline, args=(datetime.datetime.now(tz=self.timezone),), daemon=True, name='timeline')
+    self.timeline_thread.start()
+
+  def _build_timeline(self, now):
+    # Only takes the condition to copy the schedule; a build for a schedule that has been reloaded since is dropped
+    with self.timeline_lock, METRICS.timer('timeline_build_seconds'):
+      with self.condition:
+        generation = self.schedule_generation
+        compiled = self.compiled_schedule
+        rrsets = self.cached_rrsets
+        exclusions = self.cached_exclusions
+        self.timeline_sources = (rrsets, self.cached_inclusions)
+
+      # Separate cursors from the alarm queue's, since the timeline reads ahead of it
+      self.timeline = deque()
+      self.timeline_generation = generation
+      self.timeline_cursors = [
+        CompiledCursor(compiled, index, self.timezone, lambda alarm_config=alarm_config: OccurrenceCursor(self._config_rrule_set(alarm_config), exclusions))
+        for index, alarm_config in enumerate(rrsets)
+      ]
+      self.timeline_end = now
+
+      # Past its horizon a cursor has to walk its rrule from dtstart, which takes long for frequent rules, so a reload
+      # stops where the first rule set runs out of compiled occurrences (some are capped by MAX_COMPILED_OCCURRENCES
+      # well before COMPILED_HORIZON); the rest is filled in by the first upcoming() call after TIMELINE_REFRESH
+      compiled_end = min(compiled.horizons + [compiled.reference_time + self.COMPILED_HORIZON.total_seconds()])
+      self._extend_timeline(max(now, min(now + self.TIMELINE_HORIZON, datetime.datetime.fromtimestamp(compiled_end, tz=self.timezone))))
+
+  def _extend_timeline(self, end):
+    # With timeline_lock held. A reload closes the compiled schedule under the cursors, which then raise ValueError;
+    # the reload's own build replaces the timeline
+    try:
+      self._fill_timeline(end)
+    except ValueError as e:
+      if self.timeline_generation == self.schedule_generation:
+        raise
+
+  def _fill_timeline(self, end):
+    rrsets, inclusions = self.timeline_sources
+    start = self.timeline_end
+    entries = []
+    param_keys = {}  # Rule sets that start the same alarms at the same time would otherwise show up more than once
+
+    def add(dt, params):
+      if id(params) not in param_keys:
+        param_keys[id(params)] = json.dumps(params, sort_keys=True, default=str)
+
+      entries.append((dt, param_keys[id(params)], params))
+
+    for index, cursor in enumerate(self.timeline_cursors):
+      params = rrsets[index]['params']
+      dt = cursor.after(start, end)
+
+      while dt is not None and dt <= end:
+        add(dt, params)
+        dt = cursor.after(dt, end)
+
+    for inclusion in inclusions:
+      if start < inclusion['datetime'] <= end:
+        add(inclusion['datetime'], inclusion['params'])
+
+    entries.sort(key=lambda entry: entry[:2])
+    previous = None
+    for dt, key, params in entries:
+      if (dt, key) != previous:
+        self.timeline.append((dt, params))
+        previous = (dt, key)
+
+    self.timeline_end = end
+
+  def _trim_timeline(self, now):
+    while self.timeline and self.timeline[0][0] <= now:
+      self.timeline.popleft()
+
+  def upcoming(self, days=None):
+    # Alarms from now until the timeline horizon or the given number of days as (datetime, params) pairs
+    thread = self.timeline_thread
+    if thread is not None:
+      thread.join()  # so that the answer reflects a schedule that was just reloaded
+
+    with self.timeline_lock:
+      now = datetime.datetime.now(tz=self.timezone)
+      if self.timeline_end is None:
+        return []
+
+      self._trim_timeline(now)
+      if now + self.TIMELINE_HORIZON - self.timeline_end >= self.TIMELINE_REFRESH and self.timeline_generation == self.schedule_generation:
+        self._extend_timeline(now + self.TIMELINE_HORIZON)
+
+      end = now + datetime.timedelta(days=days) if days is not None else self.timeline_end
+      return list(itertools.takewhile(lambda entry: entry[0] <= end, self.timeline))
+
+  def expand(self, start, end):
+    # Every alarm in [start, end] per rouser as sorted datetime64[s] arrays in UTC, computed in bulk with numpy; meant
+    # for long what-if ranges like a whole year, where walking the cursors one occurrence at a time is slow
+    import expansion  # imports numpy, which would add to every startup otherwise
+    expansion.require_numpy()
+    np = expansion.np
+
+    # Only the schedule is copied with the condition held; the expansion itself runs without it, so that alarms keep
+    # firing while it takes seconds
+    with self.condition:
+      timezone = self.timezone
+      rule_sets = [(self._rrule_set(index), alarm_config['params']) for index, alarm_config in enumerate(self.cached_rrsets)]
+      exclusions = list(self.cached_exclusions)
+      inclusions = list(self.cached_inclusions)
+
+    offset_cache = expansion.OffsetCache(timezone)
+    excluded = np.array(sorted(int(dt.timestamp()) for dt in exclusions), dtype=np.int64)
+    per_rouser = {}
+
+    for rrule_set, params in rule_sets:
+      occurrences = expansion.expand_rule_set(rrule_set, start, end, offset_cache)
+      if len(excluded):
+        occurrences = occurrences[~expansion.contains(excluded, occurrences)]
+
+      for rouser_name in params:
+        per_rouser.setdefault(rouser_name, []).append(occurrences)
+
+    for inclusion in inclusions:
+      if start <= inclusion['datetime'] <= end:
+        for rouser_name in inclusion['params']:
+          per_rouser.setdefault(rouser_name, []).append(np.array([int(inclusion['datetime'].timestamp())], dtype=np.int64))
+
+    return {rouser_name: expansion.sorted_unique(np.concatenate(parts)).astype('datetime64[s]') for rouser_name, parts in per_rouser.items()}
+
+  def _restore_fire_check(self):
+    # After a restart, alarms that came due while the program wasn't running are fired late, up to MAX_LATENESS
+    timestamp = self.state.get('scheduler/last_fire_check', None) if self.state is not None else None
+    if timestamp is None:
+      return None
+
+    now = time.time()
+    return datetime.datetime.fromtimestamp(min(now, max(timestamp, now - self.MAX_LATENESS.total_seconds())), tz=self.timezone)
+
+  def _record_fire(self, dt, now, params, late):
+    if self.state is None:
+      return
 
-    while self.running:
-      # print("Ping - scheduler")
+    self.state.append('scheduler/recent_fires', dict(
+      scheduled=dt.isoformat(),
+      fired=now.isoformat(),
+      late=late,
+      alarms={rouser_name: alarm_params.get('name') for rouser_name, alarm_params in params.items()},
+    ), self.RECENT_FIRES)
+
+    # Every alarm up to here has been handled; only saved when something fires, since that's all a restart needs
+    self.state.set('scheduler/last_fire_check', now.timestamp(), durable=True, background=True)  # the condition is held
+
+  def _fire_due_alarms(self, now):
+    self.last_fire_check = now
+    current_time = now.timestamp()
+
+    while self.alarm_queue and self.alarm_queue[0][0] <= current_time:
+      timestamp, _, dt, (kind, index) = heapq.heappop(self.alarm_queue)
+      lateness = current_time - timestamp
+      late = lateness > self.FIRE_WINDOW.total_seconds()
+
+      if kind == 'rrule_set':
+        params = self.cached_rrsets[index]['params']
+        # A late alarm is fired once, not once for every occurrence that was missed
+        self._push_alarm(self._next_occurrence(index, now if late else dt), (kind, index))
+      else:
+        params = self.cached_inclusions[index]['params']
+
+      if late:
+        if lateness > self.MAX_LATENESS.total_seconds():
+          print("Skipping alarm scheduled for {}; it is too late to fire it.".format(dt))
+          METRICS.increment('alarms_skipped_total')
+          continue
+
+        print("Alarm scheduled for {} missed its firing window; firing it late.".format(dt))
+        METRICS.increment('alarms_fired_late_total')
+
+      METRICS.increment('alarms_fired_total')
+      METRICS.observe('alarm_lateness_seconds', lateness)
+
+      for rouser_name, alarm_params in params.items():
+        alarm_params['timezone'] = self.timezone_name  # by name, so that it can be sent on to remote rousers
+        self.rousers[rouser_name].start_alarm(**alarm_params)
 
-      for interface in self.interfaces:
-        # The interface is responsible for using methods on the scheduler to do stuff
-        try:
-          interface.check()
-        except Exception as e:
-          print("Error while checking interface:", str(e))
+      self._record_fire(dt, now, params, late)
+
+  def _next_wakeup(self, now):
+    # The condition waits on a monotonic clock, so a step of the wall clock is only noticed at the next wakeup
+    timeouts = [self.MAX_SLEEP]
+
+    if self.alarm_queue:
+      timeouts.append(self.alarm_queue[0][0] - now.timestamp())
+
+    return max(0, min(timeouts))
+
+  def edit_schedule(self, edit):
+    # Applies `edit` to the parsed schedule file and returns its result. The file is replaced atomically, so a crash
+    # or the file watcher never sees half of it, and reloaded right away rather than when the watcher notices.
+    filepath = os.path.join(os.getcwd(), self.schedule_filepath)
+
+    with self.edit_lock:
+      try:
+        with open(filepath, 'r') as file:
+          schedule = json.load(file)
+      except FileNotFoundError as e:
+        schedule = {}
+      except ValueError as e:
+        # Rewriting it would lose whatever is in it, so it has to be fixed by hand first
+        raise CommandError("The schedule file can't be edited because it isn't valid JSON: {}".format(str(e)))
+
+      result = edit(schedule)
+
+      temporary = filepath + '.tmp'
+      with open(temporary, 'w') as file:
+        json.dump(schedule, file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+
+      os.replace(temporary, filepath)
+
+    METRICS.increment('schedule_edits_total')
+    self._schedule_file_changed()
+    return result
+
+  def _schedule_file_changed(self):
+    self.schedule_changed = True
+    self.notify()
+
+  def notify(self):
+    # Wakes the main loop early, e.g. when an interface has received an event
+    with self.condition:
+      self.pending_events += 1
+      self.condition.notify_all()
+
+    for listener in self.listeners:
+      listener()
+
+  def _start_schedule_watcher(self):
+    self.schedule_watcher = FileWatcher(os.path.join(os.getcwd(), self.schedule_filepath), self._schedule_file_changed)
+    self.schedule_watcher.start()
+
+  def _step(self):
+    # One pass of the main loop, with the condition held; returns how long to sleep for
+    tick_start = time.perf_counter()
+
+    if self.schedule_changed:
+      self.schedule_changed = False
 
       try:
-        self._check_schedule()
+        with METRICS.timer('schedule_reload_seconds'):
+          if self._check_schedule():
+            # On reload, pick up exactly where the previous queue left off so nothing fires twice
+            self._build_alarm_queue(self.last_fire_check or self.now - self.FIRE_WINDOW)
+            self._start_timeline_build()
       except Exception as e:
         print("Error while checking schedule:", str(e))
 
-      now = self.now
-      threshold = now - datetime.timedelta(seconds=1)
-      datetimes = sorted(self.calculate_datetimes(threshold), key=lambda _: _['datetime'])
+    # Not truncated to the second like self.now, so that alarm lateness is measured precisely
+    self._fire_due_alarms(datetime.datetime.now(tz=self.timezone))
+    # Left to upcoming() while a build holds the timeline
+    if self.timeline_lock.acquire(blocking=False):
+      try:
+        self._trim_timeline(datetime.datetime.now(tz=self.timezone))
+      finally:
+        self.timeline_lock.release()
+
+    METRICS.observe('scheduler_tick_seconds', time.perf_counter() - tick_start)
+
+    return self._next_wakeup(datetime.datetime.now(tz=self.timezone))
+
+  def main_loop(self):
+    print("Scheduler main loop running...")
+
+    self._start_schedule_watcher()
+
+    # Only alarm timing happens on this thread; interfaces push their events through methods on the scheduler
+    while self.running:
+      # print("Ping - scheduler")
+      with self.condition:
+        timeout = self._step()
 
-      for alarm_datetime in datetimes:
-        dt = alarm_datetime['datetime']
-        params = alarm_datetime['params']
+        if not self.pending_events and self.running:
+          self.condition.wait(timeout)
 
-        delta = datetime.timedelta(seconds=5)
-        if dt - delta < now < dt + delta:
-          for rouser_name, alarm_params in params.items():
-            alarm_params['timezone'] = self.timezone
-            self.rousers[rouser_name].start_alarm(**alarm_params)
+        self.pending_events = 0
 
-      time.sleep(1)
+    self.schedule_watcher.stop()
 
   def shutdown(self):
     print("Shutting down interfaces.")
@@ -217,3 +685,4 @@ class Scheduler(object):
 
     print("Shutting down scheduler.")
     self.running = False
+    self.notify()
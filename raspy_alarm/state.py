@@ -0,0 +1,186 @@
+from threading import Event, Lock, Thread, Timer
+
+import sqlite3
+import json
+import os
+
+
+class StateStore(object):
+  # Small key-value store of JSON values in SQLite, for state that has to survive a restart: how far each mailbox
+  # has been read, the active alarm of each rouser, recent alarm firings.
+  #
+  # Values are kept in memory and only written when they actually change. Writes are coalesced into one transaction
+  # every FLUSH_DELAY seconds, which saves the SD card a write per check; durable writes (e.g. an alarm starting) are
+  # committed and synced immediately. Callers that hold a lock others wait on, like the rousers' condition, pass
+  # `background` so that the sync happens on the store's writer thread instead of while they hold it.
+  FLUSH_DELAY = 5
+  DEFAULT_FILEPATH = os.path.join('data', 'state.sqlite3')
+
+  def __init__(self, filepath):
+    self.filepath = filepath
+    directory = os.path.dirname(filepath)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+
+    self.lock = Lock()
+    self.db_lock = Lock()
+    self.values = {}  # key -> JSON text
+    self.dirty = {}  # key -> JSON text, or None if deleted
+    self.timer = None
+    self.writer = None
+    self.sync_requested = Event()
+    self.closed = False
+
+    self.connection = sqlite3.connect(filepath, check_same_thread=False, isolation_level=None)
+    self.connection.execute('PRAGMA journal_mode=WAL')
+    self.connection.execute('PRAGMA synchronous=NORMAL')  # WAL commits are only synced at checkpoints
+    self.connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    for key, value in self.connection.execute('SELECT key, value FROM state'):
+      self.values[key] = value
+
+  def get(self, key, default=None):
+    with self.lock:
+      text = self.values.get(key, None)
+
+    return json.loads(text) if text is not None else default
+
+  def set(self, key, value, durable=False, background=False):
+    text = json.dumps(value, sort_keys=True)
+
+    with self.lock:
+      changed = self.values.get(key, None) != text
+      if changed:
+        self.values[key] = text
+        self.dirty[key] = text
+
+    self._changed(changed, durable, background)
+
+  def delete(self, key, durable=False, background=False):
+    with self.lock:
+      changed = key in self.values
+      if changed:
+        del self.values[key]
+        self.dirty[key] = None
+
+    self._changed(changed, durable, background)
+
+  def append(self, key, item, limit):
+    # Adds to a list value, keeping only the newest `limit` items
+    with self.lock:
+      text = self.values.get(key, None)
+      items = json.loads(text) if text is not None else []
+      items = (items + [item])[-limit:]
+
+      text = json.dumps(items, sort_keys=True)
+      self.values[key] = text
+      self.dirty[key] = text
+
+    self._changed(True, False)
+
+  def _changed(self, changed, durable, background=False):
+    if durable and background:
+      self._request_sync()
+    elif durable:
+      self.flush(durable=True)
+    elif changed:
+      with self.lock:
+        if self.timer is None:
+          self.timer = Timer(self.FLUSH_DELAY, self.flush)
+          self.timer.daemon = True
+          self.timer.start()
+
+  def _request_sync(self):
+    with self.lock:
+      if self.closed:
+        return
+
+      if self.writer is None:
+        self.writer = Thread(target=self._writer_loop, daemon=True, name='state-writer')
+        self.writer.start()
+
+    self.sync_requested.set()
+
+  def _writer_loop(self):
+    while True:
+      self.sync_requested.wait()
+      self.sync_requested.clear()
+
+      if self.closed:
+        return
+
+      self.flush(durable=True)
+
+  def flush(self, durable=False):
+    failed = False
+
+    # Taken before the dirty values, so that concurrent flushes commit them in the order they were made
+    with self.db_lock:
+      with self.lock:
+        dirty = self.dirty
+        self.dirty = {}
+
+        if self.timer is not None:
+          self.timer.cancel()
+          self.timer = None
+
+      if not dirty:
+        return
+
+      if durable:
+        self.connection.execute('PRAGMA synchronous=FULL')
+
+      try:
+        self.connection.execute('BEGIN')
+        for key, text in dirty.items():
+          if text is None:
+            self.connection.execute('DELETE FROM state WHERE key = ?', (key,))
+          else:
+            self.connection.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, text))
+        self.connection.execute('COMMIT')
+
+      except Exception as e:
+        print("Error writing state to {}: {}".format(self.filepath, str(e)))
+        if self.connection.in_transaction:
+          self.connection.execute('ROLLBACK')
+
+        with self.lock:
+          for key, text in dirty.items():
+            self.dirty.setdefault(key, text)
+        failed = True
+
+      finally:
+        if durable:
+          self.connection.execute('PRAGMA synchronous=NORMAL')
+
+    if failed:
+      self._changed(True, False)  # retried with the next flush
+
+  def close(self):
+    with self.lock:
+      self.closed = True
+      writer = self.writer
+
+    if writer is not None:
+      self.sync_requested.set()
+      writer.join()
+
+    self.flush(durable=True)
+
+    with self.db_lock:
+      self.connection.close()
+
+
+STORES = {}
+STORES_LOCK = Lock()
+
+
+def open_store(filepath=None):
+  # One store per file per process, so that every component shares the same cache and flush timer
+  filepath = os.path.abspath(filepath or StateStore.DEFAULT_FILEPATH)
+
+  with STORES_LOCK:
+    if filepath not in STORES:
+      STORES[filepath] = StateStore(filepath)
+
+    return STORES[filepath]
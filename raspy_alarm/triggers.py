@@ -0,0 +1,169 @@
+from threading import Thread
+
+import socketserver
+import traceback
+import hmac
+import json
+import time
+import os
+
+from commands import COMMANDS, CommandError
+from interface import Interface
+from metrics import METRICS
+
+
+# Triggers: interfaces that take commands straight from other programs on the Pi or the local network, e.g. an
+# alerting stack paging the sleeper, without an email round trip. They accept the same commands as the email
+# interface (see commands.py) in a JSON message
+#
+#   {"token": "...", "command": "wake up now"}
+#
+# and answer with
+#
+#   {"ok": true, "reply": "Emergency alarm started."}    or    {"ok": false, "error": "..."}
+#
+# WebhookInterface takes them as POSTs to /trigger on the web app (the token may also be given as an
+# "Authorization: Bearer ..." header), SocketInterface as newline-delimited JSON on a UNIX socket.
+
+
+class TriggerInterface(Interface):
+  # Commands are run on the thread that received them, so an alarm starts as soon as the request is read. The token
+  # allows "wake up now" and "cancel alarm"; schedule edits (see commands.py) also need `allow_edits`.
+  SIGNAL = 'trigger'  # sent to "signal" conditions whenever a command arrives
+
+  def __init__(self, token=None, wakeup_escalation=None, allow_edits=False):
+    self.scheduler = None
+    self.token = token
+    self.wakeup_escalation = wakeup_escalation
+    self.allow_edits = allow_edits
+
+  def authenticate(self, token):
+    # Compared as bytes, since compare_digest only takes ASCII strings
+    return self.token is None or (token is not None and hmac.compare_digest(str(token).encode('utf-8'), str(self.token).encode('utf-8')))
+
+  def _allowed(self, sender, permission):
+    return permission != 'edit' or self.allow_edits
+
+  def handle(self, message):
+    if not self.authenticate(message.get('token')):
+      METRICS.increment('trigger_rejected_total', interface=type(self).__name__)
+      return dict(ok=False, error='bad token')
+
+    if self.scheduler is None:
+      return dict(ok=False, error='not ready')
+
+    try:
+      invocation = COMMANDS.parse(str(message.get('command', '')))
+      if invocation is None:
+        return dict(ok=False, error='unknown command {}'.format(message.get('command')))
+
+      if not self._allowed(None, invocation.command.permission):
+        return dict(ok=False, error='not allowed: {}'.format(invocation.command.name))
+
+      print("{} command: {}".format(type(self).__name__, invocation.command.name))
+      with METRICS.timer('trigger_command_seconds', interface=type(self).__name__):
+        reply = invocation.run(self)
+
+    except CommandError as e:
+      return dict(ok=False, error=str(e))
+    except Exception as e:
+      traceback.print_exc()
+      return dict(ok=False, error=str(e))
+
+    # After the command, so that signal conditions never delay a wakeup
+    self._signal(self.SIGNAL)
+    return dict(ok=True, reply=reply)
+
+
+class WebhookInterface(TriggerInterface):
+  # Served by the web app's /trigger view (see views.py), so it needs `python main.py --web`. Anything that can reach
+  # the web app could start or cancel alarms, so a token is required.
+  SIGNAL = 'webhook'
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+
+    if not self.token:
+      raise ValueError("The webhook interface needs a token.")
+
+  def startup(self):
+    print("Webhook interface started.")
+
+  def shutdown(self):
+    print("  Shutting down webhook interface.")
+
+
+class _SocketHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    for line in self.rfile:
+      received = time.perf_counter()
+      try:
+        message = json.loads(line.decode('utf-8'))
+      except Exception as e:
+        response = dict(ok=False, error='bad message: {}'.format(str(e)))
+      else:
+        response = self.server.interface.handle(message if isinstance(message, dict) else {})
+
+      self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+      self.wfile.flush()
+      METRICS.observe('trigger_response_seconds', time.perf_counter() - received, interface='SocketInterface')
+
+
+class _SocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+class SocketInterface(TriggerInterface):
+  # Commands from local programs, e.g. `echo '{"command": "wake up now"}' | nc -U data/alarm.sock`. The socket is
+  # only accessible to this user by default (`mode`), which is enough without a token; a socket that others may use
+  # needs one.
+  SIGNAL = 'socket'
+  DEFAULT_PATH = os.path.join('data', 'alarm.sock')
+
+  def __init__(self, path=None, mode=0o600, **kwargs):
+    super().__init__(**kwargs)
+    self.path = path or self.DEFAULT_PATH
+    self.mode = mode
+
+    if not self.token and mode & 0o077:
+      raise ValueError("A socket interface that other users can reach (mode {:o}) needs a token.".format(mode))
+
+    self.server = None
+    self.thread = None
+
+  def startup(self):
+    directory = os.path.dirname(self.path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+
+    # Left behind if the alarm was killed
+    if os.path.exists(self.path):
+      os.unlink(self.path)
+
+    # Created owner-only, so that no other user can connect before the mode is applied
+    umask = os.umask(0o177)
+    try:
+      self.server = _SocketServer(self.path, _SocketHandler)
+    finally:
+      os.umask(umask)
+
+    self.server.interface = self
+    os.chmod(self.path, self.mode)
+
+    self.thread = Thread(target=self.server.serve_forever, daemon=True, name='socket-interface')
+    self.thread.start()
+    print("Socket interface listening on {}...".format(self.path))
+
+  def shutdown(self):
+    print("  Shutting down socket interface.")
+
+    # Taken first, so that a second or concurrent call finds nothing to shut down
+    server, self.server = self.server, None
+    if server:
+      server.shutdown()
+      server.server_close()
+
+      try:
+        os.unlink(self.path)
+      except FileNotFoundError as e:
+        pass
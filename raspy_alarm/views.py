@@ -1,4 +1,4 @@
-from flask import render_template, redirect, abort, url_for
+from flask import render_template, redirect, abort, url_for, request, jsonify, current_app, Response
 
 from . import app
 
@@ -20,3 +20,58 @@ def new_web_view(**kwargs):
   context = {}
 
   return render_template('home.html', **context)
+
+
+@app.route('/schedule', methods=['GET'])
+def schedule_view(**kwargs):
+  # Reads the scheduler's precomputed timeline, so this is cheap however many rules there are
+  scheduler = current_app.config.get('SCHEDULER', None)
+  if scheduler is None:
+    abort(404)
+
+  days = request.args.get('days', scheduler.TIMELINE_HORIZON.days, type=int)
+  upcoming = scheduler.upcoming(days)
+
+  if request.args.get('format') == 'json':
+    return jsonify([dict(datetime=dt.isoformat(), alarms={rouser_name: alarm_params.get('name') for rouser_name, alarm_params in params.items()}) for dt, params in upcoming])
+
+  context = dict(now=scheduler.now, days=days, upcoming=upcoming)
+  return render_template('schedule.html', **context)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view(**kwargs):
+  # Filled in by main.py when the web app runs alongside the alarm
+  metrics = current_app.config.get('METRICS', None)
+  if metrics is None:
+    abort(404)
+
+  if request.args.get('format') == 'json':
+    return jsonify(metrics.snapshot())
+
+  return Response(metrics.render_text(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/trigger', methods=['POST'])
+def trigger_view(**kwargs):
+  # Runs a command on the webhook interface (see triggers.py), filled in by main.py when `triggers` has a webhook
+  webhook = current_app.config.get('WEBHOOK', None)
+  if webhook is None:
+    abort(404)
+
+  message = dict(request.get_json(silent=True) or request.form.to_dict())
+  authorization = request.headers.get('Authorization', '')
+  if authorization.startswith('Bearer '):
+    message['token'] = authorization[len('Bearer '):]
+
+  response = webhook.handle(message)
+  if response['ok']:
+    status = 200
+  elif response['error'] == 'bad token':
+    status = 401
+  elif response['error'] == 'not ready':
+    status = 503
+  else:
+    status = 400
+
+  return jsonify(response), status
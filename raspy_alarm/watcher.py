@@ -0,0 +1,142 @@
+from threading import Thread
+
+import ctypes.util
+import ctypes
+import select
+import struct
+import time
+import os
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_libc():
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    libc.inotify_init1
+    libc.inotify_add_watch
+  except (OSError, AttributeError):
+    return None
+
+  return libc
+
+
+class FileWatcher(object):
+  # Calls `callback` whenever `filepath` is written or replaced; uses inotify where available and stat polling elsewhere
+  POLL_INTERVAL = 1
+
+  def __init__(self, filepath, callback):
+    self.filepath = os.path.abspath(filepath)
+    self.directory, self.filename = os.path.split(self.filepath)
+    self.callback = callback
+
+    self.mode = None
+    self.thread = None
+    self.running = False
+
+    self.inotify_fd = None
+    self.wake_pipe = None
+    self.last_stat = None
+
+  def _stat(self):
+    try:
+      stat = os.stat(self.filepath)
+    except FileNotFoundError as e:
+      return None
+
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+  def _setup_inotify(self):
+    libc = _load_libc()
+    if libc is None:
+      return False
+
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+      return False
+
+    # Watch the directory rather than the file so that atomic replacements (write to a temp file, then rename) are seen
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    if libc.inotify_add_watch(fd, os.fsencode(self.directory), mask) < 0:
+      os.close(fd)
+      return False
+
+    self.inotify_fd = fd
+    self.wake_pipe = os.pipe()
+    return True
+
+  def _inotify_loop(self):
+    filename = os.fsencode(self.filename)
+
+    while self.running:
+      readable, _, _ = select.select([self.inotify_fd, self.wake_pipe[0]], [], [])
+      if self.inotify_fd not in readable:
+        continue
+
+      try:
+        data = os.read(self.inotify_fd, 64 * 1024)
+      except BlockingIOError as e:
+        continue
+
+      changed = False
+      offset = 0
+      while offset < len(data):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        name = data[offset:offset + length].rstrip(b'\0')
+        offset += length
+
+        if name == filename:
+          changed = True
+
+      if changed:
+        self._notify()
+
+  def _poll_loop(self):
+    while self.running:
+      time.sleep(self.POLL_INTERVAL)
+
+      current_stat = self._stat()
+      if current_stat != self.last_stat:
+        self.last_stat = current_stat
+        self._notify()
+
+  def _notify(self):
+    try:
+      self.callback()
+    except Exception as e:
+      print("Error in file watcher callback: {}".format(str(e)))
+
+  def start(self):
+    self.running = True
+
+    if self._setup_inotify():
+      self.mode = 'inotify'
+      target = self._inotify_loop
+    else:
+      self.mode = 'poll'
+      self.last_stat = self._stat()
+      target = self._poll_loop
+
+    self.thread = Thread(target=target, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.running = False
+
+    if self.wake_pipe:
+      os.write(self.wake_pipe[1], b'\0')
+      self.thread.join()
+
+      os.close(self.inotify_fd)
+      for fd in self.wake_pipe:
+        os.close(fd)
+
+      self.inotify_fd = None
+      self.wake_pipe = None
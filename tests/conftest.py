@@ -0,0 +1,36 @@
+import sys
+import os
+
+import pytest
+
+# Modules in raspy_alarm import each other by their plain names, as when running main.py from that directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'raspy_alarm'))
+
+from backends import SimulatedBackend  # noqa
+from rouser import Rouser  # noqa
+
+
+class ManualBackend(SimulatedBackend):
+  # A simulated backend whose clock only moves when a test advances it
+  def __init__(self):
+    super().__init__()
+    self.now = 1000000.0
+
+  def time(self):
+    return self.now
+
+  def advance(self, seconds):
+    self.now += seconds
+
+
+@pytest.fixture
+def backend():
+  return ManualBackend()
+
+
+@pytest.fixture(autouse=True)
+def fresh_rousers(monkeypatch):
+  # Rousers share their pins through class attributes, so every test gets its own
+  monkeypatch.setattr(Rouser, 'OUTPUTS', {})
+  monkeypatch.setattr(Rouser, 'INPUTS', {})
+  monkeypatch.setattr(Rouser, 'INSTANCES', [])
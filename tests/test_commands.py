@@ -0,0 +1,177 @@
+import email
+import json
+
+import pytest
+
+from commands import COMMANDS, CommandError
+from interface import EmailInterface
+from scheduler import Scheduler
+
+
+class FakeOutbox(object):
+  def add_account(self, account, connect):
+    pass
+
+
+class FakeConnections(object):
+  outbox = FakeOutbox()
+
+
+class RecordingRouser(object):
+  def __init__(self, name):
+    self.name = name
+    self.calls = []
+
+  def start_alarm(self, name=None, **params):
+    self.calls.append(('start', name))
+
+  def stop_alarm(self, reason='canceled'):
+    self.calls.append(('stop', reason))
+
+  def signal(self, name):
+    self.calls.append(('signal', name))
+
+
+class RecordingInterface(EmailInterface):
+  def __init__(self, **kwargs):
+    super().__init__(connections=FakeConnections(), **kwargs)
+    self.sent = []
+
+  def _send_email(self, subject, content, from_addr=None, to_addrs=None):
+    self.sent.append((subject, content, sorted(filter(None, to_addrs or []))))
+
+
+def message(sender, subject):
+  return email.message_from_string('From: {}\nTo: alarm@example.com\nSubject: {}\n\n'.format(sender, subject))
+
+
+@pytest.fixture
+def schedule_file(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  path = tmp_path / 'schedule_rules.json'
+  path.write_text(json.dumps(dict(
+    timezone='UTC',
+    rrule_sets=[dict(rrules=[dict(freq='daily', byhour=7, byminute=30)], parameters=dict(bed=dict(name='daily')))],
+  )))
+  return path
+
+
+@pytest.fixture
+def setup(schedule_file, tmp_path):
+  from state import StateStore
+
+  rouser = RecordingRouser('bed')
+  interface = RecordingInterface(
+    address='alarm@example.com', password='', main_contacts=['main@example.com'],
+    wakeup_whitelist=['waker@example.com', 'editor@example.com'], edit_whitelist=['editor@example.com'],
+    state=StateStore(str(tmp_path / 'state.sqlite3')),
+  )
+  scheduler = Scheduler('schedule_rules.json', rousers=[rouser], interfaces=[interface])
+  with scheduler.condition:
+    scheduler._step()
+
+  return scheduler, interface, rouser
+
+
+def test_parse_is_case_and_space_insensitive():
+  invocation = COMMANDS.parse('  Wake   UP now ', 'someone@example.com')
+  assert invocation.command.name == 'wake up now'
+  assert invocation.args == ()
+
+  assert COMMANDS.parse('wake up now please') is None
+  assert COMMANDS.parse('hello') is None
+  assert COMMANDS.parse('') is None
+
+
+def test_parse_arguments():
+  assert COMMANDS.parse('skip next').args == ('next',)
+  assert COMMANDS.parse('skip 2030-01-02 07:30').args == ((2030, 1, 2, 7, 30),)
+  assert COMMANDS.parse('add alarm 06:15 bed kitchen').args == ((None, None, None, 6, 15), ('bed', 'kitchen'))
+
+  with pytest.raises(CommandError):
+    COMMANDS.parse('skip tomorrow')
+
+  with pytest.raises(CommandError):
+    COMMANDS.parse('unskip 24:00')
+
+
+def test_batch_merges_repeats_until_another_change():
+  invocations = [COMMANDS.parse(text, sender) for text, sender in [
+    ('wake up now', 'a'), ('wake up now', 'b'), ('wake up now', 'a'),
+    ('help', 'a'), ('help', 'a'), ('help', 'b'),
+    ('cancel alarm', 'a'), ('wake up now', 'c'),
+  ]]
+
+  batch = COMMANDS.batch(invocations)
+
+  assert [(invocation.command.name, invocation.senders) for invocation in batch] == [
+    ('wake up now', ['a', 'b']), ('help', ['a']), ('help', ['b']), ('cancel alarm', ['a']), ('wake up now', ['c']),
+  ]
+
+
+def test_flood_of_wake_ups_runs_once(setup):
+  scheduler, interface, rouser = setup
+  interface._handle_emails([message('waker@example.com', 'wake up now')] * 50 + [message('stranger@example.com', 'wake up now')])
+
+  assert rouser.calls == [('signal', 'email'), ('start', 'wake up now')]
+  assert interface.sent == [('Re: wake up now', 'Emergency alarm started.', ['main@example.com', 'waker@example.com'])]
+
+
+def test_edit_commands_need_the_edit_whitelist(setup, schedule_file):
+  scheduler, interface, rouser = setup
+  interface._handle_emails([message('waker@example.com', 'skip next')])
+
+  assert 'exceptions' not in json.loads(schedule_file.read_text())
+  assert interface.sent == []
+
+
+def test_skip_and_unskip(setup, schedule_file):
+  scheduler, interface, rouser = setup
+  first = scheduler.upcoming()[0][0]
+
+  interface._handle_emails([message('editor@example.com', 'skip next')])
+  assert json.loads(schedule_file.read_text())['exceptions']['exclude'] == [
+    dict(year=first.year, month=first.month, day=first.day, hour=7, minute=30, second=0),
+  ]
+
+  with scheduler.condition:
+    scheduler._step()
+  assert first not in [dt for dt, _ in scheduler.upcoming()]
+
+  interface._handle_emails([message('editor@example.com', first.strftime('unskip %Y-%m-%d %H:%M'))])
+  with scheduler.condition:
+    scheduler._step()
+  assert scheduler.upcoming()[0][0] == first
+
+
+def test_add_and_remove_alarm(setup, schedule_file):
+  scheduler, interface, rouser = setup
+  interface._handle_emails([message('editor@example.com', 'add alarm 2030-01-02 06:15 BED')])
+
+  inclusions = json.loads(schedule_file.read_text())['exceptions']['include']
+  assert inclusions == [dict(datetime=dict(year=2030, month=1, day=2, hour=6, minute=15, second=0), parameters=dict(bed=dict(name='added alarm')))]
+
+  interface._handle_emails([message('editor@example.com', 'remove alarm 2030-01-02 06:15')])
+  assert json.loads(schedule_file.read_text())['exceptions']['include'] == []
+
+
+def test_errors_are_answered_instead_of_raised(setup, schedule_file):
+  scheduler, interface, rouser = setup
+  schedule_file.write_text('{not json')
+
+  interface._handle_emails([message('editor@example.com', 'skip 07:30'), message('waker@example.com', 'wake up now')])
+
+  assert schedule_file.read_text() == '{not json'
+  assert "isn't valid JSON" in interface.sent[0][1]
+  assert rouser.calls[-1] == ('start', 'wake up now')
+
+
+def test_unexpected_errors_are_answered_too(setup):
+  scheduler, interface, rouser = setup
+  interface.wakeup_escalation = 'missing_policy'
+
+  interface._handle_emails([message('waker@example.com', 'wake up now'), message('waker@example.com', 'schedule')])
+
+  assert interface.sent[0][0] == 'Re: wake up now'
+  assert interface.sent[0][1].startswith('Error:')
+  assert interface.sent[1][0] == 'Re: schedule'
@@ -0,0 +1,81 @@
+from conditions import CompiledConditions, NeverMatcher, compile_condition
+
+
+def test_long_press_matches_while_held_and_after_release():
+  matcher = compile_condition(dict(type='long_press', seconds=3), [17])
+
+  matcher.on_press(17, 100)
+  assert not matcher.matches(102)
+  assert matcher.next_deadline(102) == 103
+  assert matcher.matches(103)
+
+  matcher.reset(110)
+  matcher.on_press(17, 110)
+  matcher.on_release(17, 111)
+  assert not matcher.matches(120)
+
+  matcher.on_press(17, 120)
+  matcher.on_release(17, 123.5)
+  assert matcher.matches(124)
+
+
+def test_matchers_only_watch_their_pins():
+  matcher = compile_condition(dict(type='long_press', seconds=1, pins=[27]), [17, 27])
+
+  matcher.on_press(17, 0)
+  assert not matcher.matches(5)
+  assert matcher.next_deadline(5) is None
+
+
+def test_presses_within_a_window():
+  matcher = compile_condition(dict(type='presses', count=3, within=5), [17])
+
+  for timestamp in (0, 4, 8):
+    matcher.on_press(17, timestamp)
+  assert not matcher.matches(8)
+
+  matcher.on_press(17, 9)
+  assert matcher.matches(9)
+
+
+def test_sequence_of_short_and_long_presses():
+  matcher = compile_condition(dict(type='sequence', pattern=['short', 'long'], long=1, within=10), [17])
+
+  for press, release in ((0, 2), (3, 3.2)):
+    matcher.on_press(17, press)
+    matcher.on_release(17, release)
+  assert not matcher.matches(4)
+
+  matcher.on_press(17, 5)
+  matcher.on_release(17, 6.5)
+  assert matcher.matches(7)
+
+
+def test_signals_and_bad_specs():
+  email = compile_condition(dict(type='email'), [])
+  webhook = compile_condition(dict(type='signal', name='webhook'), [])
+
+  email.on_signal('webhook', 0)
+  webhook.on_signal('webhook', 0)
+  assert not email.matches(0) and webhook.matches(0)
+
+  assert isinstance(compile_condition(dict(type='nonsense'), []), NeverMatcher)
+  assert isinstance(compile_condition(dict(type='presses'), []), NeverMatcher)
+
+
+def test_compiled_conditions_are_alternatives_of_all_of():
+  conditions = CompiledConditions([
+    [dict(type='email'), dict(type='presses', count=1)],
+    [lambda current_time, input_pins, INPUTS: current_time > 100],
+  ], [17])
+  assert conditions.needs_polling
+
+  conditions.on_signal('email', 0)
+  assert not conditions.evaluate(50, [17], {})
+
+  conditions.on_press(17, 1)
+  assert conditions.evaluate(50, [17], {})
+
+  conditions.reset(60)
+  assert not conditions.evaluate(60, [17], {})
+  assert conditions.evaluate(101, [17], {})
@@ -0,0 +1,93 @@
+import threading
+import os
+
+import pytest
+
+from connections import ConnectionManager
+
+
+class FakeMailboxInterface(object):
+  # Stands in for an EmailInterface whose server lacks IDLE, so its mailbox is polled
+  IDLE_TIMEOUT = 60
+  IDLE_RETRY_DELAY = 60
+
+  def __init__(self, address, release=None):
+    self.email_address = address
+    self.imap_server = None
+    self.release = release  # reads wait for this, like a server that has stopped responding
+    self.reads = 0
+    self.read = threading.Event()
+
+  def _setup_imap(self):
+    self.imap_server = object()
+
+  def _read_email(self):
+    self.reads += 1
+    self.read.set()
+
+    if self.release is not None:
+      self.release.wait(10)
+
+  def _supports_idle(self):
+    return False
+
+  def _teardown_imap(self):
+    self.imap_server = None
+
+
+@pytest.fixture
+def manager(monkeypatch):
+  manager = ConnectionManager()
+  manager.POLL_INTERVAL = 0.01
+
+  def no_network():
+    raise OSError('network is unreachable')
+
+  monkeypatch.setattr(manager, '_current_ip_address', no_network)
+  return manager
+
+
+def test_a_stuck_mailbox_does_not_hold_up_the_others(manager):
+  release = threading.Event()
+  stuck = FakeMailboxInterface('stuck@example.com', release)
+  working = FakeMailboxInterface('working@example.com')
+
+  manager.register(stuck)
+  manager.register(working)
+
+  try:
+    assert stuck.read.wait(5)
+    for _ in range(3):
+      working.read.clear()
+      assert working.read.wait(5)
+
+    assert stuck.reads == 1
+  finally:
+    release.set()
+
+  manager.unregister(stuck)
+  manager.unregister(working)
+
+  assert stuck.imap_server is None and working.imap_server is None
+  assert manager.stopped.is_set()
+
+
+def test_shutdown_closes_the_wake_pipe(manager):
+  interface = FakeMailboxInterface('alarm@example.com')
+  manager.register(interface)
+  assert interface.read.wait(5)
+
+  wake_pipe = manager.wake_pipe
+  manager.unregister(interface)
+
+  assert manager.wake_pipe is None
+  for fd in wake_pipe:
+    with pytest.raises(OSError):
+      os.fstat(fd)
+
+  manager._wake()  # e.g. a worker finishing late
+
+
+def test_shutdown_without_mailboxes_closes_the_wake_pipe(manager):
+  manager.shutdown()
+  assert manager.wake_pipe is None
@@ -0,0 +1,68 @@
+from escalation import Escalator
+from interface import Interface
+from rouser import Rouser
+
+
+POLICIES = {
+  'on_call': [
+    {'rousers': ['bedroom'], 'pattern': {'type': 'on'}, 'deadline': 60},
+    {'rousers': ['bedroom', 'living_room'], 'deadline': 60},
+  ],
+}
+
+
+class FakeScheduler(object):
+  def __init__(self, rousers):
+    self.rousers = {rouser.name: rouser for rouser in rousers}
+
+
+def make_escalator(backend):
+  rousers = [Rouser('bedroom', [17], [27], backend=backend), Rouser('living_room', [18], [28], backend=backend)]
+  escalator = Escalator(rousers, POLICIES, backend=backend)
+  return escalator, {rouser.name: rouser for rouser in rousers}
+
+
+def test_unanswered_escalation_leaves_rousers_ringing(backend):
+  # Escalator methods normally run on the timer wheel's thread; calling them directly keeps the test synchronous
+  escalator, rousers = make_escalator(backend)
+  escalator._start('on_call', 'pager', None)
+  escalation = escalator.escalations['on_call']
+
+  escalator._deadline(escalation)
+  assert rousers['living_room'].alarm['name'] == 'pager'
+
+  escalator._deadline(escalation)
+  assert 'on_call' not in escalator.escalations
+  assert rousers['bedroom'].alarm['name'] == 'pager'
+  assert rousers['living_room'].alarm['name'] == 'pager'
+  escalator.shutdown()
+
+
+def test_answered_escalation_stops_the_other_rousers(backend):
+  escalator, rousers = make_escalator(backend)
+  escalator._start('on_call', 'pager', None)
+  escalator._deadline(escalator.escalations['on_call'])
+
+  rousers['bedroom'].stop_alarm(reason='stopped')
+  escalator._handle_stop('bedroom', 'pager', 'stopped')
+
+  assert 'on_call' not in escalator.escalations
+  assert rousers['living_room'].alarm['name'] is None
+  escalator.shutdown()
+
+
+def test_wake_up_skips_escalation_policies(backend):
+  escalator, rousers = make_escalator(backend)
+  started = []
+  escalator.start = lambda policy, name=None, timezone=None: started.append(policy)
+
+  interface = Interface()
+  interface.scheduler = FakeScheduler(list(rousers.values()) + escalator.policy_rousers())
+  interface._wake_up()
+
+  assert started == []
+  assert all(rouser.alarm['name'] == 'wake up now' for rouser in rousers.values())
+
+  interface._wake_up('on_call')
+  assert started == ['on_call']
+  escalator.shutdown()
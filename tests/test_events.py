@@ -0,0 +1,34 @@
+import math
+
+from events import EventBuffer
+
+
+def test_event_buffer_records_presses_and_releases():
+  events = EventBuffer(capacity=4)
+  events.press(1)
+  events.release(2)
+  events.press(5)
+
+  assert list(events) == [[1, 2], [5]]
+  assert len(events) == 2
+  assert events[-1] == [5]
+
+  events.release(7)
+  assert events[-1] == [5, 7]
+
+
+def test_event_buffer_overwrites_the_oldest_events():
+  events = EventBuffer(capacity=3)
+  for timestamp in range(5):
+    events.press(timestamp)
+    events.release(timestamp + 0.5)
+
+  assert len(events) == 3
+  assert events[0] == [2, 2.5]
+  assert events[-1] == [4, 4.5]
+  assert events[1:] == [[3, 3.5], [4, 4.5]]
+
+  # A release without a press, or a second release, changes nothing
+  events.release(10)
+  assert events[-1] == [4, 4.5]
+  assert math.isnan(EventBuffer().release_times[0])
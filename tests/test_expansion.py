@@ -0,0 +1,101 @@
+import datetime
+import json
+
+from dateutil import tz
+
+import pytest
+
+from scheduler import Scheduler
+
+np = pytest.importorskip('numpy')
+
+
+class NullRouser(object):
+  def __init__(self, name):
+    self.name = name
+
+  def start_alarm(self, name=None, **params):
+    pass
+
+
+RULE_SETS = [
+  # Weekday mornings, with one day excluded below
+  dict(rrules=[dict(freq='daily', byweekday=['mo', 'tu', 'we', 'th', 'fr'], byhour=7, byminute=30)], parameters=dict(bed=dict(name='weekdays'))),
+  # 01:30 happens twice when the clocks go back and 02:30 not at all when they go forward
+  dict(rrules=[dict(freq='daily', byhour=[1, 2], byminute=30)], parameters=dict(bed=dict(name='night'), hall=dict(name='night'))),
+  dict(rrules=[dict(freq='monthly', bymonthday=[1, 15], bymonth=['jan', 'jun', 'dec'], byhour=9)], parameters=dict(hall=dict(name='monthly'))),
+  dict(rrules=[dict(freq='minutely', interval=20, byhour=6, byweekday='sa')], parameters=dict(hall=dict(name='saturdays'))),
+  dict(rrules=[dict(freq='weekly', interval=2, byweekday='we', byhour=20)], exdates=[dict(year=2027, month=6, day=9, hour=20, minute=0, second=0)], parameters=dict(bed=dict(name='fortnightly'))),
+  # Not a plain grid, so expanded by rrule.between
+  dict(rrules=[dict(freq='monthly', byweekday=[['su', -1]], byhour=10)], parameters=dict(bed=dict(name='last sunday'))),
+]
+EXCLUDED = dict(year=2027, month=7, day=5, hour=7, minute=30, second=0)
+INCLUDED = dict(year=2027, month=8, day=1, hour=5, minute=0, second=0)
+
+
+@pytest.fixture
+def scheduler(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  (tmp_path / 'schedule_rules.json').write_text(json.dumps(dict(
+    timezone='America/New_York',
+    rrule_sets=RULE_SETS,
+    exceptions=dict(include=[dict(datetime=INCLUDED, parameters=dict(hall=dict(name='once')))], exclude=[EXCLUDED]),
+  )))
+
+  scheduler = Scheduler('schedule_rules.json', rousers=[NullRouser('bed'), NullRouser('hall')])
+  scheduler._check_schedule()
+  return scheduler
+
+
+def expected(scheduler, start, end):
+  # The same alarms by walking each rrule set one occurrence at a time
+  per_rouser = {}
+
+  for index, alarm_config in enumerate(scheduler.cached_rrsets):
+    for dt in scheduler._rrule_set(index).between(start, end, inc=True):
+      if dt not in scheduler.cached_exclusions:
+        for rouser_name in alarm_config['params']:
+          per_rouser.setdefault(rouser_name, set()).add(int(dt.timestamp()))
+
+  for inclusion in scheduler.cached_inclusions:
+    if start <= inclusion['datetime'] <= end:
+      for rouser_name in inclusion['params']:
+        per_rouser.setdefault(rouser_name, set()).add(int(inclusion['datetime'].timestamp()))
+
+  return {rouser_name: sorted(timestamps) for rouser_name, timestamps in per_rouser.items()}
+
+
+def as_timestamps(expanded):
+  return {rouser_name: occurrences.astype(np.int64).tolist() for rouser_name, occurrences in expanded.items()}
+
+
+def test_expand_matches_rrule_over_a_year(scheduler):
+  new_york = tz.gettz('America/New_York')
+  start = datetime.datetime(2027, 1, 1, tzinfo=new_york)
+  end = datetime.datetime(2028, 1, 1, tzinfo=new_york)
+
+  expanded = as_timestamps(scheduler.expand(start, end))
+
+  assert expanded == expected(scheduler, start, end)
+  assert len(expanded['bed']) > 600
+
+
+def test_expand_includes_both_ends(scheduler):
+  new_york = tz.gettz('America/New_York')
+  start = datetime.datetime(2027, 7, 6, 7, 30, tzinfo=new_york)
+  end = datetime.datetime(2027, 7, 7, 7, 30, tzinfo=new_york)
+
+  expanded = as_timestamps(scheduler.expand(start, end))
+
+  assert expanded == expected(scheduler, start, end)
+  assert expanded['bed'][0] == int(start.timestamp())
+  assert expanded['bed'][-1] == int(end.timestamp())
+
+
+def test_excluded_and_included_alarms(scheduler):
+  new_york = tz.gettz('America/New_York')
+  expanded = as_timestamps(scheduler.expand(datetime.datetime(2027, 7, 1, tzinfo=new_york), datetime.datetime(2027, 8, 31, tzinfo=new_york)))
+
+  assert int(datetime.datetime(2027, 7, 5, 7, 30, tzinfo=new_york).timestamp()) not in expanded['bed']
+  assert int(datetime.datetime(2027, 7, 6, 7, 30, tzinfo=new_york).timestamp()) in expanded['bed']
+  assert int(datetime.datetime(2027, 8, 1, 5, 0, tzinfo=new_york).timestamp()) in expanded['hall']
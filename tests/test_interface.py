@@ -0,0 +1,242 @@
+import socketserver
+import threading
+import socket
+import time
+import re
+
+import pytest
+
+from interface import EmailInterface
+from state import StateStore
+
+
+class FakeOutbox(object):
+  def add_account(self, account, connect):
+    pass
+
+
+class FakeConnections(object):
+  outbox = FakeOutbox()
+
+  def context(self):
+    return None
+
+
+class SilentHandler(socketserver.BaseRequestHandler):
+  # Accepts the connection and never says anything, like a server that has stopped responding
+  def handle(self):
+    self.server.stopped.wait(10)
+
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+  # Just enough IMAP4rev1 with IDLE for the email interface: the mailbox is `server.messages`, whose UIDs are their
+  # positions counting from 1
+  def write(self, line):
+    self.wfile.write(line.encode('utf-8') + b'\r\n')
+    self.wfile.flush()
+
+  def handle(self):
+    self.write('* OK fake IMAP ready')
+
+    for line in self.rfile:
+      tag, command, *args = line.decode('utf-8').strip().split(' ')
+      command = command.upper()
+      messages = self.server.messages
+
+      if command == 'CAPABILITY':
+        self.write('* CAPABILITY IMAP4rev1 IDLE')
+      elif command == 'SELECT':
+        self.write('* {} EXISTS'.format(len(messages)))
+        self.write('* OK [UIDVALIDITY {}] UIDs valid'.format(self.server.uid_validity))
+      elif command == 'UID' and args[0].upper() == 'SEARCH':
+        first = re.search(r'UID (\d+):\*', ' '.join(args))
+        uids = list(range(int(first.group(1)) if first else 1, len(messages) + 1))
+        if first and not uids and messages:
+          uids = [len(messages)]  # n:* always matches the newest message
+        self.write('* SEARCH {}'.format(' '.join(map(str, uids))).rstrip())
+      elif command == 'UID' and args[0].upper() == 'FETCH':
+        self.server.fetches.append(args[1])
+        for uid in map(int, args[1].split(',')):
+          headers = messages[uid - 1].encode('utf-8')
+          literal = 'BODY[HEADER.FIELDS (FROM TO SUBJECT)] {{{}}}\r\n'.format(len(headers)).encode('utf-8') + headers
+
+          if self.server.uid_placement == 'before':
+            response = 'UID {} '.format(uid).encode('utf-8') + literal
+          elif self.server.uid_placement == 'after':
+            response = literal + ' UID {}'.format(uid).encode('utf-8')
+          else:
+            response = literal  # a broken server
+
+          self.wfile.write('* {} FETCH ('.format(uid).encode('utf-8') + response + b')\r\n')
+      elif command == 'IDLE':
+        self.write('+ idling')
+        self.server.idler = self
+        self.server.idling.set()
+        done = self.rfile.readline()
+        self.server.idling.clear()
+        if done.strip() != b'DONE':
+          return
+      elif command == 'LOGOUT':
+        self.write('* BYE')
+        self.write('{} OK bye'.format(tag))
+        return
+      elif command not in ('LOGIN', 'NOOP'):
+        self.write('{} BAD unknown command'.format(tag))
+        continue
+
+      self.write('{} OK done'.format(tag))
+
+
+class Server(socketserver.ThreadingTCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+
+
+@pytest.fixture
+def silent_server():
+  server = Server(('127.0.0.1', 0), SilentHandler)
+  server.stopped = threading.Event()
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  yield server.server_address[1]
+
+  server.stopped.set()
+  server.shutdown()
+  server.server_close()
+
+
+class FakeImapServer(Server):
+  def __init__(self):
+    super().__init__(('127.0.0.1', 0), FakeImapHandler)
+    self.messages = []  # header blocks
+    self.uid_validity = 7
+    self.fetches = []  # the UID sets that were fetched
+    self.uid_placement = 'before'  # where FETCH responses give the UID: 'before' or 'after' the headers, or None
+    self.idling = threading.Event()
+    self.idler = None
+
+  def announce(self, line):
+    # An untagged response to the client that is idling
+    self.idler.write(line)
+
+
+@pytest.fixture
+def imap_server():
+  server = FakeImapServer()
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  yield server
+
+  server.shutdown()
+  server.server_close()
+
+
+def headers(sender, subject):
+  return 'From: {}\r\nTo: alarm@example.com\r\nSubject: {}\r\n\r\n'.format(sender, subject)
+
+
+class RecordingInterface(EmailInterface):
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.handled = []
+
+  def _handle_emails(self, emails):
+    self.handled.append([message['Subject'] for message in emails])
+
+
+def make_interface(port, tmp_path, interface_class=EmailInterface, **kwargs):
+  return interface_class(
+    address='alarm@example.com', password='secret', main_contacts=['main@example.com'],
+    wakeup_whitelist=[], edit_whitelist=[], imap_server='127.0.0.1', imap_port=port, imap_ssl=False,
+    connections=FakeConnections(), state=StateStore(str(tmp_path / 'state.sqlite3')), **kwargs
+  )
+
+
+def test_unresponsive_imap_server_times_out(silent_server, tmp_path):
+  interface = make_interface(silent_server, tmp_path)
+  interface.NETWORK_TIMEOUT = 0.2
+
+  started = time.monotonic()
+  with pytest.raises(socket.timeout):
+    interface._setup_imap()
+
+  assert time.monotonic() - started < 5
+
+
+def test_fetches_only_new_messages_by_uid(imap_server, tmp_path):
+  imap_server.messages += [headers('a@example.com', 'help'), headers('b@example.com', 'schedule')]
+  interface = make_interface(imap_server.server_address[1], tmp_path, RecordingInterface)
+
+  interface._setup_imap()
+  interface._read_email()
+  interface._read_email()  # nothing new
+
+  imap_server.messages.append(headers('c@example.com', 'wake up now'))
+  interface._read_email()
+  interface._teardown_imap()
+
+  assert interface.handled == [['help', 'schedule'], ['wake up now']]
+  assert imap_server.fetches == ['1,2', '3']
+  assert interface.state.get('email/alarm_example') == dict(uid_validity=7, latest_uid=4)
+
+
+def test_uid_may_follow_the_headers(imap_server, tmp_path):
+  imap_server.uid_placement = 'after'
+  imap_server.messages += [headers('a@example.com', 'help'), headers('b@example.com', 'schedule')]
+  interface = make_interface(imap_server.server_address[1], tmp_path, RecordingInterface)
+
+  interface._setup_imap()
+  interface._read_email()
+  interface._teardown_imap()
+
+  assert interface.handled == [['help', 'schedule']]
+
+
+def test_messages_without_a_uid_are_skipped(imap_server, tmp_path):
+  imap_server.uid_placement = None
+  imap_server.messages += [headers('a@example.com', 'help')]
+  interface = make_interface(imap_server.server_address[1], tmp_path, RecordingInterface)
+
+  interface._setup_imap()
+  interface._read_email()
+  interface._teardown_imap()
+
+  assert interface.handled == [[]]
+  assert interface.state.get('email/alarm_example')['latest_uid'] == 2
+
+
+def test_new_uidvalidity_skips_the_existing_mailbox(imap_server, tmp_path):
+  imap_server.messages += [headers('a@example.com', 'help')]
+  interface = make_interface(imap_server.server_address[1], tmp_path, RecordingInterface)
+  interface.state.set('email/alarm_example', dict(uid_validity=6, latest_uid=40))
+
+  interface._setup_imap()
+  interface._read_email()
+  imap_server.messages.append(headers('a@example.com', 'schedule'))
+  interface._read_email()
+  interface._teardown_imap()
+
+  assert interface.handled == [['schedule']]
+
+
+def test_idle_reports_new_mail(imap_server, tmp_path):
+  interface = make_interface(imap_server.server_address[1], tmp_path, RecordingInterface)
+  interface._setup_imap()
+  interface._read_email()
+  assert interface._supports_idle()
+
+  interface._start_idle()
+  assert imap_server.idling.wait(5)
+  assert interface.imap_server.socket().gettimeout() == interface.NETWORK_TIMEOUT
+
+  imap_server.announce('* 0 RECENT')
+  assert not interface._read_idle()
+
+  imap_server.messages.append(headers('a@example.com', 'wake up now'))
+  imap_server.announce('* 1 EXISTS')
+  assert interface._read_idle()
+
+  # Ending IDLE leaves the connection usable for the fetch
+  interface._stop_idle()
+  interface._read_email()
+  interface._teardown_imap()
+
+  assert interface.handled == [['wake up now']]
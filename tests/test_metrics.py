@@ -0,0 +1,59 @@
+import pytest
+
+from metrics import Histogram, Metrics
+
+
+def test_histogram_buckets_are_cumulative():
+  histogram = Histogram((0.1, 1))
+  for value in (0.05, 0.1, 0.5, 3):
+    histogram.observe(value)
+
+  snapshot = histogram.snapshot()
+  assert snapshot['buckets'] == [(0.1, 2), (1, 3)]
+  assert snapshot['count'] == 4
+  assert snapshot['sum'] == pytest.approx(3.65)
+  assert snapshot['max'] == 3
+
+
+def test_render_text_is_prometheus_exposition():
+  metrics = Metrics()
+  metrics.set_buckets('alarm_lateness_seconds', (0.5, 1))
+  metrics.increment('alarms_fired_total')
+  metrics.increment('alarms_fired_total')
+  metrics.increment('commands_total', command='wake up now')
+  metrics.observe('alarm_lateness_seconds', 0.25)
+  metrics.observe('alarm_lateness_seconds', 2)
+
+  assert metrics.render_text() == '\n'.join([
+    '# TYPE alarms_fired_total counter',
+    'alarms_fired_total 2',
+    '# TYPE commands_total counter',
+    'commands_total{command="wake up now"} 1',
+    '# TYPE alarm_lateness_seconds histogram',
+    'alarm_lateness_seconds_bucket{le="0.5"} 1',
+    'alarm_lateness_seconds_bucket{le="1.0"} 1',
+    'alarm_lateness_seconds_bucket{le="+Inf"} 2',
+    'alarm_lateness_seconds_sum 2.25',
+    'alarm_lateness_seconds_count 2',
+  ]) + '\n'
+
+
+def test_label_values_are_escaped():
+  metrics = Metrics()
+  metrics.increment('trigger_rejected_total', interface='say "hi"\\')
+
+  assert 'trigger_rejected_total{interface="say \\"hi\\"\\\\"} 1' in metrics.render_text()
+
+
+def test_timer_observes_even_when_the_block_raises():
+  metrics = Metrics()
+
+  with pytest.raises(ValueError):
+    with metrics.timer('schedule_reload_seconds'):
+      raise ValueError('bad schedule')
+
+  histograms = metrics.snapshot()['histograms']
+  assert [(histogram['name'], histogram['count']) for histogram in histograms] == [('schedule_reload_seconds', 1)]
+
+  metrics.reset()
+  assert metrics.snapshot() == dict(counters=[], histograms=[])
@@ -0,0 +1,120 @@
+import time
+
+import pytest
+
+from outbox import Outbox
+
+
+class FakeSMTP(object):
+  def __init__(self, sent, failures):
+    self.sent = sent
+    self.failures = failures
+    self.closed = False
+    self.attempts = []
+
+  def send_message(self, message, from_addr, to_addrs):
+    self.attempts.append(time.monotonic())
+    if self.failures:
+      self.failures.pop()
+      raise OSError('connection reset')
+
+    self.sent.append((message['Subject'], message.get_payload(), sorted(to_addrs)))
+
+  def noop(self):
+    return 250, b''
+
+  def quit(self):
+    self.closed = True
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+  monkeypatch.setattr(Outbox, 'COALESCE_DELAY', 0.05)
+  monkeypatch.setattr(Outbox, 'RETRY_DELAY', 0.01)
+
+  sent = []
+  failures = []
+  connections = []
+
+  def connect():
+    connections.append(FakeSMTP(sent, failures))
+    return connections[-1]
+
+  outbox = Outbox(connect, name='test')
+  outbox.start()
+  yield outbox, sent, failures, connections
+
+  outbox.shutdown()
+
+
+def wait_for(predicate, timeout=5):
+  deadline = time.time() + timeout
+  while not predicate() and time.time() < deadline:
+    time.sleep(0.01)
+
+  return predicate()
+
+
+def test_messages_close_together_are_merged(outbox):
+  outbox, sent, failures, connections = outbox
+
+  outbox.send('Re: wake up now', 'Emergency alarm started.', 'alarm@example.com', ['b@example.com', 'a@example.com'])
+  outbox.send('Re: wake up now', 'Emergency alarm started.', 'alarm@example.com', ['a@example.com', 'b@example.com'])
+  outbox.send('Re: wake up now', 'Sent twice.', 'alarm@example.com', ['a@example.com', 'b@example.com'])
+  outbox.send('Re: help', 'The commands.', 'alarm@example.com', ['a@example.com'])
+
+  assert wait_for(lambda: len(sent) == 2)
+  assert sorted(sent) == [
+    ('Re: help', 'The commands.', ['a@example.com']),
+    ('Re: wake up now', 'Emergency alarm started.\n\nSent twice.', ['a@example.com', 'b@example.com']),
+  ]
+  assert len(connections) == 1  # reused
+
+
+def test_failed_sends_are_retried_on_a_new_connection(outbox):
+  outbox, sent, failures, connections = outbox
+  failures += ['reset', 'reset']
+
+  outbox.send('Alarm started and ready', 'ip address: 10.0.0.2', 'alarm@example.com', ['main@example.com'])
+
+  assert wait_for(lambda: sent)
+  assert sent == [('Alarm started and ready', 'ip address: 10.0.0.2', ['main@example.com'])]
+  assert len(connections) == 3
+  assert connections[0].closed and connections[1].closed
+
+
+def test_retries_back_off(outbox, monkeypatch):
+  outbox, sent, failures, connections = outbox
+  monkeypatch.setattr(Outbox, 'RETRY_DELAY', 0.05)
+  failures += ['reset'] * 3
+
+  outbox.send('Re: help', 'The commands.', 'alarm@example.com', ['a@example.com'])
+
+  assert wait_for(lambda: sent)
+  attempts = [connection.attempts[0] for connection in connections]
+  gaps = [later - earlier for earlier, later in zip(attempts, attempts[1:])]
+  assert len(gaps) == 3
+  assert all(gap >= delay for gap, delay in zip(gaps, [0.05, 0.1, 0.2]))
+
+
+def test_gives_up_after_max_attempts(outbox):
+  outbox, sent, failures, connections = outbox
+  failures += ['reset'] * Outbox.MAX_ATTEMPTS
+
+  outbox.send('Re: help', 'The commands.', 'alarm@example.com', ['a@example.com'])
+
+  assert wait_for(lambda: not failures and not outbox.pending)
+  time.sleep(0.1)
+  assert sent == []
+  assert len(connections) == Outbox.MAX_ATTEMPTS
+
+
+def test_shutdown_sends_what_is_queued():
+  sent = []
+  outbox = Outbox(lambda: FakeSMTP(sent, []), name='test')
+  outbox.start()
+
+  outbox.send('Re: cancel alarm', 'Emergency alarm canceled.', 'alarm@example.com', ['a@example.com'])
+  outbox.shutdown()
+
+  assert sent == [('Re: cancel alarm', 'Emergency alarm canceled.', ['a@example.com'])]
@@ -0,0 +1,63 @@
+import pytest
+
+from patterns import Waveform, compile_pattern
+
+
+def test_beep_is_a_square_wave():
+  waveform = compile_pattern(dict(type='beep', on=0.5, off=0.25))
+
+  assert waveform.at(0) == (True, 0.5)
+  assert waveform.at(0.6) == (False, 0.75)
+  assert waveform.at(0.8) == (True, 1.25)
+  assert waveform.at(75.1) == (True, 75.5)
+
+
+def test_on_is_constant():
+  assert compile_pattern(dict(type='on')).at(1000) == (True, None)
+
+
+def test_burst_merges_the_last_gap_into_the_pause():
+  waveform = compile_pattern(dict(type='burst', count=2, on=0.1, off=0.1, pause=1))
+
+  assert waveform.loop_states == [True, False, True, False]
+  assert waveform.loop_ends == pytest.approx([0.1, 0.2, 0.3, 1.4])
+  assert waveform.at(0.35)[0] is False
+  assert waveform.at(1.45)[0] is True
+
+
+def test_ramp_raises_the_duty_cycle():
+  ramp = compile_pattern({'type': 'ramp', 'from': 0.25, 'to': 0.75, 'steps': 3, 'period': 1})
+
+  assert ramp.at(0) == (True, 0.25)
+  assert ramp.at(1) == (True, 1.5)
+  assert ramp.at(2.5) == (True, 2.75)
+
+
+def test_sequence_plays_the_intro_once_then_loops_the_last_pattern():
+  waveform = compile_pattern([dict(type='beep', on=1, off=1, repeat=2), dict(type='on')])
+
+  assert waveform.intro_length == 4
+  assert waveform.at(2.5) == (True, 3)
+  assert waveform.at(3.5) == (False, 4)
+  assert waveform.at(4) == (True, None)
+  assert waveform.at(500) == (True, None)
+
+
+def test_morse_spells_the_alarm_name():
+  waveform = compile_pattern(dict(type='morse', unit=1, pause=7), 'et')
+
+  # E is a dot, a letter gap, then T is a dash, a letter gap and the word gap, before the pause
+  assert waveform.at(0) == (True, 1)
+  assert waveform.at(1) == (False, 4)
+  assert waveform.at(4) == (True, 7)
+  assert waveform.at(7) == (False, 21)
+  assert waveform.at(21) == (True, 22)
+
+
+def test_empty_waveform_is_off():
+  assert Waveform([], []).at(0) == (False, None)
+
+
+def test_bad_patterns_stay_on_and_are_cached():
+  assert compile_pattern(dict(type='siren')).at(3) == (True, None)
+  assert compile_pattern(dict(type='beep', on=2)) is compile_pattern(dict(type='beep', on=2))
@@ -0,0 +1,89 @@
+from dateutil import tz
+
+import threading
+import zoneinfo
+import time
+
+import pytest
+
+from remote import RemoteNode, RemoteRouser, RouserAgent, encode_timezone
+from rouser import Rouser
+
+
+class RecordingRouser(object):
+  def __init__(self, name):
+    self.name = name
+    self.calls = []
+    self.called = threading.Event()
+
+  def start_alarm(self, name, **params):
+    self.calls.append(('start', name, params.get('timezone')))
+    self.called.set()
+
+  def stop_alarm(self, reason='canceled'):
+    self.calls.append(('stop', reason))
+    self.called.set()
+
+
+def test_agent_needs_a_token_beyond_loopback():
+  with pytest.raises(ValueError):
+    RouserAgent([], host='0.0.0.0')
+
+  with pytest.raises(ValueError):
+    RouserAgent([], host='192.168.1.20', token='')
+
+  RouserAgent([], host='127.0.0.1')
+  RouserAgent([], host='localhost')
+  RouserAgent([], host='0.0.0.0', token='secret')
+
+
+def test_node_drops_calls_older_than_max_call_age():
+  rouser = RecordingRouser('bedroom')
+  agent = RouserAgent([rouser], host='127.0.0.1', port=0, token='secret')
+  agent.start()
+
+  node = RemoteNode('bedroom-pi', '127.0.0.1', agent.server.server_address[1], token='secret')
+  node.pending.append((time.time() - node.MAX_CALL_AGE - 1, dict(rouser='bedroom', method='start_alarm', params=dict(name='stale'))))
+  node.call('bedroom', 'stop_alarm', reason='canceled')
+  node.start()
+
+  try:
+    assert rouser.called.wait(5)
+  finally:
+    node.shutdown()
+    agent.shutdown()
+
+  assert rouser.calls == [('stop', 'canceled')]
+
+
+def test_timezones_are_sent_by_name():
+  assert encode_timezone(None) is None
+  assert encode_timezone('Europe/Berlin') == 'Europe/Berlin'
+  assert encode_timezone(tz.UTC) == 'UTC'
+  assert encode_timezone(zoneinfo.ZoneInfo('Europe/Berlin')) == 'Europe/Berlin'
+
+
+def test_remote_rousers_get_the_schedule_timezone():
+  rouser = RecordingRouser('bedroom')
+  agent = RouserAgent([rouser], host='127.0.0.1', port=0, token='sécret')
+  agent.start()
+
+  node = RemoteNode('bedroom-pi', '127.0.0.1', agent.server.server_address[1], token='sécret')
+  node.start()
+
+  try:
+    RemoteRouser('bedroom', node).start_alarm('morning', timezone='Europe/Berlin')
+    assert rouser.called.wait(5)
+  finally:
+    node.shutdown()
+    agent.shutdown()
+
+  assert rouser.calls == [('start', 'morning', 'Europe/Berlin')]
+  assert agent.handle(dict(token='☃', calls=[]))['error'] == 'bad token'
+
+
+def test_rousers_take_timezones_by_name(backend):
+  rouser = Rouser('test', [17], [27], backend=backend)
+  rouser.start_alarm('morning', timezone='Europe/Berlin')
+
+  assert rouser.alarm['timezone'] is tz.gettz('Europe/Berlin')
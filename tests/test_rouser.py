@@ -0,0 +1,160 @@
+from rouser import Rouser
+
+OUTPUT_PIN = 17
+INPUT_PIN = 27
+
+
+def make_rouser(backend, **params):
+  return Rouser('test', [OUTPUT_PIN], [INPUT_PIN], backend=backend, **params)
+
+
+def press(backend, seconds=0.1):
+  button = backend.inputs[INPUT_PIN]
+  button.press()
+  backend.advance(seconds)
+  button.release()
+
+
+def test_snooze_then_resume_rings_again(backend):
+  rouser = make_rouser(backend)
+  rouser.start_alarm(
+    'morning',
+    pattern={'type': 'on'},
+    snooze_conditions=[[{'type': 'presses', 'count': 1}]],
+    snooze_duration=60,
+  )
+  output = backend.outputs[OUTPUT_PIN]
+  assert output.is_active
+
+  press(backend)
+  rouser._step()
+  assert rouser.alarm['snooze_time'] is not None
+  assert not output.is_active
+
+  backend.advance(61)
+  rouser._step()
+  rouser._step()
+
+  # The press that snoozed the alarm must not snooze it again as soon as it resumes
+  assert rouser.alarm['onset_time'] is not None
+  assert rouser.alarm['snooze_time'] is None
+  assert output.is_active
+
+  # But a new press does
+  press(backend)
+  rouser._step()
+  assert rouser.alarm['snooze_time'] is not None
+
+
+def test_alarm_expires_after_max_active_duration(backend):
+  rouser = make_rouser(backend, max_active_duration=120)
+  rouser.start_alarm('morning', pattern={'type': 'on'}, stop_conditions=[[{'type': 'email'}]])
+
+  backend.advance(121)
+  rouser._step()
+
+  assert rouser.alarm['name'] is None
+  assert not backend.outputs[OUTPUT_PIN].is_active
+
+
+def test_stop_conditions_stop_the_alarm(backend):
+  rouser = make_rouser(backend)
+  stopped = []
+  rouser.listeners.append(lambda rouser, name, reason: stopped.append((name, reason)))
+  rouser.start_alarm('morning', pattern={'type': 'on'}, stop_conditions=[[{'type': 'long_press', 'seconds': 3}]])
+
+  press(backend, 1)
+  rouser._step()
+  assert rouser.alarm['name'] == 'morning'
+
+  press(backend, 3)
+  rouser._step()
+  assert stopped == [('morning', 'stopped')]
+
+
+def test_shutdown_keeps_the_saved_alarm(backend, tmp_path):
+  from state import StateStore
+
+  state = StateStore(str(tmp_path / 'state.sqlite3'))
+  rouser = make_rouser(backend, state=state)
+  stopped = []
+  rouser.listeners.append(lambda rouser, name, reason: stopped.append(reason))
+  rouser.start_alarm('morning', pattern={'type': 'on'})
+
+  rouser.shutdown()
+
+  assert not backend.outputs[OUTPUT_PIN].is_active
+  assert state.get(rouser.state_key)['name'] == 'morning'
+  assert stopped == []
+
+
+def restart(monkeypatch, state):
+  # A new process: the pins are set up again and the store is reopened from the file
+  state.close()
+  monkeypatch.setattr(Rouser, 'OUTPUTS', {})
+  monkeypatch.setattr(Rouser, 'INPUTS', {})
+  monkeypatch.setattr(Rouser, 'INSTANCES', [])
+
+  from state import StateStore
+  return StateStore(state.filepath)
+
+
+def test_active_alarm_is_restored_after_a_restart(backend, tmp_path, monkeypatch):
+  from state import StateStore
+
+  state = StateStore(str(tmp_path / 'state.sqlite3'))
+  rouser = make_rouser(backend, state=state)
+  rouser.start_alarm('morning', pattern={'type': 'on'}, stop_conditions=[[{'type': 'presses', 'count': 1}]])
+  onset_time = rouser.alarm['onset_time']
+
+  backend.advance(30)
+  state = restart(monkeypatch, state)
+  rouser = make_rouser(backend, state=state)
+
+  assert rouser.alarm['name'] == 'morning'
+  assert rouser.alarm['onset_time'] == onset_time  # so it still expires on time
+  assert backend.outputs[OUTPUT_PIN].is_active
+
+  # With its conditions, which were saved as specs
+  press(backend)
+  rouser._step()
+  assert rouser.alarm['name'] is None
+  assert state.get(rouser.state_key) is None
+
+
+def test_snoozed_alarm_is_restored_snoozed(backend, tmp_path, monkeypatch):
+  from state import StateStore
+
+  state = StateStore(str(tmp_path / 'state.sqlite3'))
+  rouser = make_rouser(backend, state=state)
+  rouser.start_alarm('morning', pattern={'type': 'on'}, snooze_duration=60)
+  rouser.snooze_alarm()
+  snooze_time = rouser.alarm['snooze_time']
+
+  state = restart(monkeypatch, state)
+  rouser = make_rouser(backend, state=state)
+
+  assert rouser.alarm['snooze_time'] == snooze_time
+  assert rouser.alarm['onset_time'] is None
+  assert not backend.outputs[OUTPUT_PIN].is_active
+
+  backend.advance(61)
+  rouser._step()
+  assert rouser.alarm['onset_time'] is not None
+  assert backend.outputs[OUTPUT_PIN].is_active
+
+
+def test_expired_alarm_is_not_restored(backend, tmp_path, monkeypatch):
+  from state import StateStore
+
+  state = StateStore(str(tmp_path / 'state.sqlite3'))
+  rouser = make_rouser(backend, state=state, max_active_duration=120)
+  rouser.start_alarm('morning', pattern={'type': 'on'})
+
+  backend.advance(121)
+  state = restart(monkeypatch, state)
+  rouser = make_rouser(backend, state=state, max_active_duration=120)
+
+  assert rouser.alarm['name'] is None
+  assert not backend.outputs[OUTPUT_PIN].is_active
+  assert state.get(rouser.state_key) is None
@@ -0,0 +1,78 @@
+import threading
+import datetime
+import asyncio
+import json
+import time
+
+from dateutil import tz
+
+import pytest
+
+from backends import SimulatedBackend
+from runtime import AsyncRuntime
+from scheduler import Scheduler
+from rouser import Rouser
+
+OUTPUT_PIN = 17
+INPUT_PIN = 27
+
+
+def wait_until(predicate, timeout=10):
+  deadline = time.monotonic() + timeout
+  while not predicate():
+    if time.monotonic() > deadline:
+      return False
+    time.sleep(0.01)
+
+  return True
+
+
+@pytest.fixture
+def running(tmp_path, monkeypatch):
+  # A scheduler with one alarm two seconds from now, and its rouser, running on the asyncio runtime
+  monkeypatch.chdir(tmp_path)
+
+  due = datetime.datetime.now(tz=tz.UTC) + datetime.timedelta(seconds=2)
+  (tmp_path / 'schedule_rules.json').write_text(json.dumps(dict(timezone='UTC', rrule_sets=[], exceptions=dict(include=[dict(
+    datetime=dict(year=due.year, month=due.month, day=due.day, hour=due.hour, minute=due.minute, second=due.second),
+    parameters=dict(test=dict(name='morning', stop_conditions=[[{'type': 'presses', 'count': 1}]])),
+  )]))))
+
+  backend = SimulatedBackend()
+  rouser = Rouser('test', [OUTPUT_PIN], [INPUT_PIN], backend=backend)
+  scheduler = Scheduler('schedule_rules.json', rousers=[rouser])
+  runtime = AsyncRuntime(scheduler, [rouser])
+
+  thread = threading.Thread(target=runtime.run, daemon=True)
+  thread.start()
+  assert wait_until(lambda: runtime.loop is not None)
+
+  yield runtime, backend
+
+  rouser.shutdown()
+  scheduler.shutdown()
+  thread.join(5)
+  assert not thread.is_alive()
+
+
+def test_alarms_fire_and_presses_stop_them(running):
+  runtime, backend = running
+  rouser = runtime.rousers[0]
+
+  assert wait_until(lambda: rouser.alarm['name'] == 'morning')
+
+  button = backend.inputs[INPUT_PIN]
+  button.press()
+  button.release()
+
+  assert wait_until(lambda: rouser.alarm['name'] is None)
+  assert not backend.outputs[OUTPUT_PIN].is_active
+
+
+def test_the_loop_keeps_running_while_a_step_waits_for_its_lock(running):
+  runtime, backend = running
+  rouser = runtime.rousers[0]
+
+  with Rouser.CONDITION:
+    rouser._notify_all()  # the rouser's next step has to wait until the condition is released
+    asyncio.run_coroutine_threadsafe(asyncio.sleep(0), runtime.loop).result(timeout=2)
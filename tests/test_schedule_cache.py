@@ -0,0 +1,92 @@
+import json
+
+from schedule_cache import CompiledSchedule
+from scheduler import Scheduler
+
+
+def test_save_and_load_round_trip(tmp_path):
+  path = str(tmp_path / 'schedule.compiled')
+  CompiledSchedule('abc', 100.0, 90.0, [200.0, float('inf')], [0, 2, 3], [110.0, 150.0, 120.0]).save(path)
+
+  compiled = CompiledSchedule.load(path)
+  try:
+    assert (compiled.schedule_hash, compiled.reference_time, compiled.threshold) == ('abc', 100.0, 90.0)
+    assert compiled.horizons == [200.0, float('inf')]
+    assert list(compiled.timestamps) == [110.0, 150.0, 120.0]
+
+    assert compiled.next_timestamp(0, 100) == 110.0
+    assert compiled.next_timestamp(0, 110) == 150.0
+    assert compiled.next_timestamp(0, 150) is None
+    assert compiled.next_timestamp(1, 100) == 120.0
+  finally:
+    compiled.close()
+
+
+def test_missing_or_corrupt_files_are_a_cache_miss(tmp_path):
+  assert CompiledSchedule.load(str(tmp_path / 'missing.compiled')) is None
+
+  (tmp_path / 'empty.compiled').write_bytes(b'')
+  assert CompiledSchedule.load(str(tmp_path / 'empty.compiled')) is None
+
+  (tmp_path / 'garbage.compiled').write_bytes(b'not a compiled schedule at all')
+  assert CompiledSchedule.load(str(tmp_path / 'garbage.compiled')) is None
+
+
+def test_truncated_files_are_a_cache_miss(tmp_path):
+  path = tmp_path / 'schedule.compiled'
+  CompiledSchedule('abc', 100.0, 90.0, [200.0, float('inf')], [0, 2, 3], [110.0, 150.0, 120.0]).save(str(path))
+  contents = path.read_bytes()
+
+  path.write_bytes(contents[:-8])
+  assert CompiledSchedule.load(str(path)) is None
+
+  path.write_bytes(contents[:-3])
+  assert CompiledSchedule.load(str(path)) is None
+
+  # Offsets that point past the timestamps
+  CompiledSchedule('abc', 100.0, 90.0, [200.0, float('inf')], [0, 2, 4], [110.0, 150.0, 120.0]).save(str(path))
+  assert CompiledSchedule.load(str(path)) is None
+
+
+def write_schedule(tmp_path, hour):
+  (tmp_path / 'schedule_rules.json').write_text(json.dumps(dict(
+    timezone='UTC', rrule_sets=[dict(rrules=[dict(freq='daily', byhour=hour, byminute=0)], parameters={})],
+  )))
+
+
+def test_scheduler_reuses_the_compiled_schedule_until_the_schedule_changes(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  write_schedule(tmp_path, 7)
+
+  cold = Scheduler('schedule_rules.json')
+  cold._check_schedule()
+  assert cold.cached_rrsets[0]['rrule_set'] is not None
+
+  # A restart with the same schedule doesn't build the rrules at all
+  warm = Scheduler('schedule_rules.json')
+  warm._check_schedule()
+  assert warm.cached_rrsets[0]['rrule_set'] is None
+  assert warm.compiled_schedule.reference_time == cold.compiled_schedule.reference_time
+  assert warm.calculate_datetimes()[0]['datetime'] == cold.calculate_datetimes()[0]['datetime']
+
+  write_schedule(tmp_path, 9)
+  changed = Scheduler('schedule_rules.json')
+  changed._check_schedule()
+  assert changed.cached_rrsets[0]['rrule_set'] is not None
+  assert changed.calculate_datetimes()[0]['datetime'].hour == 9
+
+
+def test_scheduler_recompiles_a_stale_compiled_schedule(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  write_schedule(tmp_path, 7)
+
+  scheduler = Scheduler('schedule_rules.json')
+  scheduler._check_schedule()
+  compiled = scheduler.compiled_schedule
+  compiled.reference_time -= Scheduler.COMPILED_HORIZON.total_seconds() + 60
+  compiled.save(scheduler.compiled_filepath)
+
+  restarted = Scheduler('schedule_rules.json')
+  restarted._check_schedule()
+  assert restarted.cached_rrsets[0]['rrule_set'] is not None
+  assert restarted.compiled_schedule.reference_time > compiled.reference_time
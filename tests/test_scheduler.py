@@ -0,0 +1,262 @@
+import threading
+import datetime
+import json
+
+from dateutil import tz
+
+import pytest
+
+from scheduler import Scheduler
+
+
+class RecordingRouser(object):
+  def __init__(self, name):
+    self.name = name
+    self.started = []
+    self.timezones = []
+
+  def start_alarm(self, name=None, **params):
+    self.started.append(name)
+    self.timezones.append(params.get('timezone'))
+
+
+@pytest.fixture
+def write_schedule(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+
+  def write(rrule_sets):
+    (tmp_path / 'schedule_rules.json').write_text(json.dumps(dict(timezone='UTC', rrule_sets=rrule_sets)))
+
+  return write
+
+
+def test_timeline_stops_at_the_first_capped_horizon(write_schedule):
+  # A minutely rule has more than MAX_COMPILED_OCCURRENCES in a week, so its compiled occurrences run out first
+  write_schedule([
+    dict(rrules=[dict(freq='minutely', dtstart=dict(hour=0, minute=0, second=0))], parameters=dict(bed=dict(name='minutely'))),
+    dict(rrules=[dict(freq='daily', byhour=7, byminute=30)], parameters=dict(bed=dict(name='daily'))),
+  ])
+  scheduler = Scheduler('schedule_rules.json', rousers=[RecordingRouser('bed')])
+
+  with scheduler.condition:
+    scheduler._step()
+
+  scheduler.timeline_thread.join()
+
+  capped = scheduler.compiled_schedule.horizons[0]
+  assert capped < scheduler.compiled_schedule.horizons[1]
+  assert scheduler.timeline_end.timestamp() <= capped
+  assert all(cursor.fallback is None for cursor in scheduler.timeline_cursors)
+
+  names = {params['bed']['name'] for dt, params in scheduler.timeline}
+  assert names == {'minutely', 'daily'}
+
+
+def test_timeline_is_built_without_the_condition(write_schedule, monkeypatch):
+  write_schedule([dict(rrules=[dict(freq='daily', byhour=7, byminute=30)], parameters=dict(bed=dict(name='daily')))])
+  scheduler = Scheduler('schedule_rules.json', rousers=[RecordingRouser('bed')])
+
+  filling, release = threading.Event(), threading.Event()
+  fill_timeline = scheduler._fill_timeline
+
+  def slow_fill(end):
+    filling.set()
+    release.wait(5)
+    fill_timeline(end)
+
+  monkeypatch.setattr(scheduler, '_fill_timeline', slow_fill)
+
+  with scheduler.condition:
+    scheduler._step()
+
+  assert filling.wait(5)
+  # The main loop can still take the condition to fire alarms
+  assert scheduler.condition.acquire(timeout=1)
+  scheduler.condition.release()
+
+  release.set()
+  upcoming = scheduler.upcoming(2)
+  assert len(upcoming) == 2
+  assert all(dt.hour == 7 and dt.minute == 30 for dt, params in upcoming)
+
+
+def test_timeline_for_a_replaced_schedule_is_dropped(write_schedule):
+  write_schedule([dict(rrules=[dict(freq='daily', byhour=7, byminute=30)], parameters=dict(bed=dict(name='early')))])
+  scheduler = Scheduler('schedule_rules.json', rousers=[RecordingRouser('bed')])
+
+  with scheduler.condition:
+    scheduler._step()
+
+  scheduler.timeline_thread.join()
+
+  write_schedule([dict(rrules=[dict(freq='daily', byhour=9, byminute=0)], parameters=dict(bed=dict(name='late')))])
+  scheduler.schedule_changed = True
+
+  with scheduler.condition:
+    scheduler._step()
+
+  assert {params['bed']['name'] for dt, params in scheduler.upcoming()} == {'late'}
+
+
+def test_alarms_are_started_with_the_timezone_name(write_schedule):
+  write_schedule([])
+  rouser = RecordingRouser('bed')
+  scheduler = Scheduler('schedule_rules.json', rousers=[rouser])
+  scheduler._check_schedule()
+
+  now = datetime.datetime.now(tz=scheduler.timezone)
+  scheduler.cached_inclusions = [dict(datetime=now, params=dict(bed=dict(name='one-off')))]
+  scheduler._push_alarm(now, ('inclusion', 0))
+  scheduler._fire_due_alarms(now)
+
+  assert rouser.timezones == ['UTC']
+
+
+def test_expand_runs_without_the_condition(write_schedule, monkeypatch):
+  pytest.importorskip('numpy')
+  import expansion
+
+  write_schedule([dict(rrules=[dict(freq='daily', byhour=7, byminute=30)], parameters=dict(bed=dict(name='daily')))])
+  scheduler = Scheduler('schedule_rules.json', rousers=[RecordingRouser('bed')])
+  scheduler._check_schedule()
+
+  held = []
+  expand_rule_set = expansion.expand_rule_set
+
+  def checked_expand_rule_set(*args):
+    held.append(scheduler.condition._is_owned())
+    return expand_rule_set(*args)
+
+  monkeypatch.setattr(expansion, 'expand_rule_set', checked_expand_rule_set)
+
+  start = scheduler.now
+  expanded = scheduler.expand(start, start + datetime.timedelta(days=10))
+
+  assert held == [False]
+  assert len(expanded['bed']) == 10
+
+
+def loaded_scheduler(write_schedule, rrule_sets, inclusions=()):
+  write_schedule(rrule_sets)
+  if inclusions:
+    path = 'schedule_rules.json'
+    with open(path) as file:
+      schedule = json.load(file)
+
+    schedule['exceptions'] = dict(include=list(inclusions))
+    with open(path, 'w') as file:
+      json.dump(schedule, file)
+
+  rouser = RecordingRouser('bed')
+  scheduler = Scheduler('schedule_rules.json', rousers=[rouser])
+  scheduler._check_schedule()
+  return scheduler, rouser
+
+
+def next_at(scheduler, hour, minute):
+  now = scheduler.now
+  dt = now.replace(hour=hour, minute=minute, second=0)
+  return dt if dt > now else dt + datetime.timedelta(days=1)
+
+
+def test_queue_fires_alarms_in_order(write_schedule):
+  scheduler, rouser = loaded_scheduler(write_schedule, [
+    dict(rrules=[dict(freq='daily', byhour=9, byminute=0)], parameters=dict(bed=dict(name='nine'))),
+    dict(rrules=[dict(freq='daily', byhour=7, byminute=30)], parameters=dict(bed=dict(name='half past seven'))),
+  ])
+  start = scheduler.now
+  scheduler._build_alarm_queue(start)
+
+  seven, nine = next_at(scheduler, 7, 30), next_at(scheduler, 9, 0)
+  first, second = sorted([(seven, 'half past seven'), (nine, 'nine')])
+
+  scheduler._fire_due_alarms(first[0] - datetime.timedelta(seconds=1))
+  assert rouser.started == []
+
+  scheduler._fire_due_alarms(first[0])
+  assert rouser.started == [first[1]]
+
+  scheduler._fire_due_alarms(second[0] + datetime.timedelta(seconds=1))
+  assert rouser.started == [first[1], second[1]]
+
+  # Each rule set is back in the queue for its next day
+  assert sorted(dt for _, _, dt, _ in scheduler.alarm_queue) == [first[0] + datetime.timedelta(days=1), second[0] + datetime.timedelta(days=1)]
+
+
+def test_one_off_alarms_fire_once(write_schedule):
+  when = datetime.datetime.now(tz=datetime.timezone.utc).replace(microsecond=0) + datetime.timedelta(hours=2)
+  fields = dict(year=when.year, month=when.month, day=when.day, hour=when.hour, minute=when.minute, second=0)
+  scheduler, rouser = loaded_scheduler(write_schedule, [], [dict(datetime=fields, parameters=dict(bed=dict(name='nap')))])
+  scheduler._build_alarm_queue(scheduler.now)
+
+  scheduler._fire_due_alarms(when.replace(second=1))
+  scheduler._fire_due_alarms(when + datetime.timedelta(days=1))
+  assert rouser.started == ['nap']
+  assert scheduler.alarm_queue == []
+
+
+def one_off_scheduler(timezone, dt):
+  rouser = RecordingRouser('bed')
+  scheduler = Scheduler('schedule_rules.json', rousers=[rouser])
+  scheduler.timezone = timezone
+  scheduler.cached_inclusions = [dict(datetime=dt, params=dict(bed=dict(name='one-off')))]
+  scheduler._push_alarm(dt, ('inclusion', 0))
+  return scheduler, rouser
+
+
+def test_sleep_is_measured_in_real_time_across_dst(monkeypatch):
+  new_york = tz.gettz('America/New_York')
+  scheduler, rouser = one_off_scheduler(new_york, datetime.datetime(2027, 3, 14, 7, 0, tzinfo=new_york))
+  monkeypatch.setattr(scheduler, 'MAX_SLEEP', 24 * 60 * 60)
+
+  # Clocks spring forward at 02:00, so 01:00 to 07:00 is only five hours
+  assert scheduler._next_wakeup(datetime.datetime(2027, 3, 14, 1, 0, tzinfo=new_york)) == 5 * 60 * 60
+
+
+def test_sleep_is_capped_so_clock_steps_are_noticed():
+  utc = tz.gettz('UTC')
+  scheduler, rouser = one_off_scheduler(utc, datetime.datetime(2027, 3, 14, 7, 0, tzinfo=utc))
+
+  assert scheduler._next_wakeup(datetime.datetime(2027, 3, 13, 7, 0, tzinfo=utc)) == scheduler.MAX_SLEEP
+
+
+def test_alarms_are_due_in_real_time_across_dst():
+  new_york = tz.gettz('America/New_York')
+  scheduler, rouser = one_off_scheduler(new_york, datetime.datetime(2027, 11, 7, 1, 30, tzinfo=new_york))
+
+  # Clocks fall back at 02:00, so the second 01:10 comes 40 minutes after the first 01:30
+  scheduler._fire_due_alarms(datetime.datetime(2027, 11, 7, 1, 10, tzinfo=new_york))
+  assert rouser.started == []
+
+  scheduler._fire_due_alarms(datetime.datetime(2027, 11, 7, 1, 10, fold=1, tzinfo=new_york))
+  assert rouser.started == ['one-off']
+
+
+def test_missed_alarms_fire_late_once(write_schedule):
+  scheduler, rouser = loaded_scheduler(write_schedule, [
+    dict(rrules=[dict(freq='minutely', dtstart=dict(hour=0, minute=0, second=0))], parameters=dict(bed=dict(name='minutely'))),
+  ])
+  start = scheduler.now.replace(second=0) + datetime.timedelta(minutes=2)
+  scheduler._build_alarm_queue(start)
+
+  # Five occurrences were missed, which is within MAX_LATENESS
+  now = start + datetime.timedelta(minutes=5, seconds=30)
+  scheduler._fire_due_alarms(now)
+
+  assert rouser.started == ['minutely']
+  assert scheduler.alarm_queue[0][2] == start + datetime.timedelta(minutes=6)
+
+
+def test_alarms_later_than_max_lateness_are_skipped(write_schedule):
+  scheduler, rouser = loaded_scheduler(write_schedule, [
+    dict(rrules=[dict(freq='daily', byhour=7, byminute=30)], parameters=dict(bed=dict(name='daily'))),
+  ])
+  scheduler._build_alarm_queue(scheduler.now)
+  dt = next_at(scheduler, 7, 30)
+
+  scheduler._fire_due_alarms(dt + scheduler.MAX_LATENESS + datetime.timedelta(minutes=1))
+  assert rouser.started == []
+  assert scheduler.alarm_queue[0][2] == dt + datetime.timedelta(days=1)
+
+  scheduler._fire_due_alarms(dt + datetime.timedelta(days=1, minutes=10))
+  assert rouser.started == ['daily']
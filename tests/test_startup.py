@@ -0,0 +1,56 @@
+import subprocess
+import sys
+import os
+
+from metrics import Metrics
+
+RASPY_ALARM = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'raspy_alarm')
+
+# Imported only by the options that use them, since each costs a noticeable fraction of a second on a Pi Zero
+LAZY = ['numpy', 'gpiozero', 'flask', 'IPython', 'asyncio', 'imaplib', 'smtplib', 'interface', 'triggers', 'remote', 'escalation', 'runtime', 'expansion']
+
+
+def write_configuration(directory):
+  (directory / 'alarm_configuration.py').write_text('rouser_configs = {}\nemails = {}\nalarms = {}\n')
+  (directory / 'schedule_rules.json').write_text('{"timezone": "UTC", "rrule_sets": [{"rrules": [{"byhour": 7}], "parameters": {}}]}')
+
+
+def imported_by(code, directory):
+  # Which of LAZY a fresh interpreter has imported after running `code` in `directory`
+  script = '{}\nimport sys\nprint(" ".join(name for name in {!r} if name in sys.modules))'.format(code, LAZY)
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join([RASPY_ALARM, str(directory)]))
+  result = subprocess.run([sys.executable, '-c', script], cwd=str(directory), env=env, capture_output=True, text=True, check=True)
+  return result.stdout.split()
+
+
+def test_main_imports_only_what_every_mode_needs(tmp_path):
+  # Including gpiozero, though the rousers' default backend is made on import
+  write_configuration(tmp_path)
+  assert imported_by('import main', tmp_path) == []
+
+
+def test_loading_the_schedule_does_not_import_numpy(tmp_path):
+  write_configuration(tmp_path)
+  code = 'from scheduler import Scheduler\nscheduler = Scheduler("schedule_rules.json")\nassert scheduler._check_schedule()'
+  assert imported_by(code, tmp_path) == []
+
+
+def test_startup_report_times_each_phase(tmp_path, monkeypatch, capsys):
+  write_configuration(tmp_path)
+  monkeypatch.syspath_prepend(str(tmp_path))
+  import main
+
+  metrics = Metrics()
+  monkeypatch.setattr(main, 'METRICS', metrics)
+
+  startup = main.StartupReport(main.STARTED)
+  startup.mark('imports')
+  startup.mark('state')
+  startup.report()
+
+  assert [phase for phase, seconds in startup.phases] == ['imports', 'state']
+  assert all(seconds >= 0 for phase, seconds in startup.phases)
+  assert capsys.readouterr().out.startswith('Started in ')
+
+  observed = [(histogram['name'], histogram['labels']) for histogram in metrics.snapshot()['histograms']]
+  assert observed == [('startup_seconds', dict(phase='imports')), ('startup_seconds', dict(phase='state'))]
@@ -0,0 +1,67 @@
+import threading
+import sqlite3
+import time
+
+from state import StateStore
+from rouser import Rouser
+
+
+def stored(filepath, key):
+  connection = sqlite3.connect(filepath)
+  try:
+    row = connection.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+  finally:
+    connection.close()
+
+
+def wait_until(predicate, timeout=5):
+  deadline = time.monotonic() + timeout
+  while not predicate():
+    if time.monotonic() > deadline:
+      return False
+    time.sleep(0.01)
+
+  return True
+
+
+def test_background_durable_writes_do_not_wait_for_the_disk(tmp_path):
+  filepath = str(tmp_path / 'state.sqlite3')
+  state = StateStore(filepath)
+
+  # Holding the database stands in for a slow fsync on an SD card
+  with state.db_lock:
+    returned = threading.Event()
+    threading.Thread(target=lambda: (state.set('key', 1, durable=True, background=True), returned.set()), daemon=True).start()
+    assert returned.wait(5)
+    assert state.get('key') == 1
+
+  assert wait_until(lambda: stored(filepath, 'key') == '1')
+  state.close()
+
+
+def test_close_commits_background_writes(tmp_path):
+  filepath = str(tmp_path / 'state.sqlite3')
+  state = StateStore(filepath)
+  state.set('first', 'a', durable=True, background=True)
+  state.set('second', 'b', durable=True, background=True)
+  state.close()
+
+  assert StateStore(filepath).get('second') == 'b'
+
+
+def test_rousers_save_alarms_without_waiting_for_the_disk(backend, tmp_path):
+  state = StateStore(str(tmp_path / 'state.sqlite3'))
+  rouser = Rouser('test', [17], [27], backend=backend, state=state)
+
+  with state.db_lock:
+    started = threading.Event()
+    threading.Thread(target=lambda: (rouser.start_alarm('morning'), started.set()), daemon=True).start()
+    assert started.wait(5)
+
+    # Nor does anyone else waiting on the rousers' condition
+    assert Rouser.CONDITION.acquire(timeout=1)
+    Rouser.CONDITION.release()
+
+  state.close()
+  assert StateStore(state.filepath).get(rouser.state_key)['name'] == 'morning'
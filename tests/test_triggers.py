@@ -0,0 +1,91 @@
+import socket
+import json
+import os
+
+import pytest
+
+from triggers import SocketInterface, WebhookInterface
+
+
+class RecordingScheduler(object):
+  def __init__(self):
+    self.rousers = {}
+
+
+def test_webhook_needs_a_token():
+  with pytest.raises(ValueError):
+    WebhookInterface()
+
+  with pytest.raises(ValueError):
+    WebhookInterface(token='')
+
+  assert WebhookInterface(token='secret').authenticate('secret')
+
+
+def test_tokens_may_be_any_text():
+  interface = WebhookInterface(token='sécret')
+
+  assert interface.authenticate('sécret')
+  assert not interface.authenticate('secret')
+  assert not interface.authenticate('☃')
+  assert not WebhookInterface(token='secret').authenticate('sécret')
+
+
+def test_socket_is_never_open_to_other_users(tmp_path, monkeypatch):
+  import triggers
+
+  path = str(tmp_path / 'alarm.sock')
+  modes = []
+  server_bind = triggers._SocketServer.server_bind
+
+  def checked_server_bind(server):
+    server_bind(server)
+    modes.append(os.stat(path).st_mode & 0o777)
+
+  monkeypatch.setattr(triggers._SocketServer, 'server_bind', checked_server_bind)
+  umask = os.umask(0o022)
+
+  try:
+    interface = SocketInterface(path=path)
+    interface.startup()
+    assert os.umask(0o022) == 0o022
+  finally:
+    os.umask(umask)
+
+  assert modes == [0o600]
+  assert os.stat(path).st_mode & 0o777 == 0o600
+  interface.shutdown()
+
+
+def test_socket_others_can_reach_needs_a_token(tmp_path):
+  with pytest.raises(ValueError):
+    SocketInterface(path=str(tmp_path / 'alarm.sock'), mode=0o666)
+
+  SocketInterface(path=str(tmp_path / 'alarm.sock'))
+  SocketInterface(path=str(tmp_path / 'alarm.sock'), mode=0o666, token='secret')
+
+
+def test_socket_answers_commands_and_shuts_down_twice(tmp_path):
+  path = str(tmp_path / 'alarm.sock')
+  interface = SocketInterface(path=path, token='secret')
+  interface.scheduler = RecordingScheduler()
+  interface.startup()
+
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  client.connect(path)
+  stream = client.makefile('rwb')
+
+  def send(message):
+    stream.write(json.dumps(message).encode('utf-8') + b'\n')
+    stream.flush()
+    return json.loads(stream.readline().decode('utf-8'))
+
+  assert send(dict(token='wrong', command='help')) == dict(ok=False, error='bad token')
+  response = send(dict(token='secret', command='help'))
+  assert response['ok'] and 'wake up now' in response['reply']
+
+  stream.close()
+  client.close()
+
+  interface.shutdown()
+  interface.shutdown()
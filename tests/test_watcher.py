@@ -0,0 +1,72 @@
+import threading
+import json
+import os
+
+import pytest
+
+from watcher import FileWatcher
+from scheduler import Scheduler
+
+
+def replace(path, text):
+  temporary = str(path) + '.tmp'
+  with open(temporary, 'w') as file:
+    file.write(text)
+
+  os.replace(temporary, str(path))
+
+
+@pytest.fixture(params=['inotify', 'poll'])
+def watched(request, tmp_path, monkeypatch):
+  if request.param == 'poll':
+    monkeypatch.setattr(FileWatcher, '_setup_inotify', lambda self: False)
+    monkeypatch.setattr(FileWatcher, 'POLL_INTERVAL', 0.05)
+
+  path = tmp_path / 'schedule_rules.json'
+  path.write_text('{}')
+  changed = threading.Event()
+
+  watcher = FileWatcher(str(path), changed.set)
+  watcher.start()
+  yield watcher, path, changed
+
+  watcher.stop()
+
+
+def test_watcher_sees_writes_and_atomic_replacements(watched):
+  watcher, path, changed = watched
+
+  with open(str(path), 'w') as file:
+    file.write('{"timezone": "UTC"}')
+  assert changed.wait(5)
+
+  changed.clear()
+  replace(path, '{"timezone": "Europe/Berlin"}')
+  assert changed.wait(5)
+
+
+def test_watcher_ignores_other_files(watched):
+  watcher, path, changed = watched
+
+  (path.parent / 'other.json').write_text('{}')
+  assert not changed.wait(0.3)
+
+
+def test_schedule_is_only_reloaded_when_its_contents_change(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  schedule = dict(timezone='UTC', rrule_sets=[dict(rrules=[dict(freq='daily', byhour=7)], parameters={})])
+  (tmp_path / 'schedule_rules.json').write_text(json.dumps(schedule))
+  scheduler = Scheduler('schedule_rules.json')
+
+  assert scheduler._check_schedule()
+  assert not scheduler._check_schedule()
+
+  # A half-written file keeps the previous schedule
+  (tmp_path / 'schedule_rules.json').write_text('{"timezone": ')
+  assert not scheduler._check_schedule()
+  assert len(scheduler.cached_rrsets) == 1
+
+  schedule['rrule_sets'].append(dict(rrules=[dict(freq='daily', byhour=9)], parameters={}))
+  (tmp_path / 'schedule_rules.json').write_text(json.dumps(schedule))
+  assert scheduler._check_schedule()
+  assert len(scheduler.cached_rrsets) == 2